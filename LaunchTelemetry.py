@@ -7,8 +7,16 @@
 import sys, os
 sys.path.append(os.getcwd())
 import time
+import socket
 from dronekit_texting.TextMessageTelemetry import LocalGCScommunication, TextMessageTelemetry
-import multiprocessing
+from dronekit_texting.Reliability import DEFAULT_RELIABLE_TYPES
+from dronekit_texting.FleetRouter import FleetRouter
+from dronekit_texting.VehicleStateCache import VehicleStateCache
+from dronekit_texting.StateSync import StateSync, SYNC_MARKER, TABLE_PARAMS, TABLE_MISSION
+from dronekit_texting.Metrics import MetricsRegistry, MetricsServer, SnapshotWriter
+from dronekit_texting.SendJournal import SendJournal
+from dronekit_texting.VehicleSender import VehicleSender
+from dronekit_texting.TelemetryRecorder import TelemetryRecorder
 from dronekit import connect
 import threading
 
@@ -22,27 +30,62 @@ import threading
 
 #MANDATORY CONFIGURATION
 AM_I_GROUNDSTATION_OR_VEHICLE = "VEHICLE"
+SMS_MODE = "PDU"  #"PDU" sends 140 binary bytes per text message; use "TEXT" for modems without PDU support
+RECEIVE_MODE = "NOTIFY"  #"NOTIFY" reads text messages as the modem announces them; use "POLL" for modems without +CMTI
+MODEM_SCHEDULE = "LEAST_BUSY"  #with a list of modem paths, which modem sends next:  "LEAST_BUSY" or "ROUND_ROBIN"
+MAX_TEXT_MESSAGES_PER_MINUTE = None  #text message budget, None for no limit; telemetry rates are degraded to stay within it
+MAX_TEXT_MESSAGES_PER_DAY = None
+RELIABLE_TYPES = DEFAULT_RELIABLE_TYPES  #messages retransmitted until acked, e.g. GCS commands; () to send everything best-effort
+SYNC_STATE = True  #keep the ground station's copy of parameters and mission in step by exchanging hashes; set on both ends
+METRICS_PORT = None  #e.g. 9464 to serve pipeline metrics on http://127.0.0.1:9464/metrics (Prometheus) and /metrics.json
+METRICS_SNAPSHOT_PATH = None  #e.g. 'telemetry_metrics.json' to rewrite a metrics snapshot every METRICS_SNAPSHOT_SECONDS
+METRICS_SNAPSHOT_SECONDS = 60
+JOURNAL_PATH = None  #e.g. 'telemetry_journal.bin' to keep unsent acks, GCS commands and STATUSTEXT on disk across crashes and reboots
+#phone numbers and modem paths may also be lists, for a pool of modems and SIMs, e.g. ['/dev/ttyUSB0', '/dev/ttyUSB2']
 
 #GROUND CONFIGURATION
 GROUNDSTATION_PHONE_NUMBER = "7031234567"
 GROUNDSTATION_MODEM_PATH = '/dev/tty.sierra03'
 GCS_PORT = 14550
 GROUNDSTATION_MODEM_BAUD = 115200
+GCS_COMMAND_BATCH_SECONDS = 1.0  #how long the ground station collects GCS commands before texting them as one batch
+BULK_DECODE_WORKERS = 2  #worker processes decoding a backlog of text messages after a coverage gap; 0 to decode in one process
+COLLAPSE_BACKLOG = False  #True hands the GCS only the newest sample of each telemetry stream in a backlog (acks, STATUSTEXT, ... all go)
+RECORD_PATH = None  #e.g. 'flight.tlog' to record what the GCS is sent, plus every text message received, for tools/QueryTelemetryLog.py
+FLEET = []  #to serve several vehicles, one dict per vehicle (VEHICLE_PHONE_NUMBER and GCS_PORT are then unused), e.g.
+#   {"PhoneNumbers": ["7031234567"], "SystemId": 1, "GcsSystemId": 1, "GcsPort": 14550},
+#   {"PhoneNumbers": ["7037654321", "7037654322"], "SystemId": 1, "GcsSystemId": 2, "GcsPort": 14550},
+#vehicles sharing a GcsPort show up in one GCS under their GcsSystemId; give each its own GcsPort to keep its sysid
 
 #VEHICLE CONFIGURATION
 VEHICLE_PHONE_NUMBER = "7031234567"
 AUTOPILOT_PATH = '/dev/ttyACM0'
 VEHICLE_MODEM_PATH = '/dev/tty.netgear03'
-SECONDS_BETWEEN_MAILBOX_CHECKS = 5  #how often does the vehicle grab the modem to check for new commands
+SECONDS_BETWEEN_MAILBOX_CHECKS = 5  #in POLL mode, how often does the vehicle grab the modem to check for new commands
+MAX_SECONDS_BETWEEN_TEXT_MESSAGES = 10  #send whatever telemetry is queued after this long, even if it doesn't fill a text message
 VEHICLE_MODEM_BAUD = 115200
+SYNCED_READ_SECONDS = 120  #with SYNC_STATE, parameters and mission items are only texted this long after the ground station asks
 
 #GLOBALS
-MessageQueue = []
-MessageQueueLock = threading.Lock()
+Metrics = MetricsRegistry()  #encode and send times, sizes, drops and queue depths of the whole pipeline
 
 
 
 
+######################################################################################
+#
+#  Summary:  Starts whichever metrics exporters are configured
+#
+######################################################################################
+def StartMetricsExport():
+    if METRICS_PORT!=None:
+        MetricsServer(Metrics, METRICS_PORT).Start()
+        print "Serving metrics on http://127.0.0.1:%d/metrics" % METRICS_PORT
+    if METRICS_SNAPSHOT_PATH!=None:
+        SnapshotWriter(Metrics, METRICS_SNAPSHOT_PATH, METRICS_SNAPSHOT_SECONDS).Start()
+
+
+
 ######################################################################################
 #
 #  Summary:  Run this on your ground station laptop
@@ -50,29 +93,55 @@ MessageQueueLock = threading.Lock()
 ######################################################################################
 def RunAsGroundStation():
 
-    def GCSListener():
+    def GCSListener(GcsPort, LocalGCSconnection):
+        #commands the GCS sends back to back (e.g. a batch of PARAM_SETs) are collected for
+        #GCS_COMMAND_BATCH_SECONDS and sent as one payload per vehicle, segmented over several texts if needed
+        Batches={}   #vehicle -> list of commands
+        BatchStarted=None
         while 1:
-            GCScommand=LocalGCSconnection.ReceiveMavlinkMessageFromGCS()
-            if GCScommand.get_type()=="HEARTBEAT":
-                #filter ground-to-vehicle heartbeats to limit SMS's
-                continue
-            else:
-                list=[]
-                list.append(GCScommand)
-                TextMessagingConnection.SendTextMessageTelemetry(list, blocking=True)  #prioritize outgoing commands by blocking
+            #sleeps in select() until the GCS sends something or the batch is due, so an idle link costs no CPU
+            Timeout = None if len(Batches)==0 else max(0, BatchStarted+GCS_COMMAND_BATCH_SECONDS-time.time())
+            try:
+                GCScommands=LocalGCSconnection.ReceiveMavlinkMessagesFromGCS(timeout=Timeout)
+            except socket.error, error:
+                print "Exception Receiving from GCS: ", str(error)
+                GCScommands=[]
+                time.sleep(1)
+
+            for GCScommand in GCScommands:
+                if GCScommand.get_type()=="HEARTBEAT":   #filter ground-to-vehicle heartbeats to limit SMS's
+                    continue
+                if len(Batches)==0:
+                    BatchStarted=time.time()
+                for Vehicle, Command in Router.ToVehicles(GcsPort, GCScommand):
+                    #reads the cache can answer (parameters, mission, ...) never cost a text message
+                    Answers, Forward = StateCaches[Vehicle].Answer(Command)
+                    LocalGCSconnection.SendBuffersToGCS(Answers)
+                    if Forward:
+                        Batches.setdefault(Vehicle, []).append(Command)
+
+            if len(Batches)>0 and (time.time()-BatchStarted) >= GCS_COMMAND_BATCH_SECONDS:
+                for Vehicle, ListOfCommands in Batches.items():
+                    TextMessagingConnection.Submit(ListOfCommands, Critical=True, Destination=Vehicle)  #commands are never dropped from the send queue
+                Batches={}
 
     def HeartbeatRepeater():
-        if LastIncomingHeartbeat!=None:
-            LocalGCSconnection.SendMavlinkMessageToGCS(LastIncomingHeartbeat)
-            time.sleep(0.5)  #the GCS wants to be fed a vehicle heartbeat something like every second or it complains
+        #the GCS wants to be fed a vehicle heartbeat something like every second or it complains
+        while 1:
+            for Vehicle, StateCache in StateCaches.items():
+                Heartbeat = StateCache.GetHeartbeat()
+                if Heartbeat!=None:
+                    GCSconnections[Router.GetVehicle(Vehicle).GcsPort].SendBufferToGCS(Heartbeat)
+            time.sleep(1)
 
     try:
+        Fleet = FLEET or [{"PhoneNumbers": VEHICLE_PHONE_NUMBER, "GcsPort": GCS_PORT}]
         print "Verifying initialization values..."
         print "  -GROUNDSTATION PHONE NUMBER =",GROUNDSTATION_PHONE_NUMBER
-        print "  -VEHICLE PHONE NUMBER =",VEHICLE_PHONE_NUMBER
+        for Entry in Fleet:
+            print "  -VEHICLE PHONE NUMBER =",Entry["PhoneNumbers"],"  GCS PORT =",Entry.get("GcsPort", GCS_PORT),"  GCS SYSID =",Entry.get("GcsSystemId", Entry.get("SystemId"))
         print "  -GROUNDSTATION MODEM PATH =", GROUNDSTATION_MODEM_PATH
         print "  -GROUNDSTATION MODEM BAUD =", GROUNDSTATION_MODEM_BAUD
-        print "  -GCS SOFTWARE (E.G. MISSION PLANNER) LISTENING ON PORT", GCS_PORT
         sys.stdout.write("Are these values correct? (y/n) ")
         response = raw_input().lower()
         if response == 'n':
@@ -84,17 +153,42 @@ def RunAsGroundStation():
             print "invalid keystroke"
             return
 
-        LastIncomingHeartbeat = None  #Cached copy of last received heartbeat from vehicle
-        LocalGCSconnection = LocalGCScommunication(GCSport=GCS_PORT, debug_level=4)
-        TextMessagingConnection = TextMessageTelemetry(VEHICLE_PHONE_NUMBER, GROUNDSTATION_MODEM_PATH, VEHICLE_MODEM_BAUD, DEBUG_LEVEL=4)
-        TextMessagingConnection.PurgeIncomingTextMessages()
-
-        LocalGCSconnection.Connect()
-
-        GCSListenerProcess = multiprocessing.Process(target=GCSListener)
-        GCSListenerProcess.start()
-        HeartbeatFakerProcess = multiprocessing.Process(target=HeartbeatRepeater)
-        HeartbeatFakerProcess.start()
+        StateCaches = {}  #vehicle -> VehicleStateCache:  last heartbeat, parameters, mission, ... as sent to the GCS
+        Syncs = {}  #vehicle -> StateSync, started on the vehicle's first heartbeat
+        TextMessagingConnection = TextMessageTelemetry(None, GROUNDSTATION_MODEM_PATH, VEHICLE_MODEM_BAUD, DEBUG_LEVEL=4, SmsMode=SMS_MODE, ReceiveMode=RECEIVE_MODE,
+                                                       Schedule=MODEM_SCHEDULE, ReliableTypes=RELIABLE_TYPES,
+                                                       MaxTextMessagesPerMinute=MAX_TEXT_MESSAGES_PER_MINUTE, MaxTextMessagesPerDay=MAX_TEXT_MESSAGES_PER_DAY,
+                                                       MetricsRegistry=Metrics, BulkDecodeWorkers=BULK_DECODE_WORKERS, CollapseBacklog=COLLAPSE_BACKLOG)
+        Router = FleetRouter(DEBUG_LEVEL=4)
+        for Entry in Fleet:
+            Vehicle = TextMessagingConnection.AddRemote(Entry["PhoneNumbers"])
+            Router.AddVehicle(Vehicle, Entry.get("SystemId"), Entry.get("GcsSystemId"), Entry.get("GcsPort", GCS_PORT))
+            StateCaches[Vehicle] = VehicleStateCache()
+            Syncs[Vehicle] = StateSync(lambda Payload, Vehicle=Vehicle: TextMessagingConnection.SubmitPayload(Payload, Destination=Vehicle),
+                                       Authoritative=False, SyncedCallback=StateCaches[Vehicle].LoadSync, DEBUG_LEVEL=4)
+        TextMessagingConnection.SetPayloadHandler(SYNC_MARKER, lambda Vehicle, Payload: Syncs[Vehicle].HandlePayload(Payload) if Vehicle in Syncs else None)
+        SyncStarted = set()
+        if JOURNAL_PATH!=None:
+            TextMessagingConnection.OpenJournal(SendJournal(JOURNAL_PATH, MetricsRegistry=Metrics))  #resends GCS commands a crash left unsent
+        Recorder = None
+        if RECORD_PATH!=None:
+            Recorder = TelemetryRecorder(RECORD_PATH)
+            Recorder.Start()
+            TextMessagingConnection.SetReceiveObserver(lambda Sender, Payload, ArrivalTime: Recorder.RecordTextMessage(Sender, Payload, ArrivalTime))
+
+        GCSconnections = {}  #GCS port -> LocalGCScommunication
+        for Index, GcsPort in enumerate(Router.GetGcsPorts()):
+            GCSconnections[GcsPort] = LocalGCScommunication(GCSport=GcsPort, debug_level=4, LocalPort=14555+Index, MetricsRegistry=Metrics)
+            GCSconnections[GcsPort].Connect()
+
+            #threads rather than processes, so they share the modem lock and the sender thread
+            GCSListenerThread = threading.Thread(target=GCSListener, args=(GcsPort, GCSconnections[GcsPort]))
+            GCSListenerThread.daemon = True
+            GCSListenerThread.start()
+        HeartbeatFakerThread = threading.Thread(target=HeartbeatRepeater)
+        HeartbeatFakerThread.daemon = True
+        HeartbeatFakerThread.start()
+        StartMetricsExport()
     except Exception, error:
         print "Exception during Groundstation comms initialization: ", str(error)
         quit()
@@ -102,12 +196,23 @@ def RunAsGroundStation():
     print "Launching Telemetry Loop"
     while 1:
         try:
-            ListOfIncomingMavlinkMessages = TextMessagingConnection.GetTextMessageTelemetry(blocking=False)
-            for message in ListOfIncomingMavlinkMessages:
-                LocalGCSconnection.SendMavlinkMessageToGCS(message)
-                if message.get_type()=="HEARTBEAT":
-                    LastIncomingHeartbeat = message
-            time.sleep(0.5)  #sleep to avoid hammering the GSM network
+            ListOfIncomingMavlinkMessages = TextMessagingConnection.WaitForTextMessageTelemetry(timeout=0.5, WithSender=True)  #in POLL mode, wait to avoid hammering the GSM network
+            FramesToGCS = {}  #GCS port -> frames, sent as a batch once the whole burst is decoded
+            for Vehicle, message in ListOfIncomingMavlinkMessages or []:
+                Frame = Router.ToGcs(Vehicle, message)
+                if Frame==None:
+                    continue   #not one of the fleet
+                FramesToGCS.setdefault(Router.GetVehicle(Vehicle).GcsPort, []).append(Frame)
+                StateCaches[Vehicle].Record(message, Frame)
+                if Recorder!=None:
+                    Recorder.Record(Frame)
+                Syncs[Vehicle].RecordMavlink(message)
+                if SYNC_STATE and message.get_type()=="HEARTBEAT" and Vehicle not in SyncStarted:
+                    SyncStarted.add(Vehicle)
+                    Syncs[Vehicle].Start(TABLE_PARAMS)
+                    Syncs[Vehicle].Start(TABLE_MISSION)
+            for GcsPort, Frames in FramesToGCS.items():
+                GCSconnections[GcsPort].SendBuffersToGCS(Frames)
         except Exception, error:
             print "Exception Receiving Telemetry: ", str(error)
             #pass
@@ -122,55 +227,15 @@ def RunAsGroundStation():
 def RunAsVehicle():
 
     def GroundListener():
-        LastMailboxCheck = time.time()
         while 1:
-            if (time.time() - LastMailboxCheck) > SECONDS_BETWEEN_MAILBOX_CHECKS:
-                CommandMessageFromGround = TextMessagingConnection.GetTextMessageTelemetry()
-                if CommandMessageFromGround!=None:
-                    AutopilotConnection.write(CommandMessageFromGround.get_msgbuf())
-                LastMailboxCheck=time.time()
-
-
-    def AutopilotIncomingMessageHandler(MavlinkMessage):
-        try:
-            global MessageQueue
-            global MessageQueueLock
-            if MavlinkMessage==None:
-                return
-            if MavlinkMessage.get_type()=="BAD_DATA":
-                return
-            print "Received:", MavlinkMessage.get_type(), "| Current MessageQueue length:", len(MessageQueue)
-
-            if "ACK" in MavlinkMessage.get_type():
-                #critical message, block until added to outgoing queue
-                print "Critical outgoing message, blocking.."
-                MessageQueueLock.acquire(True)
-            elif MessageQueueLock.acquire(False)==False:
-                print "MessageQueue was LOCKED, returning.."
-                return #another callback is processing a msg from autopilot.  Drop this message
-            else:
-                print "MessageQueue was UNLOCKED. processing msg.."
-
-            MessageQueue.append(MavlinkMessage)
-            #print "MessageQueue len AFTER:", len(MessageQueue)
-            if len(TextMessagingConnection.ConvertMavlinkToTextMessage(MessageQueue))>160:
-                print "MessageQueue Over 160, sending!"
-                MessageQueue.pop()
-                #TODO:  This should probably be a thread
-                block=False
-                for msg in MessageQueue:
-                    #check for critical msgs
-                    if "ACK" in msg.get_type():
-                        block=True
-                        break
-                TextMessagingConnection.SendTextMessageTelemetry(ListOfMavlinkMessages=MessageQueue,blocking=block)
-                MessageQueue=[]
-                MessageQueue.append(MavlinkMessage)
-            MessageQueueLock.release()
-        except Exception, e:
-            print "Exception in Pixhawk callback", str(e)
-            if MessageQueueLock.locked():
-                MessageQueueLock.release()
+            ListOfCommandsFromGround = TextMessagingConnection.WaitForTextMessageTelemetry(timeout=SECONDS_BETWEEN_MAILBOX_CHECKS)
+            if ListOfCommandsFromGround:
+                for CommandMessageFromGround in ListOfCommandsFromGround:
+                    TelemetrySender.HandleGroundCommand(CommandMessageFromGround)
+                    #frames were rebuilt with fresh sequence numbers and checksums on receipt
+                    vehicle._master.write(CommandMessageFromGround.get_msgbuf())
+            if SYNC_STATE:
+                StateSyncer.Poll()   #announces parameter and mission changes to the ground station
 
 
     try:
@@ -199,15 +264,33 @@ def RunAsVehicle():
 
         print "DroneKit init:  ", vehicle
 
-        TextMessagingConnection = TextMessageTelemetry(GROUNDSTATION_PHONE_NUMBER, VEHICLE_MODEM_PATH, GROUNDSTATION_MODEM_BAUD, DEBUG_LEVEL=4)
-        TextMessagingConnection.PurgeIncomingTextMessages()
+        TextMessagingConnection = TextMessageTelemetry(GROUNDSTATION_PHONE_NUMBER, VEHICLE_MODEM_PATH, GROUNDSTATION_MODEM_BAUD, DEBUG_LEVEL=4, SmsMode=SMS_MODE, ReceiveMode=RECEIVE_MODE,
+                                                       Schedule=MODEM_SCHEDULE, ReliableTypes=RELIABLE_TYPES,
+                                                       MaxTextMessagesPerMinute=MAX_TEXT_MESSAGES_PER_MINUTE, MaxTextMessagesPerDay=MAX_TEXT_MESSAGES_PER_DAY,
+                                                       MetricsRegistry=Metrics)
         print "Text Messaging init: ", TextMessagingConnection
 
+        StateSyncer = StateSync(TextMessagingConnection.SubmitPayload, Authoritative=True, DEBUG_LEVEL=4)
+        TextMessagingConnection.SetPayloadHandler(SYNC_MARKER, lambda Sender, Payload: StateSyncer.HandlePayload(Payload))
+        #queues the autopilot's messages and fills text messages from them
+        TelemetrySender = VehicleSender(TextMessagingConnection, StateSyncer=StateSyncer if SYNC_STATE else None,
+                                        MaxSecondsBetweenTextMessages=MAX_SECONDS_BETWEEN_TEXT_MESSAGES, SyncedReadSeconds=SYNCED_READ_SECONDS)
+        if JOURNAL_PATH!=None:
+            Journal = SendJournal(JOURNAL_PATH, MetricsRegistry=Metrics)
+            TextMessagingConnection.OpenJournal(Journal)  #resends the acks and STATUSTEXT a crash left unsent
+            TelemetrySender.SetJournal(Journal)
+
         time.sleep(3)
-        vehicle.set_mavlink_callback(AutopilotIncomingMessageHandler)
+        vehicle.set_mavlink_callback(TelemetrySender.HandleAutopilotMessage)
+        if SYNC_STATE:
+            #fill the sync tables; the callback keeps these from being texted
+            vehicle._master.param_fetch_all()
+            vehicle.commands.download()
         
-        GroundCommandListenerProcess = multiprocessing.Process(target=GroundListener)
-        GroundCommandListenerProcess.start()
+        GroundCommandListenerThread = threading.Thread(target=GroundListener)
+        GroundCommandListenerThread.daemon = True
+        GroundCommandListenerThread.start()
+        StartMetricsExport()
 
 
     except Exception, error:
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+# CodecBenchmark.py
+# Summary:  Compares how many mavlink messages fit in one text message for each payload format,
+# replaying recorded telemetry logs (.tlog) through SMSPacker
+# ChamBana03@gmail.com
+#
+# Usage:  python benchmarks/CodecBenchmark.py flight1.tlog [flight2.tlog ...]
+#
+# SMSPacker packs every message in log order, so this measures the formats alone.  The vehicle
+# instead coalesces and rate limits telemetry and picks messages by value (CoalescingQueue,
+# PayloadSelector); benchmarks/EndToEndBenchmark.py measures that.  chars/msg is the Base64
+# payload length per message sent.  A single message too big for a text message on its own is
+# counted as oversized and left out of the other columns.
+
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import base64
+import time
+from dronekit_texting import PayloadCodec
+from dronekit_texting.SMSPacker import SMSPacker
+from dronekit_texting.TelemetryRecorder import LoadTelemetryLog
+from dronekit_texting.TextMessageTelemetry import MAX_TEXT_MESSAGE_LENGTH
+
+PAYLOAD_FORMATS = [
+    ("lzma+hex (original)", PayloadCodec.FORMAT_LZMA_HEX),
+    ("deflate binary", PayloadCodec.FORMAT_DEFLATE),
+    ("deflate + dictionary", PayloadCodec.FORMAT_DEFLATE_DICT),
+    ("compact + dictionary", PayloadCodec.FORMAT_COMPACT_DICT),
+]
+
+
+def RunBenchmark(ListOfMavlinkMessages, PayloadFormat):
+    ######################################################################################
+    #
+    #  Summary:  Packs the messages into text messages and returns (NumberOfTextMessages,
+    #  NumberOfMavlinkMessages, NumberOfCharacters, NumberOfOversized, SecondsSpentEncoding),
+    #  the oversized payloads left out of the first three
+    #
+    ######################################################################################
+    def Encode(Batch):
+        return base64.b64encode(PayloadCodec.EncodePayload(Batch, PayloadFormat))
+
+    Packer = SMSPacker(Encode, MaxLength=MAX_TEXT_MESSAGE_LENGTH)
+    ListOfTextMessages = []
+    starttime = time.time()
+    for message in ListOfMavlinkMessages:
+        FullTextMessage = Packer.Append(message)
+        if FullTextMessage!=None:
+            ListOfTextMessages.append(FullTextMessage)
+    while 1:
+        FullTextMessage = Packer.Flush()
+        if FullTextMessage==None:
+            break
+        ListOfTextMessages.append(FullTextMessage)
+    Seconds = time.time()-starttime
+
+    Sent = [(Batch, Payload) for Batch, Payload in ListOfTextMessages if len(Payload)<=MAX_TEXT_MESSAGE_LENGTH]
+    return (len(Sent), sum([len(Batch) for Batch, Payload in Sent]), sum([len(Payload) for Batch, Payload in Sent]),
+            len(ListOfTextMessages) - len(Sent), Seconds)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "Usage: CodecBenchmark.py flight1.tlog [flight2.tlog ...]"
+        sys.exit(1)
+
+    ListOfMavlinkMessages = []
+    for Path in sys.argv[1:]:
+        ListOfMavlinkMessages += LoadTelemetryLog(Path)
+    print "Loaded", len(ListOfMavlinkMessages), "mavlink messages from", len(sys.argv)-1, "log(s)"
+    print
+
+    print "%-22s %10s %10s %12s %10s %12s" % ("format", "SMS", "msgs/SMS", "chars/msg", "oversized", "encode (s)")
+    for Name, PayloadFormat in PAYLOAD_FORMATS:
+        NumberOfTextMessages, NumberOfMavlinkMessages, NumberOfCharacters, NumberOfOversized, Seconds = \
+            RunBenchmark(ListOfMavlinkMessages, PayloadFormat)
+        if NumberOfTextMessages==0 or NumberOfMavlinkMessages==0:
+            print "%-22s %10d %10s %12s %10d %12.2f" % (Name, 0, "-", "-", NumberOfOversized, Seconds)
+            continue
+        print "%-22s %10d %10.2f %12.2f %10d %12.2f" % (Name, NumberOfTextMessages,
+                                                        float(NumberOfMavlinkMessages)/NumberOfTextMessages,
+                                                        float(NumberOfCharacters)/NumberOfMavlinkMessages,
+                                                        NumberOfOversized, Seconds)
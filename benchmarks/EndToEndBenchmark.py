@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+# EndToEndBenchmark.py
+# Summary:  Replays a telemetry log from the vehicle to a dummy GCS over fake modems and a simulated
+# SMS network, and reports text messages per minute, messages per text message, latency and CPU
+# ChamBana03@gmail.com
+#
+# Usage:  python benchmarks/EndToEndBenchmark.py [options] flight1.tlog [flight2.tlog ...]
+#   --speed X       replay X times faster than the log was recorded (default 1).  Telemetry rates
+#                   and send timeouts run on the wall clock, so a faster replay sends what a
+#                   flight 1/X as long would.
+#   --latency S     network latency, --jitter S on top of it (default 5, 2)
+#   --loss P        fraction of text messages lost (default 0)
+#   --submit S      seconds AT+CMGS takes (default 1)
+#   --inbox N       text messages a modem stores (default 30)
+#   --mode M        PDU or TEXT (default PDU), --receive NOTIFY or POLL (default NOTIFY)
+#   --drain S       seconds to wait for the last text messages after the replay (default 120)
+#   --seed N        makes the network's losses and delays repeatable
+#   --journal PATH  journal the vehicle's critical sends in PATH (see SendJournal)
+#
+# The vehicle side is VehicleSender, as LaunchTelemetry.py runs it, fed the log's messages at
+# their recorded times; the ground side is LaunchTelemetry.py's telemetry loop, forwarding to a
+# UDP socket standing in for the GCS.  Both TextMessageTelemetry instances talk to FakeModems
+# (SmsNetworkSimulator.py) through their real ModemEngines, so everything but the radio is
+# exercised.  A message's latency runs from the last time the vehicle saw that exact message
+# to the GCS receiving it; telemetry the vehicle coalesced away never reaches the GCS and isn't
+# counted.  CPU is per thread, so time spent waiting on the modem or network isn't counted.
+
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import resource
+import socket
+import threading
+import time
+from pymavlink import mavlinkv10 as mavlink
+from dronekit_texting import MavlinkFraming
+from dronekit_texting.TextMessageTelemetry import LocalGCScommunication, TextMessageTelemetry
+from dronekit_texting.Reliability import DEFAULT_RELIABLE_TYPES
+from dronekit_texting.SendJournal import SendJournal
+from dronekit_texting.TelemetryRecorder import LoadTelemetryLog
+from dronekit_texting.VehicleSender import VehicleSender
+from SmsNetworkSimulator import SmsNetwork, FakeModem
+
+VEHICLE_PHONE_NUMBER = "5550000001"
+GROUNDSTATION_PHONE_NUMBER = "5550000002"
+GCS_PORT = 14650
+RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", 1)   #Linux's value; Python 2's resource module lacks it
+
+DEFAULT_OPTIONS = {"--speed": 1.0, "--latency": 5.0, "--jitter": 2.0, "--loss": 0.0, "--submit": 1.0, "--inbox": 30,
+                   "--mode": "PDU", "--receive": "NOTIFY", "--drain": 120.0, "--seed": None, "--journal": None}
+
+
+def GetThreadCpuSeconds():
+    #CPU time of the calling thread, or of the whole process where per-thread times aren't available
+    try:
+        Usage = resource.getrusage(RUSAGE_THREAD)
+    except (ValueError, resource.error):
+        Usage = resource.getrusage(resource.RUSAGE_SELF)
+    return Usage.ru_utime + Usage.ru_stime
+
+
+def GetMessageKey(Frame):
+    #what identifies a message across the link:  the frame is rebuilt on the ground with a new header
+    Sequence, SystemId, ComponentId, MessageId, Payload = MavlinkFraming.SplitFrame(str(Frame))
+    return MessageId, Payload
+
+
+def GetPercentile(SortedValues, Percent):
+    if len(SortedValues)==0:
+        return float("nan")
+    return SortedValues[min(len(SortedValues)-1, int(len(SortedValues)*Percent/100.0))]
+
+
+class EndToEndBenchmark(object):
+    def __init__(self, Options):
+        ######################################################################################
+        #
+        #  Summary:  Sets up the network, a fake modem and TextMessageTelemetry per side, and
+        #  the dummy GCS.  Options as DEFAULT_OPTIONS.
+        #
+        ######################################################################################
+        self._Options = Options
+        self._Network = SmsNetwork(Latency=Options["--latency"], Jitter=Options["--jitter"], LossRate=Options["--loss"],
+                                   SubmitSeconds=Options["--submit"], Seed=Options["--seed"])
+        self._VehicleModem = FakeModem(self._Network, VEHICLE_PHONE_NUMBER, InboxCapacity=int(Options["--inbox"]))
+        self._GroundModem = FakeModem(self._Network, GROUNDSTATION_PHONE_NUMBER, InboxCapacity=int(Options["--inbox"]))
+        self._Running = True
+        self._Lock = threading.Lock()
+        self._Cpu = {"vehicle: queue, select, encode": 0.0, "vehicle: receive acks": 0.0,
+                     "ground: receive, decode": 0.0, "ground: forward to GCS": 0.0}
+        self._LastSeen = {}           #message key -> last time the vehicle handler saw it
+        self._Latencies = []
+        self._ReplayedCount = 0
+        self._DeliveredCount = 0
+
+        self._Vehicle = TextMessageTelemetry(GROUNDSTATION_PHONE_NUMBER, self._VehicleModem.GetPath(), DEBUG_LEVEL=1,
+                                             SmsMode=Options["--mode"], ReceiveMode=Options["--receive"], ReliableTypes=DEFAULT_RELIABLE_TYPES)
+        self._Ground = TextMessageTelemetry(VEHICLE_PHONE_NUMBER, self._GroundModem.GetPath(), DEBUG_LEVEL=1,
+                                            SmsMode=Options["--mode"], ReceiveMode=Options["--receive"], ReliableTypes=DEFAULT_RELIABLE_TYPES)
+        self._Sender = VehicleSender(self._Vehicle)   #LaunchTelemetry.py's send path, without the state sync
+        if Options["--journal"]!=None:
+            Journal = SendJournal(Options["--journal"])
+            self._Vehicle.OpenJournal(Journal)
+            self._Sender.SetJournal(Journal)
+
+        self._GcsSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._GcsSocket.bind(("127.0.0.1", GCS_PORT))
+        self._GcsSocket.settimeout(0.5)
+        self._GcsConnection = LocalGCScommunication(GCSport=GCS_PORT, debug_level=1, LocalPort=GCS_PORT+5)
+        self._GcsConnection.Connect()
+
+    def Run(self, ListOfMavlinkMessages):
+        ######################################################################################
+        #
+        #  Summary:  Replays the messages, waits for the text messages still on their way, and
+        #  returns the report as a dict
+        #
+        ######################################################################################
+        Threads = [threading.Thread(target=Loop) for Loop in (self._GroundLoop, self._VehicleReceiveLoop, self._GcsLoop)]
+        for Thread in Threads:
+            Thread.daemon = True
+            Thread.start()
+
+        StartTime = time.time()
+        self._Replay(ListOfMavlinkMessages)
+        ReplaySeconds = time.time() - StartTime
+        self._Drain()
+        self._Running = False
+        for Thread in Threads:
+            Thread.join(5)
+        return self._GetReport(ReplaySeconds, time.time() - StartTime)
+
+    def _Replay(self, ListOfMavlinkMessages):
+        if len(ListOfMavlinkMessages)==0:
+            return
+        LogStart = getattr(ListOfMavlinkMessages[0], "_timestamp", 0)
+        StartTime = time.time()
+        for message in ListOfMavlinkMessages:
+            Due = StartTime + (getattr(message, "_timestamp", LogStart) - LogStart)/self._Options["--speed"]
+            if Due > time.time():
+                time.sleep(Due - time.time())
+            self._LastSeen[GetMessageKey(message.get_msgbuf())] = time.time()
+            self._ReplayedCount += 1
+            Started = GetThreadCpuSeconds()
+            self._Sender.HandleAutopilotMessage(message)
+            self._AddCpu("vehicle: queue, select, encode", GetThreadCpuSeconds() - Started)
+
+    def _VehicleReceiveLoop(self):
+        #the vehicle reads its inbox for the ground station's acks and delay reports
+        while self._Running:
+            Started = GetThreadCpuSeconds()
+            self._Vehicle.WaitForTextMessageTelemetry(timeout=1)
+            self._AddCpu("vehicle: receive acks", GetThreadCpuSeconds() - Started)
+
+    def _GroundLoop(self):
+        while self._Running:
+            Started = GetThreadCpuSeconds()
+            ListOfMavlinkMessages = self._Ground.WaitForTextMessageTelemetry(timeout=0.5) or []
+            Decoded = GetThreadCpuSeconds()
+            self._AddCpu("ground: receive, decode", Decoded - Started)
+            if len(ListOfMavlinkMessages) > 0:
+                self._GcsConnection.SendBuffersToGCS([message.get_msgbuf() for message in ListOfMavlinkMessages])
+                self._AddCpu("ground: forward to GCS", GetThreadCpuSeconds() - Decoded)
+
+    def _GcsLoop(self):
+        #the dummy GCS:  times every frame it receives against when the vehicle saw it
+        Parser = mavlink.MAVLink(None)
+        while self._Running:
+            try:
+                Datagram = self._GcsSocket.recv(65535)
+            except socket.timeout:
+                continue
+            now = time.time()
+            for message in Parser.parse_buffer(Datagram) or []:
+                SeenTime = self._LastSeen.get(GetMessageKey(message.get_msgbuf()))
+                self._Lock.acquire()
+                self._DeliveredCount += 1
+                if SeenTime!=None:
+                    self._Latencies.append(now - SeenTime)
+                self._Lock.release()
+
+    def _Drain(self):
+        #waits until nothing has gone out or arrived for a full network delay, or --drain seconds
+        Deadline = time.time() + self._Options["--drain"]
+        Quiet = self._Options["--latency"] + self._Options["--jitter"] + self._Options["--submit"] + 5
+        LastChange = time.time()
+        LastState = None
+        while time.time() < Deadline:
+            Stats = self._Network.GetStats()
+            State = (Stats["Submitted"], Stats["Delivered"], self._DeliveredCount)
+            if State!=LastState:
+                LastState = State
+                LastChange = time.time()
+            elif Stats["InTransit"]==0 and self._Vehicle.GetQueuedSendCount()==0 and time.time() - LastChange > Quiet:
+                return
+            time.sleep(1)
+
+    def _AddCpu(self, Stage, Seconds):
+        self._Lock.acquire()
+        self._Cpu[Stage] += Seconds
+        self._Lock.release()
+
+    def _GetReport(self, ReplaySeconds, TotalSeconds):
+        Stats = self._Network.GetStats()
+        Latencies = sorted(self._Latencies)
+        VehicleTextMessages = Stats["SubmittedBy"].get(VEHICLE_PHONE_NUMBER, 0)
+        return {
+            "ReplaySeconds": ReplaySeconds,
+            "TotalSeconds": TotalSeconds,
+            "Replayed": self._ReplayedCount,
+            "Delivered": self._DeliveredCount,
+            "VehicleTextMessages": VehicleTextMessages,
+            "GroundTextMessages": Stats["SubmittedBy"].get(GROUNDSTATION_PHONE_NUMBER, 0),
+            "TextMessagesPerMinute": VehicleTextMessages*60.0/max(ReplaySeconds, 1e-9),
+            "MessagesPerTextMessage": float(self._DeliveredCount)/VehicleTextMessages if VehicleTextMessages else 0.0,
+            "Latency": [(Percent, GetPercentile(Latencies, Percent)) for Percent in (50, 90, 99, 100)],
+            "Network": Stats,
+            "Cpu": sorted(self._Cpu.items()),
+            "ProcessCpu": sum(os.times()[:2]),
+        }
+
+
+def PrintReport(Report):
+    Network = Report["Network"]
+    print "replayed %d messages in %.1f s, drained after %.1f s" % (Report["Replayed"], Report["ReplaySeconds"], Report["TotalSeconds"])
+    print "text messages:  vehicle %d (%.2f/min), ground %d" % (Report["VehicleTextMessages"], Report["TextMessagesPerMinute"], Report["GroundTextMessages"])
+    print "network:  delivered %d, lost %d, deferred %d (inbox full), still in transit %d" % (Network["Delivered"], Network["Lost"],
+                                                                                             Network["Deferred"], Network["InTransit"])
+    print "GCS received %d messages, %.2f per vehicle text message" % (Report["Delivered"], Report["MessagesPerTextMessage"])
+    print "latency (s):  " + "  ".join(["p%d %.1f" % (Percent, Seconds) for Percent, Seconds in Report["Latency"][:-1]]) + \
+        "  max %.1f" % Report["Latency"][-1][1]
+    print "CPU (s):"
+    for Stage, Seconds in Report["Cpu"]:
+        print "    %-34s %8.3f" % (Stage, Seconds)
+    print "    %-34s %8.3f" % ("whole process, simulator included", Report["ProcessCpu"])
+
+
+if __name__ == "__main__":
+    Arguments = sys.argv[1:]
+    Options = dict(DEFAULT_OPTIONS)
+    for Option in DEFAULT_OPTIONS:
+        if Option in Arguments:
+            Value = Arguments[Arguments.index(Option)+1]
+            if Option in ("--mode", "--receive"):
+                Options[Option] = Value.upper()
+            elif Option=="--journal":
+                Options[Option] = Value
+            else:
+                Options[Option] = float(Value)
+            del Arguments[Arguments.index(Option):Arguments.index(Option)+2]
+    if len(Arguments) < 1:
+        print "Usage: EndToEndBenchmark.py [--speed X] [--latency S] [--jitter S] [--loss P] [--submit S] [--inbox N]"
+        print "                            [--mode PDU|TEXT] [--receive NOTIFY|POLL] [--drain S] [--seed N] [--journal PATH]"
+        print "                            flight1.tlog ..."
+        sys.exit(1)
+
+    ListOfMavlinkMessages = []
+    for Path in Arguments:
+        ListOfMavlinkMessages += LoadTelemetryLog(Path)
+    print "Loaded", len(ListOfMavlinkMessages), "mavlink messages from", len(Arguments), "log(s)"
+    PrintReport(EndToEndBenchmark(Options).Run(ListOfMavlinkMessages))
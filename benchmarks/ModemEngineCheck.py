@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# ModemEngineCheck.py
+# Summary:  Runs ModemEngine against FakeModems (SmsNetworkSimulator.py) and checks the parts of
+# the AT conversation a real modem makes hard to reproduce
+# ChamBana03@gmail.com
+#
+# Usage:  python benchmarks/ModemEngineCheck.py
+#
+# Checks that:
+#   -- AT+CMGS waits for the '> ' prompt, writes the text after it and returns the +CMGS answer
+#   -- a +CMTI the modem sends unasked reaches NotificationCallback, and the message it points
+#      at can be read
+#   -- after a command times out, the modem's late answer to it is swallowed by the resync and
+#      the next command gets its own response
+# Prints PASS or FAIL for each and exits with 1 if any failed.
+
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import threading
+import time
+from dronekit_texting import ModemEngine
+from SmsNetworkSimulator import SmsNetwork, FakeModem
+
+VEHICLE_NUMBER = "+15550000001"
+GROUND_NUMBER = "+15550000002"
+SLOW_SUBMIT_SECONDS = 2.0   #how long the network takes over the AT+CMGS that times out
+SLOW_SUBMIT_TIMEOUT = 0.5
+
+
+class NotificationCollector(object):
+    def __init__(self):
+        self.Lines = []
+        self.Arrived = threading.Event()
+
+    def __call__(self, Line):
+        self.Lines.append(Line)
+        self.Arrived.set()
+
+
+def CheckPrompt(Modem):
+    #AT+CMGS must see the prompt before its text goes out
+    Lines = Modem.Execute('AT+CMGS="{0}"'.format(GROUND_NUMBER), Priority=ModemEngine.PRIORITY_SEND,
+                          Timeout=5, Prompt='> ', Data="prompt check" + ModemEngine.CTRL_Z)
+    return Lines[0].startswith("+CMGS:") and Lines[-1]=="OK", Lines
+
+
+def CheckNotification(Modem, Notifications):
+    #the text sent by CheckPrompt is announced with +CMTI and can be read from the slot it names
+    if not Notifications.Arrived.wait(10):
+        return False, "no +CMTI"
+    Line = Notifications.Lines[0]
+    if not Line.startswith('+CMTI: "SM",'):
+        return False, Line
+    Lines = Modem.Execute("AT+CMGR=" + Line.split(",")[1])
+    return Lines[0].startswith("+CMGR:") and Lines[1]=="prompt check", [Line] + Lines
+
+
+def CheckTimeoutResync(Network, Modem):
+    #the modem answers the AT+CMGS after its timeout; the AT+CPMS? queued behind it mustn't get that answer
+    Network.SubmitSeconds = SLOW_SUBMIT_SECONDS
+    try:
+        Send = Modem.Submit('AT+CMGS="{0}"'.format(GROUND_NUMBER), Priority=ModemEngine.PRIORITY_SEND,
+                            Timeout=SLOW_SUBMIT_TIMEOUT, Prompt='> ', Data="timeout check" + ModemEngine.CTRL_Z)
+        Next = Modem.Submit("AT+CPMS?")
+        try:
+            Send.Result()
+            return False, "AT+CMGS didn't time out"
+        except ModemEngine.ModemTimeout:
+            pass
+        Lines = Next.Result(timeout=SLOW_SUBMIT_SECONDS + ModemEngine.RESYNC_TIMEOUT)
+    finally:
+        Network.SubmitSeconds = 0
+    return Lines[0].startswith("+CPMS:") and Lines[-1]=="OK", Lines
+
+
+if __name__ == "__main__":
+    Network = SmsNetwork(Latency=0.2, Jitter=0, SubmitSeconds=0)
+    VehicleModem = FakeModem(Network, VEHICLE_NUMBER)
+    GroundModem = FakeModem(Network, GROUND_NUMBER)
+    Notifications = NotificationCollector()
+    Vehicle = ModemEngine.ModemEngine(VehicleModem.GetPath())
+    Ground = ModemEngine.ModemEngine(GroundModem.GetPath(), NotificationCallback=Notifications)
+    Vehicle.Connect()
+    Ground.Connect()
+    for Modem in (Vehicle, Ground):
+        Modem.Execute("AT+CMGF=1")
+    Ground.Execute("AT+CNMI=2,1,0,0,0")
+
+    Failed = 0
+    for Name, Check in (("CMGS prompt", lambda: CheckPrompt(Vehicle)),
+                        ("+CMTI dispatch", lambda: CheckNotification(Ground, Notifications)),
+                        ("timeout and resync", lambda: CheckTimeoutResync(Network, Vehicle))):
+        try:
+            Passed, Detail = Check()
+        except ModemEngine.ModemError, e:
+            Passed, Detail = False, "%s: %s" % (e.__class__.__name__, e)
+        print "%-20s %s  %s" % (Name, "PASS" if Passed else "FAIL", Detail)
+        if not Passed:
+            Failed += 1
+
+    for Modem in (Vehicle, Ground):
+        Modem.Close()
+    for Modem in (VehicleModem, GroundModem):
+        Modem.Close()
+    Network.Close()
+    time.sleep(0.5)   #lets their threads see they're closed, rather than die at interpreter shutdown
+    sys.exit(1 if Failed else 0)
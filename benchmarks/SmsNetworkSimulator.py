@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+
+# SmsNetworkSimulator.py
+# Summary:  Fake GSM modems on ptys and a simulated SMS network between them, so the telemetry can
+# run without modems or a SIM plan
+# ChamBana03@gmail.com
+#
+# Usage:  python benchmarks/SmsNetworkSimulator.py [--latency S] [--jitter S] [--loss P] 7031234567 7037654321 ...
+#
+# Prints a serial port per phone number; point LaunchTelemetry.py's modem paths at them.
+# EndToEndBenchmark.py builds the same thing in-process.
+#
+# Each FakeModem answers the AT commands ModemEngine and TextMessageTelemetry use (AT+CMGF,
+# AT+CNMI, AT+CPMS, AT+CMGS, AT+CMGL, AT+CMGR, AT+CMGD), in text and PDU mode, on the master
+# side of a pty; the slave side is what pyserial opens.  Text messages it sends go to the
+# SmsNetwork, which delivers them to the modem registered for the destination number:
+#   -- after SubmitSeconds, how long AT+CMGS takes, i.e. the network accepting the message
+#   -- after Latency plus up to Jitter seconds more, drawn per text message, so jitter larger
+#      than the gap between text messages reorders them
+#   -- or never, for a LossRate fraction of them
+#   -- and only into a free slot of the destination's InboxCapacity:  a full inbox holds the
+#      text message on the network, retried every RETRY_SECONDS, as a real network does
+# Runs on Linux and Mac (pty).
+
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import errno
+import heapq
+import pty
+import random
+import re
+import threading
+import time
+import tty
+from dronekit_texting import SmsPdu
+
+RETRY_SECONDS = 5.0
+DEFAULT_INBOX_CAPACITY = 30   #a SIM's message storage
+
+CTRL_Z = chr(26)
+ESCAPE = chr(27)
+
+CMGS_TEXT_REGEX = re.compile(r'^AT\+CMGS="([^"]+)"')
+
+
+class SmsNetwork(object):
+    def __init__(self, Latency=5.0, Jitter=2.0, LossRate=0.0, SubmitSeconds=1.0, Seed=None):
+        ######################################################################################
+        #
+        #  Summary:  Latency, Jitter and SubmitSeconds in seconds, LossRate a fraction of the
+        #  text messages.  Seed makes the losses and delays repeatable.
+        #
+        ######################################################################################
+        self.Latency = Latency
+        self.Jitter = Jitter
+        self.LossRate = LossRate
+        self.SubmitSeconds = SubmitSeconds
+        self._Random = random.Random(Seed)
+        self._Modems = {}             #phone number -> FakeModem
+        self._InTransit = []          #heap of (delivery time, count, sender, destination, data coding, user data, submit time)
+        self._Count = 0
+        self._Condition = threading.Condition()
+        self._Running = True
+        self._Stats = {"Submitted": 0, "Lost": 0, "Delivered": 0, "Deferred": 0, "Undeliverable": 0}
+        self._SubmittedBy = {}        #sender -> text messages submitted
+        self._Latencies = []          #seconds from AT+CMGS to the inbox, per delivered text message
+        self._Thread = threading.Thread(target=self._DeliveryLoop)
+        self._Thread.daemon = True
+        self._Thread.start()
+
+    def Register(self, PhoneNumber, Modem):
+        self._Modems[_Normalize(PhoneNumber)] = Modem
+
+    def Close(self):
+        self._Condition.acquire()
+        self._Running = False
+        self._Condition.notify()
+        self._Condition.release()
+
+    def GetSubmitSeconds(self):
+        return self.SubmitSeconds
+
+    def Submit(self, Sender, Destination, DataCoding, UserData):
+        ######################################################################################
+        #
+        #  Summary:  Takes a text message a modem sent, once the network has accepted it
+        #
+        ######################################################################################
+        self._Condition.acquire()
+        try:
+            self._Stats["Submitted"] += 1
+            self._SubmittedBy[Sender] = self._SubmittedBy.get(Sender, 0) + 1
+            if self._Random.random() < self.LossRate:
+                self._Stats["Lost"] += 1
+                return
+            now = time.time()
+            self._Count += 1
+            heapq.heappush(self._InTransit, (now + self.Latency + self._Random.uniform(0, self.Jitter), self._Count,
+                                             Sender, Destination, DataCoding, UserData, now))
+            self._Condition.notify()
+        finally:
+            self._Condition.release()
+
+    def GetStats(self):
+        ######################################################################################
+        #
+        #  Summary:  Counts of text messages Submitted, Lost, Delivered, Deferred (inbox full,
+        #  retried) and Undeliverable (unknown number), plus InTransit, SubmittedBy (sender ->
+        #  count) and the sorted Latencies
+        #
+        ######################################################################################
+        self._Condition.acquire()
+        try:
+            Stats = dict(self._Stats)
+            Stats["InTransit"] = len(self._InTransit)
+            Stats["SubmittedBy"] = dict(self._SubmittedBy)
+            Stats["Latencies"] = sorted(self._Latencies)
+            return Stats
+        finally:
+            self._Condition.release()
+
+    def _DeliveryLoop(self):
+        self._Condition.acquire()
+        try:
+            while self._Running:
+                if len(self._InTransit)==0:
+                    self._Condition.wait()
+                    continue
+                Due = self._InTransit[0][0] - time.time()
+                if Due > 0:
+                    self._Condition.wait(Due)
+                    continue
+                DeliveryTime, Count, Sender, Destination, DataCoding, UserData, SubmitTime = heapq.heappop(self._InTransit)
+                Modem = self._Modems.get(_Normalize(Destination))
+                if Modem==None:
+                    self._Stats["Undeliverable"] += 1
+                elif Modem.Store(Sender, DataCoding, UserData):
+                    self._Stats["Delivered"] += 1
+                    self._Latencies.append(time.time() - SubmitTime)
+                else:
+                    self._Stats["Deferred"] += 1
+                    heapq.heappush(self._InTransit, (time.time() + RETRY_SECONDS, Count, Sender, Destination, DataCoding, UserData, SubmitTime))
+        finally:
+            self._Condition.release()
+
+
+class FakeModem(object):
+    def __init__(self, Network, PhoneNumber, InboxCapacity=DEFAULT_INBOX_CAPACITY):
+        ######################################################################################
+        #
+        #  Summary:  A modem with the SIM PhoneNumber on Network.  GetPath() is the serial port
+        #  to hand ModemEngine.
+        #
+        ######################################################################################
+        self._Network = Network
+        self._PhoneNumber = PhoneNumber
+        self._InboxCapacity = InboxCapacity
+        self._Master, self._Slave = pty.openpty()
+        tty.setraw(self._Slave)
+        self._Path = os.ttyname(self._Slave)
+        self._WriteLock = threading.Lock()
+        self._Lock = threading.Lock()   #guards the inbox and settings, also used from the network's thread
+        self._Inbox = {}                #index -> [status, sender, data coding, user data, time received]
+        self._Echo = True
+        self._PduMode = False
+        self._Notify = False
+        self._MessageReference = 0
+        self._Running = True
+        Network.Register(PhoneNumber, self)
+        self._Thread = threading.Thread(target=self._CommandLoop)
+        self._Thread.daemon = True
+        self._Thread.start()
+
+    def GetPath(self):
+        return self._Path
+
+    def Close(self):
+        self._Running = False
+        os.close(self._Slave)
+        os.close(self._Master)
+
+    def Store(self, Sender, DataCoding, UserData):
+        ######################################################################################
+        #
+        #  Summary:  Puts a text message from the network in the lowest free inbox slot and
+        #  announces it with +CMTI if AT+CNMI asked for that.  Returns False if the inbox is full.
+        #
+        ######################################################################################
+        self._Lock.acquire()
+        try:
+            Free = [Index for Index in range(1, self._InboxCapacity+1) if Index not in self._Inbox]
+            if len(Free)==0:
+                return False
+            self._Inbox[Free[0]] = ["REC UNREAD", Sender, DataCoding, UserData, time.time()]
+            Notify = self._Notify
+        finally:
+            self._Lock.release()
+        if Notify:
+            self._Write('\r\n+CMTI: "SM",%d\r\n' % Free[0])
+        return True
+
+    def _Write(self, Data):
+        self._WriteLock.acquire()
+        try:
+            os.write(self._Master, Data)
+        except OSError:
+            pass   #closed
+        finally:
+            self._WriteLock.release()
+
+    def _CommandLoop(self):
+        ######################################################################################
+        #
+        #  Summary:  Reads AT commands off the pty, one per carriage return, and the text or
+        #  PDU after an AT+CMGS prompt, up to CTRL_Z (ESCAPE cancels it)
+        #
+        ######################################################################################
+        Buffer = ""
+        Sending = None   #the AT+CMGS waiting for its text or PDU
+        while self._Running:
+            try:
+                Data = os.read(self._Master, 4096)
+            except OSError, e:
+                if e.errno==errno.EINTR:
+                    continue
+                return   #closed
+            if not Data:
+                return
+            Buffer += Data
+            while 1:
+                if Sending!=None:
+                    if ESCAPE in Buffer:
+                        Buffer = Buffer[Buffer.index(ESCAPE)+1:]
+                        Sending = None
+                        self._Write("\r\nOK\r\n")
+                        continue
+                    if CTRL_Z not in Buffer:
+                        break
+                    Body, Buffer = Buffer.split(CTRL_Z, 1)
+                    self._Send(Sending, Body)
+                    Sending = None
+                    continue
+                if "\r" not in Buffer:
+                    break
+                Line, Buffer = Buffer.split("\r", 1)
+                Line = Line.strip()
+                if not Line:
+                    continue
+                if self._Echo:
+                    self._Write(Line + "\r\n")
+                if Line.upper().startswith("AT+CMGS="):
+                    Sending = Line
+                    self._Write("\r\n> ")
+                else:
+                    self._Write(self._Execute(Line))
+
+    def _Send(self, Command, Body):
+        time.sleep(self._Network.GetSubmitSeconds())   #the network taking the text message
+        try:
+            if self._PduMode:
+                Destination, DataCoding, UserData = SmsPdu.DecodeSubmitPdu(Body)
+            else:
+                Destination, DataCoding, UserData = CMGS_TEXT_REGEX.match(Command).group(1), SmsPdu.DATA_CODING_GSM7, Body.strip()
+        except Exception:
+            self._Write("\r\n+CMS ERROR: 304\r\n")   #invalid PDU mode parameter
+            return
+        self._Network.Submit(self._PhoneNumber, Destination, DataCoding, UserData)
+        self._MessageReference = (self._MessageReference + 1) % 256
+        self._Write("\r\n+CMGS: %d\r\n\r\nOK\r\n" % self._MessageReference)
+
+    def _Execute(self, Line):
+        #returns the response to one AT command, final result code included
+        Command = Line.upper()
+        self._Lock.acquire()
+        try:
+            if Command in ("AT", "AT+CMEE=1") or Command.startswith("AT+CSCS"):
+                return "\r\nOK\r\n"
+            if Command=="ATE0":
+                self._Echo = False
+                return "\r\nOK\r\n"
+            if Command.startswith("AT+CMGF="):
+                self._PduMode = Command.endswith("0")
+                return "\r\nOK\r\n"
+            if Command.startswith("AT+CNMI="):
+                self._Notify = Command.split("=")[1].split(",")[1:2]==["1"]
+                return "\r\nOK\r\n"
+            if Command=="AT+CPMS?":
+                Used = len(self._Inbox)
+                return '\r\n+CPMS: "SM",%d,%d,"SM",%d,%d,"SM",%d,%d\r\n\r\nOK\r\n' % ((Used, self._InboxCapacity)*3)
+            if Command.startswith("AT+CPMS="):
+                return "\r\n+CPMS: %d,%d,%d,%d,%d,%d\r\n\r\nOK\r\n" % ((len(self._Inbox), self._InboxCapacity)*3)
+            if Command.startswith("AT+CMGL"):
+                Unread = Command.split("=")[1] in ('"REC UNREAD"', "0")
+                Response = ""
+                for Index in sorted(self._Inbox):
+                    if not Unread or self._Inbox[Index][0]=="REC UNREAD":
+                        Response += self._FormatStored(Index, "+CMGL: %d," % Index)
+                return Response + "\r\n\r\nOK\r\n"
+            if Command.startswith("AT+CMGR="):
+                Index = int(Command.split("=")[1])
+                if Index not in self._Inbox:
+                    return "\r\n+CMS ERROR: 321\r\n"   #invalid memory index
+                return self._FormatStored(Index, "+CMGR: ") + "\r\n\r\nOK\r\n"
+            if Command.startswith("AT+CMGD="):
+                Arguments = [int(Argument) for Argument in Command.split("=")[1].split(",")]
+                Flag = Arguments[1] if len(Arguments) > 1 else 0
+                for Index in list(self._Inbox):
+                    if (Flag==0 and Index==Arguments[0]) or Flag==4 or (Flag in (1, 2, 3) and self._Inbox[Index][0]!="REC UNREAD"):
+                        del self._Inbox[Index]
+                return "\r\nOK\r\n"
+            return "\r\nERROR\r\n"
+        finally:
+            self._Lock.release()
+
+    def _FormatStored(self, Index, Header):
+        #header and body lines of a stored text message, which is marked read; caller holds the lock
+        Status, Sender, DataCoding, UserData, Received = self._Inbox[Index]
+        self._Inbox[Index][0] = "REC READ"
+        if self._PduMode:
+            Pdu = SmsPdu.EncodeDeliverPdu(Sender, UserData, DataCoding, Received)
+            Stat = 0 if Status=="REC UNREAD" else 1
+            return "\r\n%s%d,,%d\r\n%s" % (Header, Stat, len(Pdu)//2 - 1, Pdu)   #length excludes the SMSC field
+        if DataCoding==SmsPdu.DATA_CODING_8BIT:
+            UserData = UserData.encode("hex").upper()   #what a modem shows for binary in text mode
+        Stamp = time.strftime("%y/%m/%d,%H:%M:%S+00", time.gmtime(Received))
+        return '\r\n%s"%s","%s",,"%s"\r\n%s' % (Header, Status, Sender, Stamp, UserData)
+
+
+def _Normalize(PhoneNumber):
+    #numbers are matched on their last 10 digits, like TextMessageTelemetry's sender matching
+    return "".join([Digit for Digit in PhoneNumber if Digit.isdigit()])[-10:]
+
+
+if __name__ == "__main__":
+    Arguments = sys.argv[1:]
+    Options = {"--latency": 5.0, "--jitter": 2.0, "--loss": 0.0}
+    for Option in Options:
+        if Option in Arguments:
+            Options[Option] = float(Arguments[Arguments.index(Option)+1])
+            del Arguments[Arguments.index(Option):Arguments.index(Option)+2]
+    if len(Arguments) < 2:
+        print "Usage: SmsNetworkSimulator.py [--latency S] [--jitter S] [--loss P] 7031234567 7037654321 ..."
+        sys.exit(1)
+
+    Network = SmsNetwork(Latency=Options["--latency"], Jitter=Options["--jitter"], LossRate=Options["--loss"])
+    Modems = [FakeModem(Network, PhoneNumber) for PhoneNumber in Arguments]
+    for Modem, PhoneNumber in zip(Modems, Arguments):
+        print PhoneNumber, "->", Modem.GetPath()
+    print "Ctrl-C to stop"
+    try:
+        while 1:
+            time.sleep(60)
+            Stats = Network.GetStats()
+            print "submitted", Stats["Submitted"], " delivered", Stats["Delivered"], " lost", Stats["Lost"], \
+                " deferred", Stats["Deferred"], " in transit", Stats["InTransit"]
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,146 @@
+
+# BulkDecoder.py
+# Summary:  Decodes a backlog of received payloads in a pool of worker processes, merges them
+# in send time order and collapses stale telemetry
+# ChamBana03@gmail.com
+#
+# After a gap in coverage the modem can hand over hundreds of stored text messages at once.
+# Decoding is pure Python (re-framing compact messages and mavlink's own parser, both
+# checksumming every frame), about a millisecond per payload on a laptop and several on a
+# Raspberry Pi, so a backlog decoded one payload after another takes its time.
+#
+# The stateless payload formats (see PayloadCodec) don't depend on the payloads before them,
+# so DecodeJob() runs in worker processes, each payload with a parser of its own:  a bad
+# payload can't leave half a frame behind to garble the next.  Compact payloads are re-framed
+# with sequence numbers, which have to run on from payload to payload of a sender, so
+# PrepareJob() inflates them first, counts their messages and reserves that many sequence
+# numbers from the sender's FrameBuilder.  Delta records and payloads with a handler are
+# stateful and stay with the caller.
+#
+# MergeBySendTime() interleaves the senders' payloads by the send time in their envelopes,
+# keeping each sender's own order, so the GCS gets a backlog from a fleet as one time ordered
+# replay.  CollapseStale() then keeps only the newest sample of each telemetry stream, since
+# the GCS only needs where the vehicle is now, not a fast forward through the outage.
+
+import CompressionDictionary
+import MavlinkFraming
+import PayloadCodec
+import RateController
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from pymavlink import mavlinkv10 as mavlink
+
+BULK_DECODE_THRESHOLD = 16   #payloads received at once that make a backlog worth the pool
+
+
+class _DiscardFile(object):
+    #the parser's file, never written to since nothing is sent
+    def write(self, data):
+        return len(data)
+
+
+def CreatePool(Workers, UseProcesses=True):
+    ######################################################################################
+    #
+    #  Summary:  Pool of Workers worker processes, or threads if UseProcesses is False
+    #  (threads share the GIL, so they keep a backlog from garbling the parser but don't
+    #  decode it any faster).  Create it before starting threads of your own, since worker
+    #  processes are forked.
+    #
+    ######################################################################################
+    if UseProcesses:
+        return Pool(Workers)
+    return ThreadPool(Workers)
+
+
+def PrepareJob(Payload, Framing):
+    ######################################################################################
+    #
+    #  Summary:  Returns the job for DecodeJob() to decode the payload (format byte first,
+    #  envelope removed).  A compact payload is inflated here and the sequence numbers of its
+    #  frames taken from Framing, the sender's FrameBuilder.  Raises for a payload that
+    #  can't be decoded.
+    #
+    ######################################################################################
+    if ord(Payload[0])==PayloadCodec.FORMAT_COMPACT_DICT:
+        Buffer = CompressionDictionary.Decompress(Payload[2:], ord(Payload[1]))
+        return (Buffer, Framing.Reserve(MavlinkFraming.CountCompact(Buffer)))
+    return (Payload, None)
+
+
+def DecodeJob(Job):
+    ######################################################################################
+    #
+    #  Summary:  Runs in a worker:  decodes a job from PrepareJob() with a fresh parser and
+    #  returns its list of mavlink messages, or None if it can't be decoded
+    #
+    ######################################################################################
+    Buffer, FirstSequence = Job
+    try:
+        if FirstSequence==None:
+            Buffer = PayloadCodec.DecodePayload(Buffer)
+        else:
+            Buffer = MavlinkFraming.UnpackCompact(Buffer, MavlinkFraming.FrameBuilder(FirstSequence))
+        return mavlink.MAVLink(_DiscardFile()).parse_buffer(Buffer) or []
+    except Exception:
+        return None
+
+
+def MergeBySendTime(ListOfDecoded, now=None):
+    ######################################################################################
+    #
+    #  Summary:  Takes a list of (Sender, Timestamp, ListOfMavlinkMessages), each sender's
+    #  in the order it sent them, and returns one list of (Sender, MavlinkMessage), oldest
+    #  payload first.  Timestamp is the envelope's send time (see RateController), None for
+    #  a payload without one, which then counts as sent with the one before it.  Each
+    #  sender's own order is kept, even if its clock jumped.
+    #
+    ######################################################################################
+    LocalTimestamp = RateController.GetTimestamp(now)
+    Queues = {}   #sender -> [(age in seconds, messages), ...] in the order sent
+    Senders = []
+    for Sender, Timestamp, ListOfMavlinkMessages in ListOfDecoded:
+        if Sender not in Queues:
+            Queues[Sender] = []
+            Senders.append(Sender)
+        if Timestamp!=None:
+            #signed, so a sender whose clock runs a little ahead doesn't look a day old
+            Age = (LocalTimestamp - Timestamp + RateController.TIMESTAMP_MODULUS//2) % RateController.TIMESTAMP_MODULUS \
+                - RateController.TIMESTAMP_MODULUS//2
+        elif len(Queues[Sender]) > 0:
+            Age = Queues[Sender][-1][0]
+        else:
+            Age = 0
+        Queues[Sender].append((Age, ListOfMavlinkMessages))
+
+    Merged = []
+    Heads = dict([(Sender, 0) for Sender in Senders])
+    while len(Heads) > 0:
+        #the sender whose next payload is oldest; on a tie, the one listed first
+        Sender = max(Senders, key=lambda Sender: Queues[Sender][Heads[Sender]][0] if Sender in Heads else None)
+        Merged += [(Sender, MavlinkMessage) for MavlinkMessage in Queues[Sender][Heads[Sender]][1]]
+        Heads[Sender] += 1
+        if Heads[Sender]==len(Queues[Sender]):
+            del Heads[Sender]
+    return Merged
+
+
+def CollapseStale(ListOfSenderMessages, KeepFunction):
+    ######################################################################################
+    #
+    #  Summary:  Takes a list of (Sender, MavlinkMessage) and returns it with only the last
+    #  sample of each stream (sender, msgid, sysid, compid) left, where it was.  Messages
+    #  KeepFunction returns True for (e.g. STATUSTEXT, acks, mission items) are all kept.
+    #
+    ######################################################################################
+    Seen = set()
+    Kept = []
+    for Sender, MavlinkMessage in reversed(ListOfSenderMessages):
+        if not KeepFunction(MavlinkMessage):
+            Key = (Sender, MavlinkMessage.get_msgId(), MavlinkMessage.get_srcSystem(), MavlinkMessage.get_srcComponent())
+            if Key in Seen:
+                continue
+            Seen.add(Key)
+        Kept.append((Sender, MavlinkMessage))
+    Kept.reverse()
+    return Kept
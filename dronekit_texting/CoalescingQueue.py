@@ -0,0 +1,315 @@
+
+# CoalescingQueue.py
+# Summary:  Outgoing message queue that keeps only the newest sample of each telemetry
+# stream, with per-type rate limits and priorities
+# ChamBana03@gmail.com
+#
+# The autopilot streams ATTITUDE, VFR_HUD, ... far faster than text messages can carry them,
+# and only the latest sample of each is worth sending.  The queue holds one message per
+# (msgid, sysid, compid); a newer one simply replaces it.  Message types where every instance
+# matters (STATUSTEXT, PARAM_VALUE, mission items, ...) are kept in arrival order instead, in a
+# bounded FIFO.  *_ACK messages are critical and always go out in the next text message.
+#
+# Memory is bounded by the number of streams plus the FIFO limits, and Put() is O(1).
+#
+# SetRateScale() scales every stream's rate at once, which is how the send rate is brought down
+# when the GSM network backs up or the text message budget runs low (see RateController).
+#
+# With a SendJournal (SetJournal()), critical messages and the journaled FIFO types are also
+# journaled as they are queued, so they are sent after a crash or reboot even if they never
+# made it into a text message.
+
+import threading
+import time
+from collections import deque
+
+DEFAULT_MESSAGE_RATES = {   #most samples per second sent for a stream; unlisted types use DEFAULT_RATE
+    "HEARTBEAT": 0.2,
+    "ATTITUDE": 0.2,
+    "VFR_HUD": 0.2,
+    "GLOBAL_POSITION_INT": 0.2,
+    "GPS_RAW_INT": 0.2,
+    "SYS_STATUS": 0.1,
+    "NAV_CONTROLLER_OUTPUT": 0.1,
+    "MISSION_CURRENT": 0.1,
+}
+DEFAULT_RATE = 0.05
+
+DEFAULT_MESSAGE_PRIORITIES = {   #higher goes first; unlisted types use DEFAULT_PRIORITY
+    "STATUSTEXT": 8,
+    "HEARTBEAT": 6,
+    "GPS_RAW_INT": 5,
+    "GLOBAL_POSITION_INT": 5,
+    "SYS_STATUS": 4,
+    "MISSION_CURRENT": 4,
+    "ATTITUDE": 3,
+    "VFR_HUD": 3,
+    "NAV_CONTROLLER_OUTPUT": 2,
+}
+DEFAULT_PRIORITY = 1
+MAX_STALE_SECONDS = 60.0   #a stream unsent for this long is worth twice its priority
+
+#every instance of these carries something different, so they are queued, not coalesced
+DEFAULT_ORDERED_TYPES = set(["STATUSTEXT", "PARAM_VALUE", "MISSION_ITEM", "MISSION_ITEM_INT", "MISSION_COUNT",
+                             "MISSION_REQUEST", "MISSION_REQUEST_INT", "COMMAND_LONG", "COMMAND_INT"])
+
+
+def IsCritical(MavlinkMessage):
+    return MavlinkMessage.get_type().endswith("_ACK")
+
+
+class CoalescingQueue(object):
+    def __init__(self, MessageRates=DEFAULT_MESSAGE_RATES, MessagePriorities=DEFAULT_MESSAGE_PRIORITIES,
+                 OrderedTypes=DEFAULT_ORDERED_TYPES, MaxOrderedMessages=64, MaxCriticalMessages=64):
+        self._MessageRates = MessageRates
+        self._MessagePriorities = MessagePriorities
+        self._OrderedTypes = OrderedTypes
+        self._Lock = threading.Lock()
+        self._Latest = {}                   #(msgid, sysid, compid) -> newest message
+        self._Ordered = deque()
+        self._MaxOrderedMessages = MaxOrderedMessages
+        self._Critical = deque()
+        self._MaxCriticalMessages = MaxCriticalMessages
+        self._LastSent = {}                 #message type -> time a sample last went out
+        self._PendingBytes = 0
+        self._OldestPut = None
+        self._RateScale = 1.0
+        self._Journal = None
+        self._JournalTypes = ()
+        self._JournalIds = {}               #id() of a queued message -> its SendJournal entry
+
+    def Put(self, MavlinkMessage):
+        ######################################################################################
+        #
+        #  Summary:  Queues a message from the autopilot, replacing the previous sample of the
+        #  same stream.  Returns False if that pushed an older message out of a full FIFO.
+        #
+        ######################################################################################
+        Size = len(MavlinkMessage.get_msgbuf())
+        Kept = True
+        self._Lock.acquire()
+        try:
+            if self._OldestPut==None:
+                self._OldestPut = time.time()
+            if self._Journal!=None and (IsCritical(MavlinkMessage) or MavlinkMessage.get_type() in self._JournalTypes):
+                self._JournalIds[id(MavlinkMessage)] = self._Journal.Add(None, MavlinkMessage.get_msgbuf())
+            if IsCritical(MavlinkMessage):
+                Kept = self._Append(self._Critical, self._MaxCriticalMessages, MavlinkMessage, Size)
+            elif MavlinkMessage.get_type() in self._OrderedTypes:
+                Kept = self._Append(self._Ordered, self._MaxOrderedMessages, MavlinkMessage, Size)
+            else:
+                Key = (MavlinkMessage.get_msgId(), MavlinkMessage.get_srcSystem(), MavlinkMessage.get_srcComponent())
+                Previous = self._Latest.get(Key)
+                if Previous!=None:
+                    self._PendingBytes -= len(Previous.get_msgbuf())
+                self._Latest[Key] = MavlinkMessage
+                self._PendingBytes += Size
+        finally:
+            self._Lock.release()
+        return Kept
+
+    def TakeMessages(self, now=None):
+        ######################################################################################
+        #
+        #  Summary:  Removes and returns the messages that are due, most important first:
+        #  critical messages, then the FIFO in arrival order, then the newest sample of every
+        #  stream whose rate limit allows another sample, by priority.  Hand back whatever
+        #  doesn't fit in the text message with ReturnMessages(), and report what went out
+        #  with MarkSent().
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        self._Lock.acquire()
+        try:
+            ListOfMavlinkMessages = list(self._Critical) + list(self._Ordered)
+            self._Critical.clear()
+            self._Ordered.clear()
+
+            DueMessages = []
+            for Key, MavlinkMessage in self._Latest.items():
+                Type = MavlinkMessage.get_type()
+                if self._IsDue(Type, now):
+                    DueMessages.append(MavlinkMessage)
+                    del self._Latest[Key]
+            DueMessages.sort(key=lambda message: -self._MessagePriorities.get(message.get_type(), DEFAULT_PRIORITY))
+            ListOfMavlinkMessages += DueMessages
+
+            self._PendingBytes -= sum([len(message.get_msgbuf()) for message in ListOfMavlinkMessages])
+            self._OldestPut = None if self._PendingBytes==0 else now
+            return ListOfMavlinkMessages
+        finally:
+            self._Lock.release()
+
+    def ReturnMessages(self, ListOfMavlinkMessages):
+        ######################################################################################
+        #
+        #  Summary:  Puts back messages taken with TakeMessages() that didn't make it into a
+        #  text message, ahead of anything queued since.  A stream sample is dropped if a newer
+        #  one arrived in the meantime.
+        #
+        ######################################################################################
+        self._Lock.acquire()
+        try:
+            for MavlinkMessage in reversed(ListOfMavlinkMessages):
+                Size = len(MavlinkMessage.get_msgbuf())
+                if IsCritical(MavlinkMessage):
+                    self._Critical.appendleft(MavlinkMessage)
+                elif MavlinkMessage.get_type() in self._OrderedTypes:
+                    if len(self._Ordered) >= self._MaxOrderedMessages:
+                        self._CompleteJournal(MavlinkMessage)
+                        continue
+                    self._Ordered.appendleft(MavlinkMessage)
+                else:
+                    Key = (MavlinkMessage.get_msgId(), MavlinkMessage.get_srcSystem(), MavlinkMessage.get_srcComponent())
+                    if Key in self._Latest:
+                        continue
+                    self._Latest[Key] = MavlinkMessage
+                self._PendingBytes += Size
+            if self._PendingBytes > 0 and self._OldestPut==None:
+                self._OldestPut = time.time()
+        finally:
+            self._Lock.release()
+
+    def MarkSent(self, ListOfMavlinkMessages, now=None, JournalHandedOver=False):
+        ######################################################################################
+        #
+        #  Summary:  Records that these messages went out.  Call it once they are submitted,
+        #  since that completes their journal entries, or with JournalHandedOver once the
+        #  sender has taken the entries over (see GetJournalIds), which the queue then forgets.
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        for MavlinkMessage in ListOfMavlinkMessages:
+            self._LastSent[MavlinkMessage.get_type()] = now
+        if self._Journal!=None:
+            self._Lock.acquire()
+            try:
+                for MavlinkMessage in ListOfMavlinkMessages:
+                    if JournalHandedOver:
+                        self._JournalIds.pop(id(MavlinkMessage), None)
+                    else:
+                        self._CompleteJournal(MavlinkMessage)
+            finally:
+                self._Lock.release()
+
+    def GetJournalIds(self, ListOfMavlinkMessages):
+        ######################################################################################
+        #
+        #  Summary:  The journal entries of these messages, taken with TakeMessages(), for
+        #  TextMessageTelemetry.Submit() to complete once the modem is done with them, so
+        #  they are journaled once rather than again by the sender.  The queue keeps them
+        #  until MarkSent(..., JournalHandedOver=True).
+        #
+        ######################################################################################
+        self._Lock.acquire()
+        try:
+            return [self._JournalIds[id(MavlinkMessage)] for MavlinkMessage in ListOfMavlinkMessages
+                    if id(MavlinkMessage) in self._JournalIds]
+        finally:
+            self._Lock.release()
+
+    def SetJournal(self, Journal, JournalTypes):
+        ######################################################################################
+        #
+        #  Summary:  Journals critical messages and those of JournalTypes in Journal (an open
+        #  SendJournal) from the moment they are queued until MarkSent(), or until a full FIFO
+        #  drops them.  Use the same journal as the sender's (TextMessageTelemetry.OpenJournal)
+        #  and hand the entries over with GetJournalIds().
+        #
+        ######################################################################################
+        self._Journal = Journal
+        self._JournalTypes = JournalTypes
+
+    def GetMessageValue(self, MavlinkMessage, now=None):
+        ######################################################################################
+        #
+        #  Summary:  How much sending this message is worth, for PayloadSelector:  its type's
+        #  priority, raised for streams the ground station hasn't heard from in a while, up to
+        #  twice the priority after MAX_STALE_SECONDS.
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        Type = MavlinkMessage.get_type()
+        Priority = self._MessagePriorities.get(Type, DEFAULT_PRIORITY)
+        SecondsStale = min(now - self._LastSent.get(Type, 0), MAX_STALE_SECONDS)
+        return Priority*(1.0 + SecondsStale/MAX_STALE_SECONDS)
+
+    def SetRateScale(self, Scale):
+        ######################################################################################
+        #
+        #  Summary:  Multiplies every stream's rate by Scale, e.g. 0.5 sends each stream half
+        #  as often.  Critical and FIFO messages aren't rate limited and are unaffected.
+        #
+        ######################################################################################
+        self._RateScale = Scale
+
+    def HasCritical(self):
+        return len(self._Critical) > 0
+
+    def GetPendingBytes(self):
+        ######################################################################################
+        #
+        #  Summary:  Raw mavlink size of everything queued; compare against PayloadSelector's
+        #  EstimateEncodedLength() to tell whether a full text message is waiting.
+        #
+        ######################################################################################
+        return self._PendingBytes
+
+    def GetDueBytes(self, now=None):
+        ######################################################################################
+        #
+        #  Summary:  Raw mavlink size of what TakeMessages() would return now:  unlike
+        #  GetPendingBytes(), stream samples held back by their rate limit don't count.
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        self._Lock.acquire()
+        try:
+            DueBytes = sum([len(message.get_msgbuf()) for message in self._Critical]) \
+                + sum([len(message.get_msgbuf()) for message in self._Ordered])
+            for MavlinkMessage in self._Latest.values():
+                if self._IsDue(MavlinkMessage.get_type(), now):
+                    DueBytes += len(MavlinkMessage.get_msgbuf())
+            return DueBytes
+        finally:
+            self._Lock.release()
+
+    def GetSecondsWaiting(self, now=None):
+        ######################################################################################
+        #
+        #  Summary:  How long the queue has held messages without a text message going out
+        #
+        ######################################################################################
+        if self._OldestPut==None:
+            return 0
+        if now==None:
+            now = time.time()
+        return now - self._OldestPut
+
+    def GetMessageCount(self):
+        return len(self._Latest) + len(self._Ordered) + len(self._Critical)
+
+    def _IsDue(self, Type, now):
+        #True if the stream's rate limit allows another sample of Type
+        return now - self._LastSent.get(Type, 0) >= 1.0/(self._MessageRates.get(Type, DEFAULT_RATE)*self._RateScale)
+
+    def _Append(self, Fifo, MaxLength, MavlinkMessage, Size):
+        Kept = True
+        if len(Fifo) >= MaxLength:
+            Dropped = Fifo.popleft()
+            self._PendingBytes -= len(Dropped.get_msgbuf())
+            self._CompleteJournal(Dropped)
+            Kept = False
+        Fifo.append(MavlinkMessage)
+        self._PendingBytes += Size
+        return Kept
+
+    def _CompleteJournal(self, MavlinkMessage):
+        #caller holds the lock
+        EntryId = self._JournalIds.pop(id(MavlinkMessage), None)
+        if EntryId!=None:
+            self._Journal.Complete(EntryId)
@@ -0,0 +1,127 @@
+
+# CompressionDictionary.py
+# Summary:  Preset deflate dictionaries trained on typical autopilot telemetry
+# ChamBana03@gmail.com
+#
+# A text message payload is only a hundred or so bytes, which is too little for deflate to
+# find repeats on its own.  Priming the compressor with a dictionary of typical mavlink frames
+# lets the very first frame in a text message already reference known header and payload bytes.
+#
+# zlib in python 2 has no preset dictionary support (zdict), so the dictionary is fed through
+# the compressor once, sync-flushed, and the primed compressor/decompressor objects are copied
+# for each payload.  The sync flush leaves the stream on a byte boundary, so everything after
+# it is an independent deflate tail that only the matching primed decompressor can inflate.
+#
+# Dictionaries ship in the dictionaries/ folder as mavlink_<id>.dict.  The id travels in every
+# payload so the ground station always picks the dictionary the vehicle compressed with.
+# Use tools/TrainCompressionDictionary.py to build a new one from your own tlogs.
+
+import os
+import random
+import zlib
+
+DEFAULT_DICTIONARY_ID = 1
+DICTIONARY_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dictionaries")
+
+_PrimedCompressors = {}
+_PrimedDecompressors = {}
+
+
+def GetDictionaryPath(DictionaryId):
+    return os.path.join(DICTIONARY_FOLDER, "mavlink_%d.dict" % DictionaryId)
+
+
+def LoadDictionary(DictionaryId):
+    ######################################################################################
+    #
+    #  Summary:  Returns the raw bytes of a shipped dictionary.  Raises ValueError if no
+    #  dictionary with that id is installed.
+    #
+    ######################################################################################
+    Path = GetDictionaryPath(DictionaryId)
+    if not os.path.exists(Path):
+        raise ValueError("Unknown compression dictionary id: "+str(DictionaryId))
+    with open(Path, "rb") as DictionaryFile:
+        return DictionaryFile.read()
+
+
+def Compress(Buffer, DictionaryId=DEFAULT_DICTIONARY_ID):
+    ######################################################################################
+    #
+    #  Summary:  Raw deflate of Buffer with the compressor primed by the given dictionary
+    #
+    ######################################################################################
+    if DictionaryId not in _PrimedCompressors:
+        Compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS, 9)
+        Compressor.compress(LoadDictionary(DictionaryId))
+        Compressor.flush(zlib.Z_SYNC_FLUSH)
+        _PrimedCompressors[DictionaryId] = Compressor
+    Compressor = _PrimedCompressors[DictionaryId].copy()
+    return Compressor.compress(Buffer) + Compressor.flush()
+
+
+def Decompress(Buffer, DictionaryId=DEFAULT_DICTIONARY_ID):
+    ######################################################################################
+    #
+    #  Summary:  Inverse of Compress().  The decompressor is primed by inflating a deflated
+    #  copy of the dictionary, which leaves the dictionary in its window.
+    #
+    ######################################################################################
+    if DictionaryId not in _PrimedDecompressors:
+        Compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS, 9)
+        PrimingStream = Compressor.compress(LoadDictionary(DictionaryId)) + Compressor.flush(zlib.Z_SYNC_FLUSH)
+        Decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        Decompressor.decompress(PrimingStream)
+        _PrimedDecompressors[DictionaryId] = Decompressor
+    Decompressor = _PrimedDecompressors[DictionaryId].copy()
+    return Decompressor.decompress(Buffer) + Decompressor.flush()
+
+
+def TrainDictionary(ListOfFrames, MaxSize=4096, SampleSize=5000, SubstringLength=6):
+    ######################################################################################
+    #
+    #  Summary:  Builds a dictionary out of sample mavlink frames (raw byte strings).  Every
+    #  frame is scored by how often its substrings show up across the whole sample; frames are
+    #  picked greedily by the score of the substrings not already covered by earlier picks,
+    #  until MaxSize is reached.  The best frames end up at the end of the dictionary, where
+    #  deflate back-references to them are shortest.
+    #
+    ######################################################################################
+    if len(ListOfFrames) > SampleSize:
+        ListOfFrames = random.Random(0).sample(ListOfFrames, SampleSize)
+
+    def Substrings(Frame):
+        return set([Frame[i:i+SubstringLength] for i in range(len(Frame)-SubstringLength+1)])
+
+    SubstringCounts = {}
+    FrameSubstrings = []
+    for Frame in ListOfFrames:
+        Found = Substrings(Frame)
+        FrameSubstrings.append(Found)
+        for Substring in Found:
+            SubstringCounts[Substring] = SubstringCounts.get(Substring, 0) + 1
+
+    Covered = set()
+    Picked = []
+    PickedSize = 0
+    Remaining = range(len(ListOfFrames))
+    while PickedSize < MaxSize and len(Remaining) > 0:
+        BestIndex = None
+        BestScore = 0
+        for i in Remaining:
+            Score = 0
+            for Substring in FrameSubstrings[i]:
+                if Substring not in Covered and SubstringCounts[Substring] > 1:
+                    Score += SubstringCounts[Substring]
+            if Score > BestScore:
+                BestIndex = i
+                BestScore = Score
+        if BestIndex==None:
+            break
+        Picked.append(ListOfFrames[BestIndex])
+        PickedSize += len(ListOfFrames[BestIndex])
+        Covered.update(FrameSubstrings[BestIndex])
+        Remaining.remove(BestIndex)
+
+    Picked.reverse()
+    return "".join(Picked)[-MaxSize:]
@@ -0,0 +1,61 @@
+
+# DuplicateFilter.py
+# Summary:  Remembers recently received payloads so text messages delivered or read twice
+# are only processed once
+# ChamBana03@gmail.com
+#
+# The GSM network occasionally delivers a text message twice, and a message can be read again
+# if deleting it from the modem failed.  Processing it twice would replay commands to the
+# autopilot, so every received payload is checked against a bounded LRU of (sender, payload
+# hash) pairs.  Memory is bounded by MaxEntries no matter how many text messages arrive.
+#
+# Only check payloads that carry a per-sender sequence number (enveloped payloads, see
+# Envelope):  without one, the GCS retrying the same command or two identical heartbeat-only
+# batches hash the same as a repeat delivery and would be dropped for the whole window.
+
+import hashlib
+import time
+from collections import OrderedDict
+
+
+class DuplicateFilter(object):
+    def __init__(self, MaxEntries=256, Window=600):
+        ######################################################################################
+        #
+        #  Summary:  Remembers the last MaxEntries payloads, each for at most Window seconds.
+        #  The window matches SegmentReassembler's timeout, since text messages can sit on the
+        #  GSM network for minutes.
+        #
+        ######################################################################################
+        self._MaxEntries = MaxEntries
+        self._Window = Window
+        self._SeenPayloads = OrderedDict()   #(Sender, digest) -> time last seen, least recent first
+
+    def IsDuplicate(self, Sender, Payload, now=None):
+        ######################################################################################
+        #
+        #  Summary:  Returns True if the same sender sent the same payload within the window,
+        #  otherwise remembers it and returns False.
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        self._Expire(now)
+
+        Key = (Sender, hashlib.sha1(Payload).digest())
+        Duplicate = Key in self._SeenPayloads
+        if Duplicate:
+            del self._SeenPayloads[Key]   #move it to the most recent end
+        elif len(self._SeenPayloads) >= self._MaxEntries:
+            self._SeenPayloads.popitem(last=False)
+        self._SeenPayloads[Key] = now
+        return Duplicate
+
+    def GetEntryCount(self):
+        return len(self._SeenPayloads)
+
+    def _Expire(self, now):
+        for Key in list(self._SeenPayloads.keys()):
+            if now - self._SeenPayloads[Key] <= self._Window:
+                break   #entries are kept least recently seen first
+            del self._SeenPayloads[Key]
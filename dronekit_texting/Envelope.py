@@ -0,0 +1,219 @@
+
+# Envelope.py
+# Summary:  Link header wrapped around each payload, carrying its sequence number, and the
+# reorder buffer that puts payloads back in order on the receiving side
+# ChamBana03@gmail.com
+#
+# Envelope layout:  [ENVELOPE_MARKER][flags][sequence, 2 bytes little endian]
+#                   [reliable header, if FLAG_RELIABLE][ack header, if FLAG_ACK]
+#                   [timestamp, if FLAG_TIMESTAMP][delay report, if FLAG_DELAY][payload]
+#
+# Reliable header:  [session][reliable sequence, 2 bytes][base offset]
+# Ack header:       [session][cumulative ack, 2 bytes][selective ack bitmap, 2 bytes]
+# Timestamp:        sender's clock in seconds, modulo 65536, 2 bytes
+# Delay report:     seconds the sender's own incoming text messages spend queued, 2 bytes
+#
+# The marker takes the place of the payload format byte (see PayloadCodec), so a receiver can
+# tell enveloped payloads from bare ones, which still decode.  Segmentation happens after
+# wrapping, so all the segments of one payload share its sequence number.
+#
+# When text messages are spread over several modems and SIMs they arrive out of order, and
+# payloads such as delta records (FieldCodec) have to be decoded in the order they were sent.
+# ReorderBuffer holds early arrivals until the gap before them fills, or until they have
+# waited HoldSeconds, after which the missing payloads are given up on.
+#
+# Payloads that must not be lost carry a reliable header too, and the other side acks them in
+# the envelope of its own payloads (see Reliability).  Timestamps and delay reports drive the
+# send rate (see RateController).  An envelope with an empty payload only carries its headers,
+# e.g. a bare ack.
+
+import struct
+import time
+
+ENVELOPE_MARKER = 0x06
+ENVELOPE_HEADER_LENGTH = 4
+
+RELIABLE_HEADER_LENGTH = 4
+ACK_HEADER_LENGTH = 5
+TIMESTAMP_LENGTH = 2
+DELAY_LENGTH = 2
+
+FLAG_SEQUENCE = 0x01
+FLAG_RELIABLE = 0x02
+FLAG_ACK = 0x04
+FLAG_TIMESTAMP = 0x08
+FLAG_DELAY = 0x10
+
+SEQUENCE_MODULUS = 65536
+MAX_SEQUENCE_AHEAD = 1024   #further ahead or behind than this, the sender must have restarted
+
+
+def IsEnveloped(Payload):
+    return len(Payload) > 0 and ord(Payload[0])==ENVELOPE_MARKER
+
+
+def WrapPayload(Payload, Sequence, Reliable=None, Ack=None, Timestamp=None, Delay=None):
+    ######################################################################################
+    #
+    #  Summary:  Envelopes Payload.  Reliable is a (Session, ReliableSequence, BaseOffset)
+    #  tuple and Ack a (Session, Cumulative, Bitmap) tuple, as returned by Reliability's
+    #  RetransmitQueue and AckTracker.  Timestamp and Delay are as returned by
+    #  RateController.  Any of them can be None.
+    #
+    ######################################################################################
+    Flags = FLAG_SEQUENCE
+    Headers = ""
+    if Reliable!=None:
+        Flags |= FLAG_RELIABLE
+        Headers += struct.pack("<BHB", Reliable[0], Reliable[1] % SEQUENCE_MODULUS, Reliable[2])
+    if Ack!=None:
+        Flags |= FLAG_ACK
+        Headers += struct.pack("<BHH", Ack[0], Ack[1] % SEQUENCE_MODULUS, Ack[2])
+    if Timestamp!=None:
+        Flags |= FLAG_TIMESTAMP
+        Headers += struct.pack("<H", Timestamp % 65536)
+    if Delay!=None:
+        Flags |= FLAG_DELAY
+        Headers += struct.pack("<H", max(0, min(65535, int(Delay))))
+    return struct.pack("<BBH", ENVELOPE_MARKER, Flags, Sequence % SEQUENCE_MODULUS) + Headers + Payload
+
+
+def UnwrapPayload(Envelope):
+    ######################################################################################
+    #
+    #  Summary:  Returns (Sequence, Payload).  Raises ValueError for a truncated envelope.
+    #
+    ######################################################################################
+    Sequence, Reliable, Ack, Timestamp, Delay, Payload = UnwrapEnvelope(Envelope)
+    return Sequence, Payload
+
+
+def UnwrapEnvelope(Envelope):
+    ######################################################################################
+    #
+    #  Summary:  Returns (Sequence, Reliable, Ack, Timestamp, Delay, Payload), with the
+    #  fields as passed to WrapPayload(), or None.  Raises ValueError for a truncated
+    #  envelope.
+    #
+    ######################################################################################
+    if len(Envelope) < ENVELOPE_HEADER_LENGTH:
+        raise ValueError("Envelope of "+str(len(Envelope))+" bytes is truncated")
+    Marker, Flags, Sequence = struct.unpack("<BBH", Envelope[:ENVELOPE_HEADER_LENGTH])
+    Position = ENVELOPE_HEADER_LENGTH
+    Reliable = None
+    Ack = None
+    if Flags & FLAG_RELIABLE:
+        if len(Envelope) < Position + RELIABLE_HEADER_LENGTH:
+            raise ValueError("Reliable header is truncated")
+        Reliable = struct.unpack("<BHB", Envelope[Position:Position+RELIABLE_HEADER_LENGTH])
+        Position += RELIABLE_HEADER_LENGTH
+    if Flags & FLAG_ACK:
+        if len(Envelope) < Position + ACK_HEADER_LENGTH:
+            raise ValueError("Ack header is truncated")
+        Ack = struct.unpack("<BHH", Envelope[Position:Position+ACK_HEADER_LENGTH])
+        Position += ACK_HEADER_LENGTH
+    Timestamp = None
+    Delay = None
+    if Flags & FLAG_TIMESTAMP:
+        if len(Envelope) < Position + TIMESTAMP_LENGTH:
+            raise ValueError("Timestamp is truncated")
+        Timestamp = struct.unpack("<H", Envelope[Position:Position+TIMESTAMP_LENGTH])[0]
+        Position += TIMESTAMP_LENGTH
+    if Flags & FLAG_DELAY:
+        if len(Envelope) < Position + DELAY_LENGTH:
+            raise ValueError("Delay report is truncated")
+        Delay = struct.unpack("<H", Envelope[Position:Position+DELAY_LENGTH])[0]
+        Position += DELAY_LENGTH
+    return Sequence, Reliable, Ack, Timestamp, Delay, Envelope[Position:]
+
+
+class ReorderBuffer(object):
+    def __init__(self, HoldSeconds=10, MaxPending=64):
+        ######################################################################################
+        #
+        #  Summary:  Puts one sender's payloads back in sequence order.  An early payload is
+        #  held for at most HoldSeconds waiting for the ones before it, and at most MaxPending
+        #  payloads are held at once.  Payloads arriving after their place has been given up
+        #  on are passed through late rather than dropped.
+        #
+        ######################################################################################
+        self._HoldSeconds = HoldSeconds
+        self._MaxPending = MaxPending
+        self._Expected = None
+        self._Pending = {}    #sequence -> (time received, payload)
+
+    def Add(self, Sequence, Payload, now=None):
+        ######################################################################################
+        #
+        #  Summary:  Adds a received payload and returns the list of payloads now ready, in
+        #  sequence order (possibly empty).
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        if self._Expected==None:
+            self._Expected = Sequence
+
+        Ahead = (Sequence - self._Expected) % SEQUENCE_MODULUS
+        if Ahead < MAX_SEQUENCE_AHEAD:
+            self._Pending[Sequence] = (now, Payload)
+            Ready = self._Drain()
+            while len(self._Pending) > self._MaxPending:
+                Ready += self._Skip()
+            return Ready
+        if SEQUENCE_MODULUS - Ahead <= MAX_SEQUENCE_AHEAD:
+            return [Payload]   #late:  its place was given up on already
+
+        #too far off to be a late or early payload:  the sender restarted its numbering
+        Ready = self.Flush()
+        self._Expected = (Sequence + 1) % SEQUENCE_MODULUS
+        return Ready + [Payload]
+
+    def Expire(self, now=None):
+        ######################################################################################
+        #
+        #  Summary:  Gives up on missing payloads that have held others back for HoldSeconds
+        #  and returns the payloads that releases, in sequence order.
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        Ready = []
+        while len(self._Pending) > 0 and now - self._GetOldestTime() >= self._HoldSeconds:
+            Ready += self._Skip()
+        return Ready
+
+    def Flush(self):
+        Ready = []
+        while len(self._Pending) > 0:
+            Ready += self._Skip()
+        return Ready
+
+    def GetNextDeadline(self):
+        ######################################################################################
+        #
+        #  Summary:  Time at which Expire() will next release something, or None if nothing
+        #  is held
+        #
+        ######################################################################################
+        if len(self._Pending)==0:
+            return None
+        return self._GetOldestTime() + self._HoldSeconds
+
+    def GetPendingCount(self):
+        return len(self._Pending)
+
+    def _GetOldestTime(self):
+        return min([Received for Received, Payload in self._Pending.values()])
+
+    def _Skip(self):
+        #gives up on the gap before the lowest held sequence number
+        self._Expected = min(self._Pending.keys(), key=lambda Sequence: (Sequence - self._Expected) % SEQUENCE_MODULUS)
+        return self._Drain()
+
+    def _Drain(self):
+        Ready = []
+        while self._Expected in self._Pending:
+            Ready.append(self._Pending.pop(self._Expected)[1])
+            self._Expected = (self._Expected + 1) % SEQUENCE_MODULUS
+        return Ready
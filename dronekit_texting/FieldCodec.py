@@ -0,0 +1,378 @@
+
+# FieldCodec.py
+# Summary:  Schema-aware mavlink codec that sends each field as a varint delta against the
+# last state sent for that message type
+# ChamBana03@gmail.com
+#
+# Telemetry text messages mostly repeat the same GPS_RAW_INT, ATTITUDE, VFR_HUD, ... with
+# slightly different values.  Instead of whole frames, the DeltaEncoder unpacks each message
+# with its pymavlink wire format and only sends the fields that changed, as zigzag varint
+# deltas.  Floats listed in the quantization table are sent as integer steps (attitude to
+# 0.1 degree, speeds to 1 cm/s, ...); other floats are sent raw when they change.
+#
+# Payload layout:  [format byte][text message sequence][records, deflated or raw]
+# Record layout:   [msgid][flags]([sysid][compid])([reference sequence])([changed mask])[values]
+#
+# A delta record names the text message sequence its reference state was sent in.  The
+# DeltaDecoder only applies a delta whose reference it has; after a lost text message the
+# records referring to it are dropped until the next keyframe of that message type, which the
+# encoder sends every KeyframeInterval text messages.
+
+import math
+import re
+import struct
+import zlib
+import MavlinkFraming
+
+FORMAT_DELTA = 0x03        #delta records, headerless deflate
+FORMAT_DELTA_RAW = 0x04    #delta records, uncompressed (used when deflate doesn't help)
+
+FLAG_KEYFRAME = 0x01
+FLAG_NEW_SOURCE = 0x02     #sysid/compid follow; otherwise same as the previous record
+FLAG_RAW_PAYLOAD = 0x04    #message id unknown to the dialect, payload sent as is
+
+DEGREE = math.pi/180.0
+
+DEFAULT_QUANTIZATION = {
+    ("ATTITUDE", "roll"): 0.1*DEGREE,
+    ("ATTITUDE", "pitch"): 0.1*DEGREE,
+    ("ATTITUDE", "yaw"): 0.1*DEGREE,
+    ("ATTITUDE", "rollspeed"): 0.1*DEGREE,
+    ("ATTITUDE", "pitchspeed"): 0.1*DEGREE,
+    ("ATTITUDE", "yawspeed"): 0.1*DEGREE,
+    ("VFR_HUD", "airspeed"): 0.01,
+    ("VFR_HUD", "groundspeed"): 0.01,
+    ("VFR_HUD", "alt"): 0.01,
+    ("VFR_HUD", "climb"): 0.01,
+    ("NAV_CONTROLLER_OUTPUT", "nav_roll"): 0.1,
+    ("NAV_CONTROLLER_OUTPUT", "nav_pitch"): 0.1,
+    ("NAV_CONTROLLER_OUTPUT", "alt_error"): 0.01,
+    ("NAV_CONTROLLER_OUTPUT", "aspd_error"): 0.01,
+    ("NAV_CONTROLLER_OUTPUT", "xtrack_error"): 0.01,
+    ("SCALED_PRESSURE", "press_abs"): 0.01,
+    ("SCALED_PRESSURE", "press_diff"): 0.01,
+}
+
+_FormatToken = re.compile(r"(\d*)([a-zA-Z?])")
+
+
+class _MessageSchema(object):
+    ######################################################################################
+    #
+    #  Summary:  Wire layout of one message type, one entry per field:  (struct type code,
+    #  array length or 0, quantization step or None).  A char array ("50s") is one value.
+    #
+    ######################################################################################
+    def __init__(self, MessageClass, Quantization):
+        self.Format = MessageClass.format
+        self.Fields = []
+        FieldNames = MessageClass.ordered_fieldnames
+        for Number, (Count, TypeCode) in enumerate(_FormatToken.findall(MessageClass.format.lstrip("<"))):
+            Count = int(Count) if Count else 0
+            if TypeCode=="s":
+                Count = 0
+            Step = None
+            if TypeCode in "fd" and Number < len(FieldNames):
+                Step = Quantization.get((MessageClass.name, FieldNames[Number]))
+            self.Fields.append((TypeCode, Count, Step))
+
+    def Unpack(self, Payload):
+        ######################################################################################
+        #
+        #  Summary:  Payload bytes -> list with one entry per field (a list for arrays),
+        #  quantized floats replaced by their integer step count
+        #
+        ######################################################################################
+        Values = list(struct.unpack(self.Format, Payload))
+        Fields = []
+        for TypeCode, Count, Step in self.Fields:
+            if Count:
+                Value = Values[:Count]
+                del Values[:Count]
+            else:
+                Value = Values.pop(0)
+            if Step!=None:
+                Value = [_Quantize(v, Step) for v in Value] if Count else _Quantize(Value, Step)
+            Fields.append(Value)
+        return Fields
+
+    def Pack(self, Fields):
+        Values = []
+        for (TypeCode, Count, Step), Value in zip(self.Fields, Fields):
+            if Step!=None:
+                Value = [v*Step for v in Value] if Count else Value*Step
+            if Count:
+                Values += Value
+            else:
+                Values.append(Value)
+        return struct.pack(self.Format, *Values)
+
+
+class _SchemaCache(object):
+    def __init__(self, Quantization):
+        self._Quantization = Quantization
+        self._Schemas = {}
+
+    def Get(self, MessageId):
+        if MessageId not in self._Schemas:
+            MessageClass = MavlinkFraming.GetMessageClass(MessageId)
+            self._Schemas[MessageId] = _MessageSchema(MessageClass, self._Quantization) if MessageClass!=None else None
+        return self._Schemas[MessageId]
+
+
+class DeltaEncoder(object):
+    def __init__(self, KeyframeInterval=10, Quantization=DEFAULT_QUANTIZATION):
+        ######################################################################################
+        #
+        #  Summary:  KeyframeInterval is how many text messages may go by before a message
+        #  type is sent in full again, which bounds how long the ground side stays out of
+        #  sync after a lost text message.  Quantization maps (message name, field name) to
+        #  the step floats are rounded to.
+        #
+        ######################################################################################
+        self._KeyframeInterval = KeyframeInterval
+        self._Schemas = _SchemaCache(Quantization)
+        self._Counter = 0       #text messages committed so far; the sequence byte is this modulo 256
+        self._References = {}   #(msgid, sysid, compid) -> (Fields, Counter, KeyframeCounter)
+
+    def Encode(self, ListOfMavlinkMessages, Commit=False):
+        ######################################################################################
+        #
+        #  Summary:  Returns the payload for the messages, format byte included.  Encoding
+        #  doesn't change the reference state unless Commit is True, so it is safe to call
+        #  repeatedly while sizing a text message (PayloadSelector); commit only what is sent.
+        #
+        ######################################################################################
+        References = {}
+        Records = []
+        LastSource = None
+        for message in ListOfMavlinkMessages:
+            Sequence, SystemId, ComponentId, MessageId, Payload = MavlinkFraming.SplitFrame(message.get_msgbuf())
+            Key = (MessageId, SystemId, ComponentId)
+            Flags = 0
+            if LastSource!=(SystemId, ComponentId):
+                Flags |= FLAG_NEW_SOURCE
+                LastSource = (SystemId, ComponentId)
+
+            Schema = self._Schemas.Get(MessageId)
+            if Schema==None:
+                Record = _EncodeVarint(len(Payload)) + Payload
+                Flags |= FLAG_RAW_PAYLOAD
+            else:
+                Fields = Schema.Unpack(Payload)
+                Reference = References.get(Key, self._References.get(Key))
+                if Reference==None or self._Counter - Reference[2] >= self._KeyframeInterval or self._Counter - Reference[1] >= 128:
+                    Flags |= FLAG_KEYFRAME
+                    Record = _EncodeKeyframe(Schema, Fields)
+                    References[Key] = (Fields, self._Counter, self._Counter)
+                else:
+                    Record = chr(Reference[1] % 256) + _EncodeDelta(Schema, Fields, Reference[0])
+                    References[Key] = (Fields, self._Counter, Reference[2])
+
+            Header = chr(MessageId) + chr(Flags)
+            if Flags & FLAG_NEW_SOURCE:
+                Header += chr(SystemId) + chr(ComponentId)
+            Records.append(Header + Record)
+
+        Records = "".join(Records)
+        Compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS, 9)
+        Compressed = Compressor.compress(Records) + Compressor.flush()
+        if len(Compressed) < len(Records):
+            Payload = chr(FORMAT_DELTA) + chr(self._Counter % 256) + Compressed
+        else:
+            Payload = chr(FORMAT_DELTA_RAW) + chr(self._Counter % 256) + Records
+
+        if Commit:
+            self._References.update(References)
+            self._Counter += 1
+        return Payload
+
+
+class DeltaDecoder(object):
+    def __init__(self, Framing=None, Quantization=DEFAULT_QUANTIZATION):
+        ######################################################################################
+        #
+        #  Summary:  Ground side of DeltaEncoder; keep one per sender.  Framing is the
+        #  MavlinkFraming.FrameBuilder that numbers the rebuilt frames.  Quantization has to
+        #  match the encoder's.
+        #
+        ######################################################################################
+        self._Schemas = _SchemaCache(Quantization)
+        self._Framing = Framing if Framing!=None else MavlinkFraming.FrameBuilder()
+        self._References = {}   #(msgid, sysid, compid) -> (Fields, Sequence)
+
+    def Decode(self, Payload):
+        ######################################################################################
+        #
+        #  Summary:  Rebuilds complete mavlink frames (fresh sequence numbers and checksums)
+        #  from a FORMAT_DELTA/FORMAT_DELTA_RAW payload and returns them as one buffer.  Deltas
+        #  whose reference state never arrived are dropped.
+        #
+        ######################################################################################
+        Sequence = ord(Payload[1])
+        if ord(Payload[0])==FORMAT_DELTA:
+            Decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            Records = Decompressor.decompress(Payload[2:]) + Decompressor.flush()
+        else:
+            Records = Payload[2:]
+
+        Frames = []
+        Offset = 0
+        SystemId = ComponentId = 0
+        while Offset < len(Records):
+            MessageId = ord(Records[Offset])
+            Flags = ord(Records[Offset+1])
+            Offset += 2
+            if Flags & FLAG_NEW_SOURCE:
+                SystemId = ord(Records[Offset])
+                ComponentId = ord(Records[Offset+1])
+                Offset += 2
+            Key = (MessageId, SystemId, ComponentId)
+
+            if Flags & FLAG_RAW_PAYLOAD:
+                Length, Offset = _DecodeVarint(Records, Offset)
+                MessagePayload = Records[Offset:Offset+Length]
+                Offset += Length
+                if MavlinkFraming.GetMessageClass(MessageId)!=None:
+                    Frames.append(self._Framing.BuildFrame(SystemId, ComponentId, MessageId, MessagePayload))
+                continue
+
+            Schema = self._Schemas.Get(MessageId)
+            if Schema==None:
+                raise ValueError("Message id "+str(MessageId)+" isn't in this mavlink dialect")
+            if Flags & FLAG_KEYFRAME:
+                Fields, Offset = _DecodeKeyframe(Schema, Records, Offset)
+            else:
+                ReferenceSequence = ord(Records[Offset])
+                Reference = self._References.get(Key)
+                Usable = Reference!=None and Reference[1]==ReferenceSequence
+                Fields, Offset = _DecodeDelta(Schema, Records, Offset+1, Reference[0] if Usable else None)
+                if not Usable:
+                    continue   #reference was in a lost text message; wait for the next keyframe
+
+            self._References[Key] = (Fields, Sequence)
+            Frames.append(self._Framing.BuildFrame(SystemId, ComponentId, MessageId, Schema.Pack(Fields)))
+        return "".join(Frames)
+
+
+######################################################################################
+#
+#  Field encoding helpers
+#
+######################################################################################
+
+def _Quantize(Value, Step):
+    if math.isnan(Value) or math.isinf(Value):
+        return 0
+    return int(round(Value/Step))
+
+
+def _EncodeVarint(Value):
+    Bytes = ""
+    while Value >= 0x80:
+        Bytes += chr((Value & 0x7f) | 0x80)
+        Value >>= 7
+    return Bytes + chr(Value)
+
+
+def _DecodeVarint(Buffer, Offset):
+    Value = 0
+    Shift = 0
+    while 1:
+        Byte = ord(Buffer[Offset])
+        Offset += 1
+        Value |= (Byte & 0x7f) << Shift
+        if Byte < 0x80:
+            return Value, Offset
+        Shift += 7
+
+
+def _EncodeSigned(Value):
+    return _EncodeVarint(Value*2 if Value >= 0 else -Value*2-1)
+
+
+def _DecodeSigned(Buffer, Offset):
+    Value, Offset = _DecodeVarint(Buffer, Offset)
+    return (Value >> 1) if not (Value & 1) else -((Value+1) >> 1), Offset
+
+
+def _EncodeValue(TypeCode, Step, Value, Reference):
+    if TypeCode in "fd" and Step==None:
+        return struct.pack("<"+TypeCode, Value)
+    if TypeCode in "sc":
+        Value = Value.rstrip("\0")
+        return _EncodeVarint(len(Value)) + Value
+    return _EncodeSigned(Value - Reference)
+
+
+def _DecodeValue(TypeCode, Step, Buffer, Offset, Reference):
+    if TypeCode in "fd" and Step==None:
+        Size = struct.calcsize(TypeCode)
+        return struct.unpack("<"+TypeCode, Buffer[Offset:Offset+Size])[0], Offset+Size
+    if TypeCode in "sc":
+        Length, Offset = _DecodeVarint(Buffer, Offset)
+        return Buffer[Offset:Offset+Length], Offset+Length
+    Delta, Offset = _DecodeSigned(Buffer, Offset)
+    return Reference + Delta, Offset
+
+
+def _EncodeField(TypeCode, Count, Step, Value, Reference):
+    if Count:
+        return "".join([_EncodeValue(TypeCode, Step, Value[i], Reference[i]) for i in range(Count)])
+    return _EncodeValue(TypeCode, Step, Value, Reference)
+
+
+def _DecodeField(TypeCode, Count, Step, Buffer, Offset, Reference):
+    if Count:
+        Value = []
+        for i in range(Count):
+            Item, Offset = _DecodeValue(TypeCode, Step, Buffer, Offset, Reference[i])
+            Value.append(Item)
+        return Value, Offset
+    return _DecodeValue(TypeCode, Step, Buffer, Offset, Reference)
+
+
+def _ZeroField(Count):
+    return [0]*Count if Count else 0
+
+
+def _EncodeKeyframe(Schema, Fields):
+    return "".join([_EncodeField(TypeCode, Count, Step, Value, _ZeroField(Count))
+                    for (TypeCode, Count, Step), Value in zip(Schema.Fields, Fields)])
+
+
+def _DecodeKeyframe(Schema, Buffer, Offset):
+    Fields = []
+    for TypeCode, Count, Step in Schema.Fields:
+        Value, Offset = _DecodeField(TypeCode, Count, Step, Buffer, Offset, _ZeroField(Count))
+        Fields.append(Value)
+    return Fields, Offset
+
+
+def _EncodeDelta(Schema, Fields, Reference):
+    ChangedMask = 0
+    Values = ""
+    for Number, ((TypeCode, Count, Step), Value) in enumerate(zip(Schema.Fields, Fields)):
+        if Value!=Reference[Number]:
+            ChangedMask |= 1 << Number
+            Values += _EncodeField(TypeCode, Count, Step, Value, Reference[Number])
+    return _EncodeVarint(ChangedMask) + Values
+
+
+def _DecodeDelta(Schema, Buffer, Offset, Reference):
+    ######################################################################################
+    #
+    #  Summary:  Decodes a delta record.  With Reference None (reference state missing) the
+    #  record is only skipped over, and the returned fields are meaningless.
+    #
+    ######################################################################################
+    ChangedMask, Offset = _DecodeVarint(Buffer, Offset)
+    Fields = []
+    for Number, (TypeCode, Count, Step) in enumerate(Schema.Fields):
+        Base = Reference[Number] if Reference!=None else _ZeroField(Count)
+        if ChangedMask & (1 << Number):
+            Value, Offset = _DecodeField(TypeCode, Count, Step, Buffer, Offset, Base)
+            Fields.append(Value)
+        else:
+            Fields.append(Base)
+    return Fields, Offset
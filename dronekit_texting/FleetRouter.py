@@ -0,0 +1,125 @@
+
+# FleetRouter.py
+# Summary:  Routes mavlink between the GCS and a fleet of vehicles texting one ground station
+# ChamBana03@gmail.com
+#
+# Every vehicle is known by the first phone number of its modem pool (TextMessageTelemetry's
+# AddRemote) and shows up in the GCS on its GcsPort.  Two ways to keep the vehicles apart:
+#   -- one GcsPort per vehicle, e.g. one GCS instance each, so each vehicle's sysid can stay
+#   -- one shared GcsPort, each vehicle under its own GcsSystemId.  Vehicles usually all call
+#      themselves sysid 1, so their frames are rewritten to GcsSystemId on the way to the GCS,
+#      and the GCS's commands targeting GcsSystemId are rewritten back to the vehicle's
+#      SystemId (see MavlinkFraming.RewriteFrame).
+# Commands without a target_system, or targeting 0 (broadcast), go to every vehicle on the
+# port they came from.
+
+import threading
+from pymavlink import mavlinkv10 as mavlink
+import MavlinkFraming
+
+
+class Vehicle(object):
+    def __init__(self, Key, SystemId=None, GcsSystemId=None, GcsPort=14550):
+        ######################################################################################
+        #
+        #  Summary:  One vehicle of the fleet.  SystemId is the sysid its autopilot uses and
+        #  GcsSystemId the one the GCS sees; None for either leaves sysids as they are.
+        #
+        ######################################################################################
+        self.Key = Key
+        self.SystemId = SystemId
+        self.GcsSystemId = GcsSystemId if GcsSystemId!=None else SystemId
+        self.GcsPort = GcsPort
+
+    def IsRewritten(self):
+        return self.SystemId!=None and self.GcsSystemId!=self.SystemId
+
+
+class FleetRouter(object):
+    def __init__(self, DEBUG_LEVEL=2):
+        self._DEBUG_LEVEL = DEBUG_LEVEL
+        self._Vehicles = {}           #vehicle key -> Vehicle
+        self._Parser = mavlink.MAVLink(None)   #re-decodes the frames rewritten on the way to a vehicle
+        self._ParserLock = threading.Lock()
+
+    def AddVehicle(self, Key, SystemId=None, GcsSystemId=None, GcsPort=14550):
+        ######################################################################################
+        #
+        #  Summary:  Adds a vehicle, Key being the first phone number of its modem pool as
+        #  returned by TextMessageTelemetry's AddRemote().  Raises ValueError if another
+        #  vehicle already shows up on GcsPort under GcsSystemId.
+        #
+        ######################################################################################
+        Added = Vehicle(Key, SystemId, GcsSystemId, GcsPort)
+        for Other in self._Vehicles.values():
+            if Other.Key!=Key and Other.GcsPort==GcsPort and (Other.GcsSystemId==None or Added.GcsSystemId==None
+                                                              or Other.GcsSystemId==Added.GcsSystemId):
+                raise ValueError("Vehicles "+str(Other.Key)+" and "+str(Key)+" can't be told apart on port "+str(GcsPort)+
+                                 ":  give them different GcsSystemIds or GcsPorts")
+        self._Vehicles[Key] = Added
+        return Added
+
+    def GetVehicle(self, Key):
+        return self._Vehicles.get(Key)
+
+    def GetVehicles(self):
+        return list(self._Vehicles.values())
+
+    def GetGcsPorts(self):
+        return sorted(set([Added.GcsPort for Added in self._Vehicles.values()]))
+
+    def ToGcs(self, Key, MavlinkMessage):
+        ######################################################################################
+        #
+        #  Summary:  Returns the frame to hand the GCS for a message from vehicle Key, with the
+        #  vehicle's sysid rewritten to its GcsSystemId, or None if Key isn't in the fleet.
+        #  Messages from other sysids behind the vehicle (e.g. a companion computer) pass as
+        #  they are.
+        #
+        ######################################################################################
+        FromVehicle = self._Vehicles.get(Key)
+        if FromVehicle==None:
+            self.Logger("Dropping message from %s, which isn't in the fleet", 2, Key)
+            return None
+        Frame = MavlinkMessage.get_msgbuf()
+        if FromVehicle.IsRewritten() and MavlinkMessage.get_srcSystem()==FromVehicle.SystemId:
+            Frame = MavlinkFraming.RewriteFrame(Frame, SystemId=FromVehicle.GcsSystemId)
+        return Frame
+
+    def ToVehicles(self, GcsPort, MavlinkMessage):
+        ######################################################################################
+        #
+        #  Summary:  Returns the list of (Key, MavlinkMessage) to text for a message the GCS
+        #  sent from GcsPort:  to the vehicle it targets, with target_system rewritten to the
+        #  vehicle's own sysid, or to every vehicle on the port if it targets none.
+        #
+        ######################################################################################
+        Frame = MavlinkMessage.get_msgbuf()
+        TargetSystem = MavlinkFraming.GetTargetSystem(Frame)
+        Routed = []
+        for ToVehicle in self._Vehicles.values():
+            if ToVehicle.GcsPort!=GcsPort:
+                continue
+            if TargetSystem in (None, 0) or ToVehicle.GcsSystemId in (None, TargetSystem):
+                if TargetSystem not in (None, 0) and ToVehicle.IsRewritten():
+                    Routed.append((ToVehicle.Key, self._Decode(MavlinkFraming.RewriteFrame(Frame, TargetSystem=ToVehicle.SystemId))))
+                else:
+                    Routed.append((ToVehicle.Key, MavlinkMessage))
+        if len(Routed)==0:
+            self.Logger("No vehicle on port %s is sysid %s, dropping %s", 2, GcsPort, TargetSystem, MavlinkMessage.get_type())
+        return [(Key, Message) for Key, Message in Routed if Message!=None]
+
+    def _Decode(self, Frame):
+        self._ParserLock.acquire()
+        try:
+            return self._Parser.decode(Frame)
+        except Exception, e:
+            self.Logger("Can't decode rewritten frame: %s", 1, e)
+            return None
+        finally:
+            self._ParserLock.release()
+
+    def Logger(self, message, message_importance, *Arguments):
+        #Arguments are only formatted into message if it is printed
+        if message_importance < self._DEBUG_LEVEL:
+            print message % Arguments if Arguments else message
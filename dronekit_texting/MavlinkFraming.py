@@ -0,0 +1,213 @@
+
+# MavlinkFraming.py
+# Summary:  Helpers to take mavlink 1.0 frames apart and build them back up with fresh
+# sequence numbers and checksums
+# ChamBana03@gmail.com
+#
+# Frame layout:  [0xFE][payload length][sequence][sysid][compid][msgid][payload][crc16]
+#
+# The text message link has its own integrity checks, so the compact layout drops everything
+# but the message id and payload.  Messages are grouped by source, whose sysid/compid is sent
+# once per group, and the payload length follows from the message id:
+#
+# Compact layout:  ([sysid][compid][message count]([msgid][payload])*)*
+#
+# A ground station serving several vehicles rewrites the sysid and target_system of frames
+# in place (RewriteFrame), so vehicles that all call themselves sysid 1 show up as different
+# vehicles in one GCS.
+
+import re
+import struct
+from pymavlink import mavlinkv10 as mavlink
+
+FRAME_START = 0xFE
+FRAME_HEADER_LENGTH = 6
+FRAME_CRC_LENGTH = 2
+
+
+def SplitFrame(Frame):
+    ######################################################################################
+    #
+    #  Summary:  Returns (Sequence, SystemId, ComponentId, MessageId, Payload) for one
+    #  complete mavlink 1.0 frame, e.g. message.get_msgbuf()
+    #
+    ######################################################################################
+    Length, Sequence, SystemId, ComponentId, MessageId = struct.unpack("<BBBBB", Frame[1:FRAME_HEADER_LENGTH])
+    return Sequence, SystemId, ComponentId, MessageId, Frame[FRAME_HEADER_LENGTH:FRAME_HEADER_LENGTH+Length]
+
+
+def GetMessageClass(MessageId):
+    ######################################################################################
+    #
+    #  Summary:  The pymavlink message class for a message id (its wire format, field names,
+    #  crc_extra, ...), or None if the dialect doesn't know the id.
+    #
+    ######################################################################################
+    return mavlink.mavlink_map.get(MessageId)
+
+
+def GetPayloadLength(MessageId):
+    MessageClass = GetMessageClass(MessageId)
+    if MessageClass==None:
+        return None
+    return struct.calcsize(MessageClass.format)
+
+
+_FieldOffsets = {}   #(message id, field name) -> byte offset in the payload, or None
+
+
+def GetFieldOffset(MessageId, FieldName):
+    ######################################################################################
+    #
+    #  Summary:  Byte offset of a field in the payload of a message id, or None if the
+    #  message has no such field.  Fields are on the wire in the order of the message
+    #  class's format, largest type first, not in the order they are declared.
+    #
+    ######################################################################################
+    Key = (MessageId, FieldName)
+    if Key not in _FieldOffsets:
+        Offset = None
+        MessageClass = GetMessageClass(MessageId)
+        if MessageClass!=None and FieldName in MessageClass.ordered_fieldnames:
+            Offset = 0
+            for Name, (Count, Code) in zip(MessageClass.ordered_fieldnames, re.findall(r'(\d*)([a-zA-Z?])', MessageClass.format)):
+                if Name==FieldName:
+                    break
+                Offset += struct.calcsize("<" + Count + Code)
+        _FieldOffsets[Key] = Offset
+    return _FieldOffsets[Key]
+
+
+def RewriteFrame(Frame, SystemId=None, TargetSystem=None):
+    ######################################################################################
+    #
+    #  Summary:  Returns a copy of a complete mavlink 1.0 frame with its sysid and/or its
+    #  target_system field replaced (None leaves them alone) and a fresh checksum.  Messages
+    #  without a target_system field keep the one they have.
+    #
+    ######################################################################################
+    Sequence, FrameSystemId, ComponentId, MessageId, Payload = SplitFrame(Frame)
+    if SystemId==None:
+        SystemId = FrameSystemId
+    if TargetSystem!=None:
+        Offset = GetFieldOffset(MessageId, "target_system")
+        if Offset!=None and Offset < len(Payload):
+            Payload = Payload[:Offset] + chr(TargetSystem) + Payload[Offset+1:]
+    Header = struct.pack("<BBBBBB", FRAME_START, len(Payload), Sequence, SystemId, ComponentId, MessageId)
+    Crc = mavlink.x25crc(Header[1:] + Payload)
+    Crc.accumulate(chr(mavlink.mavlink_map[MessageId].crc_extra))
+    return Header + Payload + struct.pack("<H", Crc.crc)
+
+
+def GetTargetSystem(Frame):
+    #the target_system field of a complete frame, or None if its message has none
+    Sequence, SystemId, ComponentId, MessageId, Payload = SplitFrame(Frame)
+    Offset = GetFieldOffset(MessageId, "target_system")
+    if Offset==None or Offset >= len(Payload):
+        return None
+    return ord(Payload[Offset])
+
+
+def PackCompact(ListOfMavlinkMessages):
+    ######################################################################################
+    #
+    #  Summary:  Strips the framing off the messages and returns them in the compact layout.
+    #  Messages the dialect doesn't know are left out, since the receiver couldn't tell
+    #  their length (nor parse them).
+    #
+    ######################################################################################
+    Groups = []
+    GroupOfSource = {}
+    for message in ListOfMavlinkMessages:
+        Sequence, SystemId, ComponentId, MessageId, Payload = SplitFrame(message.get_msgbuf())
+        if GetPayloadLength(MessageId)!=len(Payload):
+            continue
+        Source = (SystemId, ComponentId)
+        if Source not in GroupOfSource or len(GroupOfSource[Source][1])==255:
+            GroupOfSource[Source] = (Source, [])
+            Groups.append(GroupOfSource[Source])
+        GroupOfSource[Source][1].append(chr(MessageId) + Payload)
+
+    return "".join([chr(SystemId) + chr(ComponentId) + chr(len(Records)) + "".join(Records)
+                    for (SystemId, ComponentId), Records in Groups])
+
+
+def UnpackCompact(Buffer, Framing):
+    ######################################################################################
+    #
+    #  Summary:  Inverse of PackCompact().  Re-frames every message with the next sequence
+    #  number of Framing (a FrameBuilder) and a fresh checksum, and returns the frames as one
+    #  buffer ready for MAVLink.parse_buffer().
+    #
+    ######################################################################################
+    Frames = []
+    Offset = 0
+    while Offset < len(Buffer):
+        SystemId, ComponentId, Count = struct.unpack("<BBB", Buffer[Offset:Offset+3])
+        Offset += 3
+        for i in range(Count):
+            MessageId = ord(Buffer[Offset])
+            Length = GetPayloadLength(MessageId)
+            if Length==None:
+                raise ValueError("Message id "+str(MessageId)+" isn't in this mavlink dialect")
+            Frames.append(Framing.BuildFrame(SystemId, ComponentId, MessageId, Buffer[Offset+1:Offset+1+Length]))
+            Offset += 1 + Length
+    return "".join(Frames)
+
+
+def CountCompact(Buffer):
+    ######################################################################################
+    #
+    #  Summary:  Number of messages in a compact buffer, without building their frames.
+    #  Raises ValueError like UnpackCompact().
+    #
+    ######################################################################################
+    Count = 0
+    Offset = 0
+    while Offset < len(Buffer):
+        GroupCount = ord(Buffer[Offset+2])
+        Offset += 3
+        for i in range(GroupCount):
+            Length = GetPayloadLength(ord(Buffer[Offset]))
+            if Length==None:
+                raise ValueError("Message id "+str(ord(Buffer[Offset]))+" isn't in this mavlink dialect")
+            Offset += 1 + Length
+        Count += GroupCount
+    return Count
+
+
+class FrameBuilder(object):
+    def __init__(self, Sequence=0):
+        ######################################################################################
+        #
+        #  Summary:  Builds complete mavlink frames from a message id and payload.  Every frame
+        #  gets the next sequence number of this builder, so use one builder per outgoing link.
+        #  Sequence is the number of the first frame.
+        #
+        ######################################################################################
+        self._Sequence = Sequence % 256
+
+    def Reserve(self, Count):
+        ######################################################################################
+        #
+        #  Summary:  Skips Count sequence numbers and returns the first, for frames built
+        #  elsewhere (e.g. by a FrameBuilder(Sequence) in a decode worker) that should
+        #  number on from this builder's
+        #
+        ######################################################################################
+        Sequence = self._Sequence
+        self._Sequence = (self._Sequence + Count) % 256
+        return Sequence
+
+    def BuildFrame(self, SystemId, ComponentId, MessageId, Payload):
+        ######################################################################################
+        #
+        #  Summary:  Returns the complete frame, checksum included.  Raises KeyError if the
+        #  dialect doesn't know the message id, since the checksum needs its crc_extra.
+        #
+        ######################################################################################
+        Header = struct.pack("<BBBBBB", FRAME_START, len(Payload), self._Sequence, SystemId, ComponentId, MessageId)
+        self._Sequence = (self._Sequence + 1) % 256
+        Crc = mavlink.x25crc(Header[1:] + Payload)
+        Crc.accumulate(chr(mavlink.mavlink_map[MessageId].crc_extra))
+        return Header + Payload + struct.pack("<H", Crc.crc)
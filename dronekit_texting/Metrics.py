@@ -0,0 +1,237 @@
+
+# Metrics.py
+# Summary:  Counters, gauges and histograms for the telemetry pipeline, exported as Prometheus text
+# or JSON on a local HTTP port, or written to a snapshot file
+# ChamBana03@gmail.com
+#
+# TextMessageTelemetry and LocalGCScommunication record into a MetricsRegistry as they go:  how
+# long encoding takes and how well it compresses, messages per text message, how long sends wait
+# for the send lock and the modem, how long AT+CMGS and inbox reads take, drops by reason and
+# queue depths.  Recording is a dictionary update under a lock, cheap enough for every message;
+# nothing is formatted until an exporter asks.
+#
+# Histogram buckets are picked by the name's suffix (see HISTOGRAM_BUCKETS).  Labels are keyword
+# arguments, e.g. Increment("drops_total", Reason="duplicate").
+#
+# Exporters, both optional and both off the hot path:
+#   -- MetricsServer:  http://127.0.0.1:<port>/metrics (Prometheus text) and /metrics.json
+#   -- SnapshotWriter:  the JSON rewritten to a file every IntervalSeconds, atomically
+
+import json
+import os
+import threading
+import time
+import BaseHTTPServer
+from bisect import bisect_left
+
+#upper bounds of the histogram buckets, by the metric name's suffix
+HISTOGRAM_BUCKETS = [
+    ("_seconds", (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)),
+    ("_bytes", (16, 32, 64, 96, 120, 140, 280, 560, 1120, 2240)),
+    ("_ratio", (1.0, 1.5, 2.0, 3.0, 4.0, 6.0, 8.0, 12.0)),
+]
+DEFAULT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)   #counts, e.g. messages per text message
+
+
+class MetricsRegistry(object):
+    def __init__(self, Prefix="texting_"):
+        ######################################################################################
+        #
+        #  Summary:  Metrics of one process; every exported name starts with Prefix.  Thread
+        #  safe.
+        #
+        ######################################################################################
+        self._Prefix = Prefix
+        self._Lock = threading.Lock()
+        self._Counters = {}      #(name, labels) -> value
+        self._Gauges = {}        #(name, labels) -> value
+        self._Histograms = {}    #(name, labels) -> [bucket counts..., +Inf count, sum]
+
+    def Increment(self, Name, Amount=1, **Labels):
+        Key = (Name, tuple(sorted(Labels.items())))
+        self._Lock.acquire()
+        try:
+            self._Counters[Key] = self._Counters.get(Key, 0) + Amount
+        finally:
+            self._Lock.release()
+
+    def Set(self, Name, Value, **Labels):
+        Key = (Name, tuple(sorted(Labels.items())))
+        self._Lock.acquire()
+        try:
+            self._Gauges[Key] = Value
+        finally:
+            self._Lock.release()
+
+    def Observe(self, Name, Value, **Labels):
+        ######################################################################################
+        #
+        #  Summary:  Adds a sample to the histogram Name
+        #
+        ######################################################################################
+        Key = (Name, tuple(sorted(Labels.items())))
+        Buckets = GetBuckets(Name)
+        self._Lock.acquire()
+        try:
+            Histogram = self._Histograms.get(Key)
+            if Histogram==None:
+                Histogram = self._Histograms[Key] = [0]*(len(Buckets) + 1) + [0.0]
+            Histogram[bisect_left(Buckets, Value)] += 1
+            Histogram[-1] += Value
+        finally:
+            self._Lock.release()
+
+    def GetSnapshot(self):
+        ######################################################################################
+        #
+        #  Summary:  Every metric as a dict of "counters", "gauges" and "histograms", keyed by
+        #  name with labels in Prometheus notation.  A histogram is {"count", "sum",
+        #  "buckets":  [[upper bound, samples in that bucket or below], ..., ["+Inf", count]]}.
+        #
+        ######################################################################################
+        self._Lock.acquire()
+        try:
+            Counters = dict(self._Counters)
+            Gauges = dict(self._Gauges)
+            Histograms = dict([(Key, list(Histogram)) for Key, Histogram in self._Histograms.items()])
+        finally:
+            self._Lock.release()
+        Snapshot = {"time": time.time(), "counters": {}, "gauges": {}, "histograms": {}}
+        for (Name, Labels), Value in Counters.items():
+            Snapshot["counters"][self._FormatName(Name, Labels)] = Value
+        for (Name, Labels), Value in Gauges.items():
+            Snapshot["gauges"][self._FormatName(Name, Labels)] = Value
+        for (Name, Labels), Histogram in Histograms.items():
+            Cumulative = []
+            Count = 0
+            for Bound, Samples in zip(list(GetBuckets(Name)) + ["+Inf"], Histogram[:-1]):
+                Count += Samples
+                Cumulative.append([Bound, Count])
+            Snapshot["histograms"][self._FormatName(Name, Labels)] = {"count": Count, "sum": Histogram[-1], "buckets": Cumulative}
+        return Snapshot
+
+    def GetJson(self):
+        return json.dumps(self.GetSnapshot(), sort_keys=True)
+
+    def GetPrometheusText(self):
+        ######################################################################################
+        #
+        #  Summary:  Every metric in the Prometheus text exposition format
+        #
+        ######################################################################################
+        Snapshot = self.GetSnapshot()
+        Lines = []
+        for Kind, Type in (("counters", "counter"), ("gauges", "gauge")):
+            Typed = set()
+            for FullName in sorted(Snapshot[Kind]):
+                Name = FullName.split("{")[0]
+                if Name not in Typed:
+                    Lines.append("# TYPE %s %s" % (Name, Type))
+                    Typed.add(Name)
+                Lines.append("%s %s" % (FullName, repr(Snapshot[Kind][FullName])))
+        Typed = set()
+        for FullName in sorted(Snapshot["histograms"]):
+            Name, Labels = (FullName.split("{", 1) + [""])[:2]
+            Labels = Labels.rstrip("}")
+            if Name not in Typed:
+                Lines.append("# TYPE %s histogram" % Name)
+                Typed.add(Name)
+            Histogram = Snapshot["histograms"][FullName]
+            for Bound, Count in Histogram["buckets"]:
+                Lines.append('%s_bucket{%sle="%s"} %d' % (Name, Labels + "," if Labels else "", Bound, Count))
+            Suffix = "{" + Labels + "}" if Labels else ""
+            Lines.append("%s_sum%s %s" % (Name, Suffix, repr(Histogram["sum"])))
+            Lines.append("%s_count%s %d" % (Name, Suffix, Histogram["count"]))
+        return "\n".join(Lines) + "\n"
+
+    def _FormatName(self, Name, Labels):
+        if len(Labels)==0:
+            return self._Prefix + Name
+        return self._Prefix + Name + "{" + ",".join(['%s="%s"' % (Label.lower(), Value) for Label, Value in Labels]) + "}"
+
+
+def GetBuckets(Name):
+    for Suffix, Buckets in HISTOGRAM_BUCKETS:
+        if Name.endswith(Suffix):
+            return Buckets
+    return DEFAULT_BUCKETS
+
+
+class MetricsServer(object):
+    def __init__(self, Registry, Port, Address="127.0.0.1"):
+        ######################################################################################
+        #
+        #  Summary:  Serves Registry on http://Address:Port/metrics (Prometheus text) and
+        #  /metrics.json from a background thread, once Start() is called
+        #
+        ######################################################################################
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path=="/metrics":
+                    Body, ContentType = Registry.GetPrometheusText(), "text/plain; version=0.0.4"
+                elif self.path=="/metrics.json":
+                    Body, ContentType = Registry.GetJson(), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", ContentType)
+                self.send_header("Content-Length", str(len(Body)))
+                self.end_headers()
+                self.wfile.write(Body)
+
+            def log_message(self, format, *args):
+                pass   #scrapes aren't worth a line each
+
+        self._Server = BaseHTTPServer.HTTPServer((Address, Port), Handler)
+        self._Thread = None
+
+    def Start(self):
+        self._Thread = threading.Thread(target=self._Server.serve_forever)
+        self._Thread.daemon = True
+        self._Thread.start()
+
+    def Close(self):
+        self._Server.shutdown()
+        self._Server.server_close()
+
+
+class SnapshotWriter(object):
+    def __init__(self, Registry, Path, IntervalSeconds=60):
+        ######################################################################################
+        #
+        #  Summary:  Rewrites Path with Registry's JSON every IntervalSeconds from a background
+        #  thread, once Start() is called.  The file is replaced whole, so a reader never sees
+        #  half a snapshot.
+        #
+        ######################################################################################
+        self._Registry = Registry
+        self._Path = Path
+        self._IntervalSeconds = IntervalSeconds
+        self._Stop = threading.Event()
+        self._Thread = None
+
+    def Start(self):
+        self._Thread = threading.Thread(target=self._WriterLoop)
+        self._Thread.daemon = True
+        self._Thread.start()
+
+    def Close(self):
+        self._Stop.set()
+        self.Write()
+
+    def Write(self):
+        TemporaryPath = self._Path + ".tmp"
+        SnapshotFile = open(TemporaryPath, "w")
+        try:
+            SnapshotFile.write(self._Registry.GetJson())
+        finally:
+            SnapshotFile.close()
+        os.rename(TemporaryPath, self._Path)
+
+    def _WriterLoop(self):
+        while not self._Stop.wait(self._IntervalSeconds):
+            try:
+                self.Write()
+            except (IOError, OSError), e:
+                print "Can't write metrics snapshot: "+str(e)
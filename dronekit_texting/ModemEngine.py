@@ -0,0 +1,340 @@
+
+# ModemEngine.py
+# Summary:  AT command engine for the GSM modem:  one reader thread, a priority queue of
+# commands and a future per command, so callers never sleep-poll the serial port
+# ChamBana03@gmail.com
+#
+# Callers queue commands with Submit() and get a ModemCommand back, whose Result() waits for the
+# modem's final result code.  A dispatcher thread writes the queued commands one at a time,
+# highest priority first (sends ahead of inbox reads), and the reader thread matches every line
+# the modem returns to the command in flight.  Unsolicited lines such as +CMTI new message
+# indications are handed to NotificationCallback as they arrive, even while a command is in
+# flight.
+#
+# A modem only executes one AT command at a time, so the engine can't run two commands at
+# once.  What it does overlap is everything around them:  callers queue reads while a send is
+# waiting on the network, the next command goes out the moment the last one completes, and new
+# message indications are picked up without a poll.
+#
+# A command that times out may still be answered later.  Before the next command goes out the
+# engine resyncs:  it sends AT and discards everything up to a final result code that isn't
+# followed by more output, so a late answer can't complete the next command with a response
+# that isn't its own.
+#
+# Port can be anything pyserial opens, including a pty, which is how the engine is exercised
+# against a fake modem.
+
+import threading
+import time
+import Queue
+import serial
+
+PRIORITY_SEND = 0         #outgoing text messages
+PRIORITY_RECEIVE = 1      #inbox reads and deletes
+PRIORITY_BACKGROUND = 2   #setup and housekeeping
+
+FINAL_RESULT_CODES = ("OK", "ERROR", "+CME ERROR", "+CMS ERROR", "NO CARRIER")
+UNSOLICITED_PREFIXES = ("+CMTI:", "+CDSI:", "RING", "+CLIP:")
+
+RESYNC_ATTEMPTS = 3         #ATs sent after a timeout before giving up on a clean resync
+RESYNC_TIMEOUT = 5          #seconds each of them gets
+RESYNC_QUIET_SECONDS = 0.5  #silence after a final result code that means nothing more is coming
+
+CTRL_Z = chr(26)
+ESCAPE = chr(27)
+
+
+class ModemError(Exception):
+    pass
+
+
+class ModemTimeout(ModemError):
+    pass
+
+
+class ModemCommand(object):
+    def __init__(self, Command, Timeout, Prompt, Data):
+        ######################################################################################
+        #
+        #  Summary:  One queued AT command and, once the modem answers, its response.  Created
+        #  by ModemEngine.Submit().
+        #
+        ######################################################################################
+        self.Command = Command
+        self.Timeout = Timeout
+        self.Prompt = Prompt
+        self.Data = Data
+        self.Lines = []
+        self.QueuedTime = time.time()
+        self.SentTime = None        #when the dispatcher wrote the command to the modem
+        self.CompletedTime = None
+        self._Error = None
+        self._PromptEvent = threading.Event()
+        self._Done = threading.Event()
+
+    def Result(self, timeout=None):
+        ######################################################################################
+        #
+        #  Summary:  Waits for the command to complete and returns the response lines, final
+        #  result code included.  Raises ModemError if the modem answered with an error and
+        #  ModemTimeout if it didn't answer in time.  Without a timeout, waits as long as the
+        #  command sits in the queue; once written, the modem gets the command's own Timeout.
+        #
+        ######################################################################################
+        if timeout==None:
+            while not self._Done.wait(1):
+                pass
+        elif not self._Done.wait(timeout):
+            raise ModemTimeout("No response to "+self.Command)
+        if self._Error!=None:
+            raise self._Error
+        return self.Lines
+
+    def IsDone(self):
+        return self._Done.isSet()
+
+    def GetDuration(self):
+        ######################################################################################
+        #
+        #  Summary:  Seconds the modem took over the command, from writing it to its final
+        #  result code, or None if it hasn't been written or hasn't completed.  For AT+CMGS
+        #  this is how long the network took to accept the text message.
+        #
+        ######################################################################################
+        if self.SentTime==None or self.CompletedTime==None:
+            return None
+        return self.CompletedTime - self.SentTime
+
+    def GetQueueWait(self):
+        ######################################################################################
+        #
+        #  Summary:  Seconds the command waited in the queue for the modem, or None if it
+        #  hasn't been written yet
+        #
+        ######################################################################################
+        if self.SentTime==None:
+            return None
+        return self.SentTime - self.QueuedTime
+
+    def _Complete(self, Error=None):
+        self._Error = Error
+        self.CompletedTime = time.time()
+        self._Done.set()
+
+
+class ModemEngine(object):
+    def __init__(self, Port, BaudRate=115200, NotificationCallback=None, DEBUG_LEVEL=2):
+        ######################################################################################
+        #
+        #  Summary:  NotificationCallback(Line) is called from the reader thread for every
+        #  unsolicited line, e.g. '+CMTI: "SM",3'.  It must not wait on a command result,
+        #  since the reader thread is what completes commands.
+        #
+        ######################################################################################
+        self._Port = Port
+        self._BaudRate = BaudRate
+        self._NotificationCallback = NotificationCallback
+        self._DEBUG_LEVEL = DEBUG_LEVEL
+        self._Serial = None
+        self._Commands = Queue.PriorityQueue()
+        self._CommandCount = 0            #tie breaker keeping equal priority commands in order
+        self._CommandCountLock = threading.Lock()
+        self._InFlight = None
+        self._InFlightLock = threading.Lock()
+        self._LastOutputTime = 0           #when the modem last sent a line meant for a command
+        self._Running = False
+        self._ReaderThread = None
+        self._DispatcherThread = None
+
+    def Connect(self):
+        ######################################################################################
+        #
+        #  Summary:  Opens the serial port, starts the reader and dispatcher threads, and turns
+        #  command echo off and verbose errors on.
+        #
+        ######################################################################################
+        self._Serial = serial.Serial(self._Port, self._BaudRate, timeout=0.1)
+        self._Running = True
+        self._ReaderThread = threading.Thread(target=self._ReaderLoop)
+        self._ReaderThread.daemon = True
+        self._ReaderThread.start()
+        self._DispatcherThread = threading.Thread(target=self._DispatcherLoop)
+        self._DispatcherThread.daemon = True
+        self._DispatcherThread.start()
+
+        self.Execute("AT", Priority=PRIORITY_BACKGROUND, Timeout=5)
+        self.Execute("ATE0", Priority=PRIORITY_BACKGROUND, Timeout=5)
+        self.Execute("AT+CMEE=1", Priority=PRIORITY_BACKGROUND, Timeout=5)
+
+    def Close(self):
+        self._Running = False
+        while not self._Commands.empty():
+            Priority, Count, Command = self._Commands.get()
+            Command._Complete(ModemError("Modem closed before "+Command.Command))
+        self._Commands.put((-1, 0, None))   #wake up the dispatcher so it can exit
+        if self._Serial!=None:
+            self._Serial.close()
+
+    def Submit(self, Command, Priority=PRIORITY_RECEIVE, Timeout=10, Prompt=None, Data=None):
+        ######################################################################################
+        #
+        #  Summary:  Queues an AT command and returns its ModemCommand straight away.  For
+        #  commands that take a second part, e.g. AT+CMGS, pass the Prompt the modem answers
+        #  with ('> ') and the Data to write after it, CTRL_Z included.  Timeout is how long the
+        #  modem gets to answer once the command has been written.
+        #
+        ######################################################################################
+        Queued = ModemCommand(Command, Timeout, Prompt, Data)
+        self._CommandCountLock.acquire()
+        self._CommandCount += 1
+        Count = self._CommandCount
+        self._CommandCountLock.release()
+        self._Commands.put((Priority, Count, Queued))
+        return Queued
+
+    def Execute(self, Command, Priority=PRIORITY_RECEIVE, Timeout=10, Prompt=None, Data=None):
+        ######################################################################################
+        #
+        #  Summary:  Submit() and wait for the result
+        #
+        ######################################################################################
+        return self.Submit(Command, Priority, Timeout, Prompt, Data).Result()
+
+    def GetQueuedCommandCount(self):
+        return self._Commands.qsize()
+
+    def Logger(self, message, message_importance, *Arguments):
+        #Arguments are only formatted into message if it is printed
+        if message_importance < self._DEBUG_LEVEL:
+            print message % Arguments if Arguments else message
+
+    def _DispatcherLoop(self):
+        ######################################################################################
+        #
+        #  Summary:  Writes the queued commands one at a time and waits for each to complete
+        #  before the next goes out.  After a timeout the modem is resynced first.
+        #
+        ######################################################################################
+        while self._Running:
+            Priority, Count, Command = self._Commands.get()
+            if Command==None:
+                break
+            self._SetInFlight(Command)
+            try:
+                Command.SentTime = time.time()
+                self._Serial.write(Command.Command + "\r")
+                if Command.Prompt!=None:
+                    if not Command._PromptEvent.wait(Command.Timeout):
+                        self._Serial.write(ESCAPE)   #cancel the command so the modem is usable again
+                        raise ModemTimeout("No prompt after "+Command.Command)
+                    self._Serial.write(Command.Data)
+                if not Command._Done.wait(Command.Timeout):
+                    raise ModemTimeout("No response to "+Command.Command)
+            except Exception, e:
+                self.Logger("Modem command failed: %s", 2, e)
+                Command._Complete(e if isinstance(e, ModemError) else ModemError(str(e)))
+                if isinstance(e, ModemTimeout):
+                    self._Resync()
+            self._SetInFlight(None)
+
+    def _Resync(self):
+        ######################################################################################
+        #
+        #  Summary:  Called by the dispatcher after a timeout, while the modem may still be
+        #  answering the command that timed out.  Sends AT and swallows the modem's output
+        #  until a final result code is followed by RESYNC_QUIET_SECONDS of silence:  the late
+        #  answer, if any, comes first and the AT's OK right behind it.
+        #
+        ######################################################################################
+        for Attempt in range(RESYNC_ATTEMPTS):
+            Resync = ModemCommand("AT", RESYNC_TIMEOUT, None, None)
+            self._SetInFlight(Resync)
+            try:
+                self._Serial.write("AT\r")
+            except Exception, e:
+                self.Logger("Modem resync failed: %s", 1, e)
+                return
+            if not Resync._Done.wait(RESYNC_TIMEOUT):
+                continue   #still busy, or the AT got lost; try again
+            while time.time() - self._LastOutputTime < RESYNC_QUIET_SECONDS:
+                time.sleep(RESYNC_QUIET_SECONDS)
+            if Resync.Lines!=["OK"]:
+                self.Logger("Discarded late modem output: %s", 2, Resync.Lines)
+            return
+        self.Logger("Modem didn't answer AT after a timeout; carrying on", 1)
+
+    def _SetInFlight(self, Command):
+        self._InFlightLock.acquire()
+        self._InFlight = Command
+        self._InFlightLock.release()
+
+    def _ReaderLoop(self):
+        ######################################################################################
+        #
+        #  Summary:  Reads everything the modem sends and splits it into lines:  unsolicited
+        #  lines go to NotificationCallback, the rest to the command in flight.  The '> '
+        #  prompt has no line ending, so it is recognized on its own.
+        #
+        ######################################################################################
+        Buffer = ""
+        while self._Running:
+            try:
+                Data = self._Serial.read(1)
+                if Data:
+                    Data += self._Serial.read(self._Serial.inWaiting())
+            except Exception, e:
+                if self._Running:
+                    self.Logger("Modem read failed: %s", 1, e)
+                    time.sleep(1)
+                continue
+            if not Data:
+                continue
+            Buffer += Data
+
+            while 1:
+                Stripped = Buffer.lstrip("\r\n")
+                if Stripped.startswith(">") and self._HandlePrompt():
+                    Buffer = Stripped[1:].lstrip(" ")
+                    continue
+                End = Buffer.find("\n")
+                if End < 0:
+                    break
+                Line = Buffer[:End].strip()
+                Buffer = Buffer[End+1:]
+                if Line:
+                    self._HandleLine(Line)
+
+    def _HandlePrompt(self):
+        #returns True if the command in flight was waiting for the prompt
+        self._InFlightLock.acquire()
+        Command = self._InFlight
+        self._InFlightLock.release()
+        if Command==None or Command.Prompt==None or Command._PromptEvent.isSet():
+            return False
+        Command._PromptEvent.set()
+        return True
+
+    def _HandleLine(self, Line):
+        if Line.startswith(UNSOLICITED_PREFIXES):
+            self.Logger("Modem notification: %s", 3, Line)
+            if self._NotificationCallback!=None:
+                try:
+                    self._NotificationCallback(Line)
+                except Exception, e:
+                    self.Logger("Exception in modem notification callback: %s", 1, e)
+            return
+
+        self._LastOutputTime = time.time()
+        self._InFlightLock.acquire()
+        Command = self._InFlight
+        self._InFlightLock.release()
+        if Command==None or Command.IsDone():
+            self.Logger("Unexpected modem output: %s", 3, Line)
+            return
+        if Line==Command.Command:
+            return   #echo, before ATE0 takes effect
+        Command.Lines.append(Line)
+        if Line=="OK":
+            Command._Complete()
+        elif Line.startswith(FINAL_RESULT_CODES):
+            Command._Complete(ModemError(Command.Command+": "+Line))
@@ -0,0 +1,90 @@
+
+# PayloadCodec.py
+# Summary:  Wire formats for the binary payload carried inside each text message
+# ChamBana03@gmail.com
+#
+# Every payload starts with a format byte so the receiving side can tell how the rest of
+# the payload was built.  The original format never had one, but its first byte is always
+# pylzma's properties byte (0x5D with pylzma's default settings), so it doubles as the
+# format byte and old text messages still decode.
+#
+# Format bytes taken elsewhere:  0x03/0x04 delta records (FieldCodec, stateful, decoded by
+# TextMessageTelemetry), 0x06 sequence numbered envelopes (Envelope), 0x07 parameter and
+# mission sync (StateSync), 0x0F segments (Segmentation).
+
+import binascii
+import zlib
+import pylzma
+import CompressionDictionary
+import MavlinkFraming
+
+FORMAT_LZMA_HEX = 0x5D       #original format: hexlified mavlink frames, pylzma.compress()
+FORMAT_DEFLATE = 0x01        #raw mavlink frames, headerless deflate
+FORMAT_DEFLATE_DICT = 0x02   #raw mavlink frames, headerless deflate primed with a preset dictionary;
+                             #the dictionary id follows the format byte
+FORMAT_COMPACT_DICT = 0x05   #compact frames (msgid + payload, see MavlinkFraming), deflate primed with a
+                             #preset dictionary; the dictionary id follows the format byte
+
+DEFAULT_PAYLOAD_FORMAT = FORMAT_COMPACT_DICT
+
+
+def EncodePayload(ListOfMavlinkMessages, PayloadFormat=DEFAULT_PAYLOAD_FORMAT, DictionaryId=CompressionDictionary.DEFAULT_DICTIONARY_ID):
+    ######################################################################################
+    #
+    #  Summary:  Concatenates the mavlink frames of the messages and compresses them into
+    #  a binary payload of the requested format, format byte included.  DictionaryId is
+    #  only used by the dictionary formats.
+    #
+    ######################################################################################
+    if PayloadFormat==FORMAT_COMPACT_DICT:
+        CompactMavlinkBuffer = MavlinkFraming.PackCompact(ListOfMavlinkMessages)
+        return chr(FORMAT_COMPACT_DICT) + chr(DictionaryId) + CompressionDictionary.Compress(CompactMavlinkBuffer, DictionaryId)
+
+    BufferOfMavlinkMessages = "".join([message.get_msgbuf() for message in ListOfMavlinkMessages])
+
+    if PayloadFormat==FORMAT_DEFLATE_DICT:
+        return chr(FORMAT_DEFLATE_DICT) + chr(DictionaryId) + CompressionDictionary.Compress(BufferOfMavlinkMessages, DictionaryId)
+    elif PayloadFormat==FORMAT_DEFLATE:
+        return chr(FORMAT_DEFLATE) + _DeflateRaw(BufferOfMavlinkMessages)
+    elif PayloadFormat==FORMAT_LZMA_HEX:
+        return pylzma.compress(binascii.hexlify(BufferOfMavlinkMessages))
+    else:
+        raise ValueError("Unknown payload format: "+str(PayloadFormat))
+
+
+def DecodePayload(Payload, Framing=None):
+    ######################################################################################
+    #
+    #  Summary:  Reads the format byte of a binary payload and returns the raw buffer of
+    #  concatenated mavlink frames it carries.  Raises ValueError for unknown formats.
+    #  Compact payloads are re-framed with the sequence numbers of Framing, a
+    #  MavlinkFraming.FrameBuilder; keep one per sender so its sequence numbers run on.
+    #
+    ######################################################################################
+    if len(Payload)==0:
+        raise ValueError("Empty payload")
+
+    PayloadFormat = ord(Payload[0])
+    if PayloadFormat==FORMAT_COMPACT_DICT:
+        if Framing==None:
+            Framing = MavlinkFraming.FrameBuilder()
+        return MavlinkFraming.UnpackCompact(CompressionDictionary.Decompress(Payload[2:], ord(Payload[1])), Framing)
+    elif PayloadFormat==FORMAT_DEFLATE_DICT:
+        return CompressionDictionary.Decompress(Payload[2:], ord(Payload[1]))
+    elif PayloadFormat==FORMAT_DEFLATE:
+        return _InflateRaw(Payload[1:])
+    elif PayloadFormat==FORMAT_LZMA_HEX:
+        return binascii.unhexlify(pylzma.decompress(Payload))
+    else:
+        raise ValueError("Unknown payload format: "+str(PayloadFormat))
+
+
+def _DeflateRaw(Buffer):
+    #negative window bits = raw deflate stream, no zlib header or adler32 trailer
+    Compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS, 9)
+    return Compressor.compress(Buffer) + Compressor.flush()
+
+
+def _InflateRaw(Buffer):
+    Decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    return Decompressor.decompress(Buffer) + Decompressor.flush()
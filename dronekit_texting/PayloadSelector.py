@@ -0,0 +1,192 @@
+
+# PayloadSelector.py
+# Summary:  Chooses which pending mavlink messages go in the next text message, maximizing
+# their total value within one text message
+# ChamBana03@gmail.com
+#
+# Filling a text message in queue order wastes room:  one big low priority message can push out
+# several small important ones.  This picks the subset with the most total value that still fits,
+# a 0/1 knapsack.  Compressed sizes don't add up exactly, so the knapsack runs on cheap estimates
+# (raw size scaled by the compression ratio of the last exact encode) and the result is checked
+# with a real encode, trimmed or topped up as needed.
+#
+# To keep the cost bounded on a Raspberry Pi, sizes are rounded to CAPACITY_UNITS steps of the
+# text message, at most MaxCandidates messages are considered and at most MaxEncodes exact
+# encodes are made per text message.  A selection takes a few milliseconds.
+
+import time
+
+CAPACITY_UNITS = 64
+INITIAL_ENCODED_PER_RAW_BYTE = 0.5   #typical for the compressed formats, until an exact encode tells better
+
+
+class PayloadSelector(object):
+    def __init__(self, EncodeFunction, MaxLength=160, ValueFunction=None, MandatoryFunction=None,
+                 OrderedTypes=(), MaxCandidates=48, MaxEncodes=4):
+        ######################################################################################
+        #
+        #  Summary:  EncodeFunction takes a list of mavlink messages and returns the encoded
+        #  payload (e.g. TextMessageTelemetry.EncodeOutgoingPayload), and MaxLength is the
+        #  largest payload one text message carries.  ValueFunction(message, now) scores a
+        #  message (e.g. CoalescingQueue.GetMessageValue); by default every message is worth 1,
+        #  which maximizes the message count.  Messages for which MandatoryFunction(message)
+        #  is True (e.g. CoalescingQueue.IsCritical) are always selected.  Messages of the
+        #  OrderedTypes are only ever selected oldest first, so the receiver sees them in order.
+        #
+        ######################################################################################
+        self._Encode = EncodeFunction
+        self._MaxLength = MaxLength
+        self._GetValue = ValueFunction
+        self._IsMandatory = MandatoryFunction
+        self._OrderedTypes = OrderedTypes
+        self._MaxCandidates = MaxCandidates
+        self._MaxEncodes = MaxEncodes
+        self._EncodedPerRawByte = INITIAL_ENCODED_PER_RAW_BYTE
+
+    def Select(self, ListOfMavlinkMessages, now=None):
+        ######################################################################################
+        #
+        #  Summary:  Returns (SelectedMessages, EncodedPayload, LeftoverMessages).  Both lists
+        #  keep the order of ListOfMavlinkMessages; hand the leftovers back to the queue.  The
+        #  payload fits in MaxLength unless the mandatory messages alone don't, or a single
+        #  message doesn't, in which case the caller has to segment it.  Returns
+        #  ([], None, []) for an empty list.
+        #
+        ######################################################################################
+        if len(ListOfMavlinkMessages)==0:
+            return [], None, []
+        if now==None:
+            now = time.time()
+
+        Items = []   #[Index, RawLength, Value, Mandatory, Type]
+        for Index in range(len(ListOfMavlinkMessages)):
+            MavlinkMessage = ListOfMavlinkMessages[Index]
+            Mandatory = self._IsMandatory!=None and self._IsMandatory(MavlinkMessage)
+            Value = 1.0 if self._GetValue==None else float(self._GetValue(MavlinkMessage, now))
+            Items.append([Index, len(MavlinkMessage.get_msgbuf()), Value, Mandatory, MavlinkMessage.get_type()])
+
+        Mandatory = [Item for Item in Items if Item[3]]
+        Optional = [Item for Item in Items if not Item[3]]
+        Candidates = Optional[:self._MaxCandidates]
+
+        #knapsack over the room the mandatory messages leave
+        Capacity = self._MaxLength - self.EstimateEncodedLength(sum([Item[1] for Item in Mandatory]))
+        Chosen = self._SolveKnapsack(Candidates, Capacity)
+        Selected = self._KeepOrderedPrefix(Mandatory + [Item for Item in Candidates if Item[0] in Chosen], Items)
+        if len(Selected)==0:
+            Selected = [Items[0]]   #even the smallest message looks too big; send the first one anyway
+
+        #exact check: trim the least valuable bytes until the real encode fits
+        Encodes = 0
+        Payload = self._ExactEncode(ListOfMavlinkMessages, Selected)
+        Encodes += 1
+        while len(Payload) > self._MaxLength:
+            Removable = [Item for Item in Selected if not Item[3]]
+            if len(Removable)==0 or len(Selected)==1:
+                break
+            Removable.sort(key=lambda Item: Item[2]/Item[1])
+            Excess = len(Payload) - self._MaxLength
+            Removed = set()
+            for Item in Removable:
+                if len(Selected) - len(Removed) <= 1:
+                    break
+                Removed.add(Item[0])
+                Excess -= self.EstimateEncodedLength(Item[1])
+                if Excess <= 0:
+                    break
+            Selected = self._KeepOrderedPrefix([Item for Item in Selected if Item[0] not in Removed], Items)
+            Payload = self._ExactEncode(ListOfMavlinkMessages, Selected)
+            Encodes += 1
+
+        #top up with whatever the estimates were too cautious about, while encodes last
+        SelectedIndexes = set([Item[0] for Item in Selected])
+        Remaining = [Item for Item in Candidates if Item[0] not in SelectedIndexes]
+        Remaining.sort(key=lambda Item: -Item[2]/Item[1])
+        for Item in Remaining:
+            if Encodes >= self._MaxEncodes or len(Payload) > self._MaxLength:
+                break
+            if len(Payload) + self.EstimateEncodedLength(Item[1]) > self._MaxLength:
+                continue
+            Trial = self._KeepOrderedPrefix(Selected + [Item], Items)
+            if len(Trial)==len(Selected):
+                continue
+            TrialPayload = self._ExactEncode(ListOfMavlinkMessages, Trial)
+            Encodes += 1
+            if len(TrialPayload) <= self._MaxLength:
+                Selected = Trial
+                Payload = TrialPayload
+
+        SelectedIndexes = set([Item[0] for Item in Selected])
+        SelectedMessages = [ListOfMavlinkMessages[i] for i in sorted(SelectedIndexes)]
+        LeftoverMessages = [ListOfMavlinkMessages[i] for i in range(len(ListOfMavlinkMessages)) if i not in SelectedIndexes]
+        return SelectedMessages, Payload, LeftoverMessages
+
+    def EstimateEncodedLength(self, RawLength):
+        ######################################################################################
+        #
+        #  Summary:  Estimates the encoded length of RawLength bytes of mavlink frames, scaled
+        #  by the ratio seen in the last exact encode
+        #
+        ######################################################################################
+        return int(RawLength*self._EncodedPerRawByte + 0.5)
+
+    def _SolveKnapsack(self, Candidates, Capacity):
+        ######################################################################################
+        #
+        #  Summary:  0/1 knapsack over the candidates' estimated encoded sizes, rounded up to
+        #  1/CAPACITY_UNITS of a text message.  Returns the set of chosen message indexes.
+        #
+        ######################################################################################
+        if Capacity <= 0 or len(Candidates)==0:
+            return set()
+        UnitLength = float(self._MaxLength)/CAPACITY_UNITS
+        Units = min(CAPACITY_UNITS, int(Capacity/UnitLength))
+        Weights = [max(1, int(-(-self.EstimateEncodedLength(Item[1])//UnitLength))) for Item in Candidates]
+
+        Best = [0.0]*(Units+1)
+        Taken = []
+        for i in range(len(Candidates)):
+            Weight = Weights[i]
+            Value = Candidates[i][2]
+            TakenHere = [False]*(Units+1)
+            for Room in range(Units, Weight-1, -1):
+                WithItem = Best[Room-Weight] + Value
+                if WithItem > Best[Room]:
+                    Best[Room] = WithItem
+                    TakenHere[Room] = True
+            Taken.append(TakenHere)
+
+        Chosen = set()
+        Room = Units
+        for i in range(len(Candidates)-1, -1, -1):
+            if Taken[i][Room]:
+                Chosen.add(Candidates[i][0])
+                Room -= Weights[i]
+        return Chosen
+
+    def _KeepOrderedPrefix(self, Selected, Items):
+        ######################################################################################
+        #
+        #  Summary:  Drops any ordered type message selected after an older one of its type
+        #  that wasn't, so those messages never overtake each other.  Returns the selection
+        #  sorted by index.
+        #
+        ######################################################################################
+        Selected = sorted(Selected, key=lambda Item: Item[0])
+        if len(self._OrderedTypes)==0:
+            return Selected
+        SelectedIndexes = set([Item[0] for Item in Selected])
+        FirstSkipped = {}   #ordered type -> index of its oldest message left out
+        for Item in Items:
+            if Item[4] in self._OrderedTypes and Item[4] not in FirstSkipped and Item[0] not in SelectedIndexes:
+                FirstSkipped[Item[4]] = Item[0]
+        return [Item for Item in Selected
+                if Item[3] or Item[0] < FirstSkipped.get(Item[4], len(Items))]
+
+    def _ExactEncode(self, ListOfMavlinkMessages, Selected):
+        Messages = [ListOfMavlinkMessages[Item[0]] for Item in Selected]
+        Payload = self._Encode(Messages)
+        RawLength = sum([Item[1] for Item in Selected])
+        if RawLength > 0:
+            self._EncodedPerRawByte = float(len(Payload))/RawLength
+        return Payload
@@ -0,0 +1,235 @@
+
+# RateController.py
+# Summary:  Decides how much telemetry to send, from the measured SMS latency, the modem's send
+# times and a text message budget
+# ChamBana03@gmail.com
+#
+# Sending a text message whenever one fills up works until the GSM network falls behind:  the
+# text messages then queue up on the network, hundreds of them, each one older by the time it
+# arrives.  Holding full text messages back would only make them older still, so instead the
+# controller hands out a rate scale for the per-type telemetry rates (see CoalescingQueue):
+# fewer samples per stream, so text messages fill up more slowly, but what is sent is fresh.
+#
+# Signals, each side measuring its own:
+#   -- how long AT+CMGS takes, i.e. how long the network takes to accept a text message
+#   -- the queueing delay of the text messages going out.  Every envelope carries the sender's
+#      clock (see Envelope); the receiver takes the smallest arrival minus send time seen in
+#      the last DELAY_WINDOW_SECONDS as the base latency, whatever the clock offset between
+#      the two sides, and anything above it as queueing.  It reports that back in the envelopes
+#      it sends, bare ones every FEEDBACK_SECONDS while it is above target.
+#   -- the budget:  text messages sent in the last minute and day against MaxPerMinute and
+#      MaxPerDay
+#
+# Every UPDATE_SECONDS the scale is halved if the network is congested or the send rate nears
+# the budget, and otherwise creeps back up towards 1 (AIMD, as in TCP).  A hard budget stop
+# (IsWithinBudget) is left for the critical messages that have to go out regardless.
+
+import threading
+import time
+from collections import deque
+
+TIMESTAMP_MODULUS = 65536
+TARGET_QUEUEING_DELAY = 60.0      #seconds text messages may sit on the network before backing off
+MAX_MODEM_SEND_SECONDS = 15.0     #AT+CMGS taking longer than this means the network is struggling
+MIN_RATE_SCALE = 0.05
+UPDATE_SECONDS = 30.0
+RATE_WINDOW_SECONDS = 300.0       #the send rate compared against the budget is averaged over this long
+DELAY_WINDOW_SECONDS = 3600.0     #the base latency is the smallest seen in this long
+REPORT_MAX_AGE_SECONDS = 600.0    #delay reports older than this are ignored
+FEEDBACK_SECONDS = 60.0
+
+
+def GetTimestamp(now=None):
+    if now==None:
+        now = time.time()
+    return int(now) % TIMESTAMP_MODULUS
+
+
+class RateController(object):
+    def __init__(self, MaxPerMinute=None, MaxPerDay=None, TargetQueueingDelay=TARGET_QUEUEING_DELAY,
+                 MaxModemSendSeconds=MAX_MODEM_SEND_SECONDS):
+        ######################################################################################
+        #
+        #  Summary:  MaxPerMinute and MaxPerDay are the text message budget, None for no
+        #  limit.  Thread safe.
+        #
+        ######################################################################################
+        self._MaxPerMinute = MaxPerMinute
+        self._MaxPerDay = MaxPerDay
+        self._TargetQueueingDelay = TargetQueueingDelay
+        self._MaxModemSendSeconds = MaxModemSendSeconds
+        self._Lock = threading.Lock()
+        self._SendTimes = deque()          #one entry per text message sent, oldest first
+        self._ModemSendSeconds = None      #smoothed AT+CMGS time
+        self._DelaySamples = deque()       #(time received, arrival minus send time), oldest first
+        self._FirstOffset = None
+        self._InboundDelay = None          #smoothed queueing delay of the text messages coming in
+        self._ReportedDelay = None         #the other side's InboundDelay:  our text messages' queueing delay
+        self._ReportedTime = None
+        self._LastReportSent = None
+        self._RateScale = 1.0
+        self._LastUpdate = None
+        self._HeldBack = 0                 #times IsWithinBudget() said no since the last update
+
+    def RecordSend(self, TextMessageCount=1, now=None):
+        if now==None:
+            now = time.time()
+        self._Lock.acquire()
+        try:
+            for Count in range(TextMessageCount):
+                self._SendTimes.append(now)
+            self._ForgetSends(now)
+        finally:
+            self._Lock.release()
+
+    def RecordModemSendTime(self, Seconds):
+        self._Lock.acquire()
+        try:
+            if self._ModemSendSeconds==None:
+                self._ModemSendSeconds = Seconds
+            else:
+                self._ModemSendSeconds = 0.8*self._ModemSendSeconds + 0.2*Seconds
+        finally:
+            self._Lock.release()
+
+    def RecordTimestamp(self, Timestamp, now=None):
+        ######################################################################################
+        #
+        #  Summary:  Takes the timestamp of a received envelope and updates the queueing delay
+        #  of the incoming text messages
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        self._Lock.acquire()
+        try:
+            Offset = (GetTimestamp(now) - Timestamp) % TIMESTAMP_MODULUS   #latency plus the clock offset
+            if self._FirstOffset==None:
+                self._FirstOffset = Offset
+            #unwrapped around the first sample, so the modulus never shows
+            Offset = (Offset - self._FirstOffset + TIMESTAMP_MODULUS//2) % TIMESTAMP_MODULUS - TIMESTAMP_MODULUS//2
+            self._DelaySamples.append((now, Offset))
+            while now - self._DelaySamples[0][0] > DELAY_WINDOW_SECONDS:
+                self._DelaySamples.popleft()
+            QueueingDelay = Offset - min([Sample for Received, Sample in self._DelaySamples])
+            if self._InboundDelay==None:
+                self._InboundDelay = QueueingDelay
+            else:
+                self._InboundDelay = 0.7*self._InboundDelay + 0.3*QueueingDelay
+        finally:
+            self._Lock.release()
+
+    def RecordReportedDelay(self, Delay, now=None):
+        if now==None:
+            now = time.time()
+        self._ReportedDelay = Delay
+        self._ReportedTime = now
+
+    def GetInboundDelay(self):
+        ######################################################################################
+        #
+        #  Summary:  Seconds the incoming text messages spend queued, to report back to the
+        #  other side, or None before the first timestamp
+        #
+        ######################################################################################
+        if self._InboundDelay==None:
+            return None
+        return int(self._InboundDelay + 0.5)
+
+    def ReportSent(self, now=None):
+        if now==None:
+            now = time.time()
+        self._LastReportSent = now
+
+    def GetFeedbackDeadline(self):
+        ######################################################################################
+        #
+        #  Summary:  Time by which a delay report has to go out, bare if need be, or None while
+        #  the incoming text messages are on time.  The other side can't back off unless it
+        #  hears about the delay.
+        #
+        ######################################################################################
+        if self._InboundDelay==None or self._InboundDelay <= self._TargetQueueingDelay:
+            return None
+        if self._LastReportSent==None:
+            return time.time()
+        return self._LastReportSent + FEEDBACK_SECONDS
+
+    def IsCongested(self, now=None):
+        if now==None:
+            now = time.time()
+        if self._ModemSendSeconds!=None and self._ModemSendSeconds > self._MaxModemSendSeconds:
+            return True
+        return self._ReportedDelay!=None and now - self._ReportedTime <= REPORT_MAX_AGE_SECONDS \
+            and self._ReportedDelay > self._TargetQueueingDelay
+
+    def IsWithinBudget(self, now=None):
+        ######################################################################################
+        #
+        #  Summary:  False if another text message would exceed MaxPerMinute or MaxPerDay
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        self._Lock.acquire()
+        try:
+            self._ForgetSends(now)
+            if (self._MaxPerDay!=None and len(self._SendTimes) >= self._MaxPerDay) \
+                    or (self._MaxPerMinute!=None and self._CountSendsSince(now - 60) >= self._MaxPerMinute):
+                self._HeldBack += 1
+                return False
+            return True
+        finally:
+            self._Lock.release()
+
+    def GetRateScale(self, now=None):
+        ######################################################################################
+        #
+        #  Summary:  Factor between MIN_RATE_SCALE and 1 to apply to the per-type telemetry
+        #  rates, updated every UPDATE_SECONDS
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        self._Lock.acquire()
+        try:
+            if self._LastUpdate!=None and now - self._LastUpdate < UPDATE_SECONDS:
+                return self._RateScale
+            self._LastUpdate = now
+            self._ForgetSends(now)
+            SendRate = self._CountSendsSince(now - RATE_WINDOW_SECONDS)/RATE_WINDOW_SECONDS
+            AllowedRate = self._GetAllowedRate()
+            #back off as soon as the hard budget stop holds a text message back, since that delays it
+            if self.IsCongested(now) or self._HeldBack > 0 or (AllowedRate!=None and SendRate > 0.9*AllowedRate):
+                self._RateScale = max(MIN_RATE_SCALE, self._RateScale*0.5)
+            elif AllowedRate==None or SendRate < 0.6*AllowedRate:
+                self._RateScale = min(1.0, self._RateScale + 0.1)
+            self._HeldBack = 0
+            return self._RateScale
+        finally:
+            self._Lock.release()
+
+    def _GetAllowedRate(self):
+        #text messages per second the budget allows on average, or None without a budget
+        Rates = []
+        if self._MaxPerMinute!=None:
+            Rates.append(self._MaxPerMinute/60.0)
+        if self._MaxPerDay!=None:
+            Rates.append(self._MaxPerDay/86400.0)
+        if len(Rates)==0:
+            return None
+        return min(Rates)
+
+    def _CountSendsSince(self, Since):
+        Count = 0
+        for SendTime in reversed(self._SendTimes):
+            if SendTime <= Since:
+                break
+            Count += 1
+        return Count
+
+    def _ForgetSends(self, now):
+        #caller holds the lock
+        Window = 86400 if self._MaxPerDay!=None else max(60, RATE_WINDOW_SECONDS)
+        while len(self._SendTimes) > 0 and now - self._SendTimes[0] > Window:
+            self._SendTimes.popleft()
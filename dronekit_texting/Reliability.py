@@ -0,0 +1,286 @@
+
+# Reliability.py
+# Summary:  Acks and retransmission for the payloads that must not be lost, such as commands
+# from the ground station
+# ChamBana03@gmail.com
+#
+# Telemetry is best-effort:  a lost text message is superseded by the next one.  A lost
+# COMMAND_LONG or MISSION_ITEM is not, so payloads carrying one of the ReliableTypes get a
+# reliable sequence number of their own (see Envelope) and are kept by the sender's
+# RetransmitQueue until acked.  The receiver's AckTracker acks them in the envelope of whatever
+# it sends back anyway:  a cumulative ack (everything up to here arrived) plus a bitmap of the
+# ACK_BITMAP_BITS reliable payloads after it, so a single lost text message only costs its own
+# retransmission.  A receiver with nothing to send back sends a bare ack after ACK_DELAY_SECONDS.
+#
+# The retransmit timeout follows the measured round trip (RFC 6298 smoothing, first sends only),
+# doubling on every retransmission, bounded for SMS latencies of seconds to minutes.  Each
+# sender picks a random session number when it starts, so acks meant for an earlier run of the
+# sender are ignored and the receiver starts over when the sender does.
+
+import random
+import threading
+import time
+import Envelope
+
+DEFAULT_RELIABLE_TYPES = ("COMMAND_LONG", "COMMAND_INT", "SET_MODE", "PARAM_SET", "MISSION_COUNT", "MISSION_ITEM",
+                          "MISSION_ITEM_INT", "MISSION_CLEAR_ALL", "MISSION_SET_CURRENT", "SET_HOME_POSITION")
+
+INITIAL_RETRANSMIT_SECONDS = 60.0   #until a round trip has been measured
+MIN_RETRANSMIT_SECONDS = 20.0
+MAX_RETRANSMIT_SECONDS = 600.0
+MAX_RETRANSMITS = 5                 #then the payload is given up on
+MAX_UNACKED = 64                    #base offsets are a byte, so the oldest unacked payload is given up on beyond this
+ACK_DELAY_SECONDS = 10.0            #how long an ack waits for a payload to ride on before it is sent bare
+ACK_REPEAT_SECONDS = 120.0          #acks ride on every payload for this long after the last reliable payload
+ACK_BITMAP_BITS = 16
+
+
+def _IsAtOrBefore(Sequence, Reference):
+    #True if Sequence is Reference or up to MAX_SEQUENCE_AHEAD before it, modulo the sequence space
+    return (Reference - Sequence) % Envelope.SEQUENCE_MODULUS < Envelope.MAX_SEQUENCE_AHEAD
+
+
+class RetransmitQueue(object):
+    def __init__(self):
+        ######################################################################################
+        #
+        #  Summary:  Sender side:  numbers the reliable payloads, keeps each one until it is
+        #  acked and says when it is due for retransmission.  Thread safe.
+        #
+        ######################################################################################
+        self._Lock = threading.Lock()
+        self._Session = random.randint(0, 255)
+        self._NextSequence = 0
+        self._Unacked = {}   #reliable sequence -> [Payload, FirstSent, Retransmits, Deadline]
+        self._SmoothedRoundTrip = None
+        self._RoundTripVariation = None
+        self._Timeout = INITIAL_RETRANSMIT_SECONDS
+
+    def Add(self, Payload, now=None):
+        ######################################################################################
+        #
+        #  Summary:  Takes a new reliable payload (not enveloped yet) and returns the
+        #  ReliableSequence to send it with.  Returns a list of the reliable sequences given
+        #  up on to make room as well.
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        self._Lock.acquire()
+        try:
+            GivenUp = []
+            while len(self._Unacked) >= MAX_UNACKED:
+                Oldest = self._GetOldestSequence()
+                del self._Unacked[Oldest]
+                GivenUp.append(Oldest)
+            Sequence = self._NextSequence
+            self._NextSequence = (self._NextSequence + 1) % Envelope.SEQUENCE_MODULUS
+            self._Unacked[Sequence] = [Payload, now, 0, now + self._Timeout]
+            return Sequence, GivenUp
+        finally:
+            self._Lock.release()
+
+    def GetHeader(self, Sequence):
+        ######################################################################################
+        #
+        #  Summary:  (Session, ReliableSequence, BaseOffset) for Envelope.WrapPayload(), where
+        #  BaseOffset tells the receiver how far back the oldest payload still being
+        #  retransmitted is, so it stops waiting for anything older.
+        #
+        ######################################################################################
+        self._Lock.acquire()
+        try:
+            Oldest = self._GetOldestSequence()
+            if Oldest==None:
+                Oldest = Sequence
+            return self._Session, Sequence, (Sequence - Oldest) % Envelope.SEQUENCE_MODULUS
+        finally:
+            self._Lock.release()
+
+    def Acknowledge(self, Ack, now=None):
+        ######################################################################################
+        #
+        #  Summary:  Processes a received (Session, Cumulative, Bitmap) ack and returns the
+        #  number of payloads it acked.  Acks for another session are ignored.
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        Session, Cumulative, Bitmap = Ack
+        if Session!=self._Session:
+            return 0
+        self._Lock.acquire()
+        try:
+            Acked = 0
+            for Sequence in list(self._Unacked.keys()):
+                Offset = (Sequence - Cumulative - 1) % Envelope.SEQUENCE_MODULUS
+                if _IsAtOrBefore(Sequence, Cumulative) or (Offset < ACK_BITMAP_BITS and Bitmap >> Offset & 1):
+                    Payload, FirstSent, Retransmits, Deadline = self._Unacked.pop(Sequence)
+                    if Retransmits==0:
+                        self._AddRoundTrip(now - FirstSent)   #a retransmitted payload's round trip is ambiguous
+                    Acked += 1
+            return Acked
+        finally:
+            self._Lock.release()
+
+    def TakeDue(self, now=None):
+        ######################################################################################
+        #
+        #  Summary:  Returns (ListOfDue, GivenUp):  the (ReliableSequence, Payload) tuples due
+        #  for retransmission, whose timers are backed off, and the reliable sequences given up
+        #  on after MAX_RETRANSMITS.
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        self._Lock.acquire()
+        try:
+            ListOfDue = []
+            GivenUp = []
+            for Sequence in sorted(self._Unacked.keys(), key=self._GetAge, reverse=True):
+                Entry = self._Unacked[Sequence]
+                if Entry[3] > now:
+                    continue
+                if Entry[2] >= MAX_RETRANSMITS:
+                    del self._Unacked[Sequence]
+                    GivenUp.append(Sequence)
+                    continue
+                Entry[2] += 1
+                Entry[3] = now + min(MAX_RETRANSMIT_SECONDS, self._Timeout * 2**Entry[2])
+                ListOfDue.append((Sequence, Entry[0]))
+            return ListOfDue, GivenUp
+        finally:
+            self._Lock.release()
+
+    def GetNextDeadline(self):
+        ######################################################################################
+        #
+        #  Summary:  Time at which TakeDue() will next return something, or None if nothing is
+        #  waiting for an ack
+        #
+        ######################################################################################
+        self._Lock.acquire()
+        try:
+            if len(self._Unacked)==0:
+                return None
+            return min([Entry[3] for Entry in self._Unacked.values()])
+        finally:
+            self._Lock.release()
+
+    def GetUnackedCount(self):
+        return len(self._Unacked)
+
+    def GetRetransmitTimeout(self):
+        return self._Timeout
+
+    def _GetAge(self, Sequence):
+        #how far behind the next sequence number, so the oldest payload sorts first
+        return (self._NextSequence - Sequence) % Envelope.SEQUENCE_MODULUS
+
+    def _GetOldestSequence(self):
+        #caller holds the lock
+        if len(self._Unacked)==0:
+            return None
+        return max(self._Unacked.keys(), key=self._GetAge)
+
+    def _AddRoundTrip(self, RoundTrip):
+        #RFC 6298 smoothing; caller holds the lock
+        if self._SmoothedRoundTrip==None:
+            self._SmoothedRoundTrip = RoundTrip
+            self._RoundTripVariation = RoundTrip/2
+        else:
+            self._RoundTripVariation = 0.75*self._RoundTripVariation + 0.25*abs(self._SmoothedRoundTrip - RoundTrip)
+            self._SmoothedRoundTrip = 0.875*self._SmoothedRoundTrip + 0.125*RoundTrip
+        Timeout = self._SmoothedRoundTrip + 4*self._RoundTripVariation
+        self._Timeout = max(MIN_RETRANSMIT_SECONDS, min(MAX_RETRANSMIT_SECONDS, Timeout))
+
+
+class AckTracker(object):
+    def __init__(self):
+        ######################################################################################
+        #
+        #  Summary:  Receiver side:  remembers which reliable payloads of one sender arrived,
+        #  drops retransmissions of the ones already processed and builds the acks.  Thread
+        #  safe.
+        #
+        ######################################################################################
+        self._Lock = threading.Lock()
+        self._Session = None
+        self._Cumulative = None
+        self._Received = set()     #reliable sequences received after the cumulative ack
+        self._LastReceived = None
+        self._OwedSince = None     #first reliable payload received since the last ack went out
+
+    def Receive(self, Reliable, now=None):
+        ######################################################################################
+        #
+        #  Summary:  Processes the (Session, ReliableSequence, BaseOffset) of a received
+        #  payload.  Returns True the first time the payload arrives and False for a
+        #  retransmission of one already received, which should be dropped.  Either way an ack
+        #  is owed.
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        Session, Sequence, BaseOffset = Reliable
+        Base = (Sequence - BaseOffset) % Envelope.SEQUENCE_MODULUS
+        self._Lock.acquire()
+        try:
+            if Session!=self._Session or self._Cumulative==None:
+                self._Session = Session            #first payload from this run of the sender
+                self._Cumulative = (Base - 1) % Envelope.SEQUENCE_MODULUS
+                self._Received = set()
+            elif not _IsAtOrBefore(Base, self._Cumulative):
+                self._Cumulative = (Base - 1) % Envelope.SEQUENCE_MODULUS   #the sender gave up on the ones before Base
+                self._Received = set([Received for Received in self._Received if not _IsAtOrBefore(Received, self._Cumulative)])
+
+            New = not _IsAtOrBefore(Sequence, self._Cumulative) and Sequence not in self._Received
+            if New:
+                self._Received.add(Sequence)
+                while (self._Cumulative + 1) % Envelope.SEQUENCE_MODULUS in self._Received:
+                    self._Cumulative = (self._Cumulative + 1) % Envelope.SEQUENCE_MODULUS
+                    self._Received.remove(self._Cumulative)
+            self._LastReceived = now
+            if self._OwedSince==None:
+                self._OwedSince = now
+            return New
+        finally:
+            self._Lock.release()
+
+    def GetAck(self, now=None):
+        ######################################################################################
+        #
+        #  Summary:  Returns the (Session, Cumulative, Bitmap) ack to put in the next outgoing
+        #  envelope, or None if no reliable payload arrived in the last ACK_REPEAT_SECONDS.
+        #  Bit i of the bitmap acks reliable sequence Cumulative+1+i.
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        self._Lock.acquire()
+        try:
+            if self._LastReceived==None or now - self._LastReceived > ACK_REPEAT_SECONDS:
+                return None
+            Bitmap = 0
+            for Received in self._Received:
+                Offset = (Received - self._Cumulative - 1) % Envelope.SEQUENCE_MODULUS
+                if Offset < ACK_BITMAP_BITS:
+                    Bitmap |= 1 << Offset
+            return self._Session, self._Cumulative, Bitmap
+        finally:
+            self._Lock.release()
+
+    def AckSent(self):
+        self._OwedSince = None
+
+    def GetAckDeadline(self):
+        ######################################################################################
+        #
+        #  Summary:  Time by which an owed ack has to go out, bare if need be, or None if no
+        #  ack is owed
+        #
+        ######################################################################################
+        OwedSince = self._OwedSince
+        if OwedSince==None:
+            return None
+        return OwedSince + ACK_DELAY_SECONDS
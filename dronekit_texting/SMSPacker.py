@@ -0,0 +1,140 @@
+
+# SMSPacker.py
+# Summary:  Incrementally packs outgoing Mavlink messages into text message sized payloads
+# ChamBana03@gmail.com
+#
+# Only used by benchmarks/CodecBenchmark.py, to compare payload formats by packing a log in
+# order.  The vehicle picks the messages of each text message with PayloadSelector instead.
+
+
+class SMSPacker(object):
+    def __init__(self, EncodeFunction, MaxLength=160, SafetyMargin=0.85):
+        ######################################################################################
+        #
+        #  Summary:  EncodeFunction takes a list of mavlink messages and returns the encoded
+        #  text message payload (e.g. TextMessageTelemetry.EncodeOutgoingPayload).
+        #  MaxLength is the largest payload a single text message can carry.  SafetyMargin is
+        #  the fraction of MaxLength the running size estimate has to reach before the packer
+        #  pays for an exact encode of the pending messages.
+        #
+        ######################################################################################
+        self._Encode = EncodeFunction
+        self._MaxLength = MaxLength
+        self._SafetyMargin = SafetyMargin
+        self._Messages = []
+        self._RawLength = 0
+        self._EncodedPerRawByte = None   #learned from the most recent exact encode
+        self._LastFitCount = 0           #number of messages covered by _LastFitPayload
+        self._LastFitPayload = None      #last exact encode checked to fit MaxLength
+
+    def Append(self, MavlinkMessage):
+        ######################################################################################
+        #
+        #  Summary:  Adds one mavlink message to the pending text message.  Returns None while
+        #  there is still room.  Once the message no longer fits, returns a tuple of
+        #  (ListOfMavlinkMessages, EncodedPayload):  the longest run of the pending messages whose
+        #  encode fits, and the ones after it start the next text message.
+        #  The pending messages are only re-encoded when the running size estimate gets close
+        #  to MaxLength, so the per-message cost stays flat instead of growing with the queue.
+        #  The estimate can undershoot, so a returned payload is always checked against
+        #  MaxLength; only a single message too big on its own comes back longer.
+        #
+        ######################################################################################
+        self._Messages.append(MavlinkMessage)
+        self._RawLength += len(MavlinkMessage.get_msgbuf())
+
+        if self.EstimateLength() < self._MaxLength*self._SafetyMargin:
+            return None
+
+        Payload = self._ExactEncode()
+        if len(Payload) <= self._MaxLength:
+            self._LastFitCount = len(self._Messages)
+            self._LastFitPayload = Payload
+            return None
+
+        if len(self._Messages)==1:
+            #a single message that doesn't fit on its own; hand it back so the caller can decide
+            self._Reset()
+            return [MavlinkMessage], Payload
+        return self._TakeFittingPrefix(len(self._Messages) - 1)
+
+    def Flush(self):
+        ######################################################################################
+        #
+        #  Summary:  Returns (ListOfMavlinkMessages, EncodedPayload) for the pending messages,
+        #  however few, or only as many as fit in MaxLength, in which case the rest stay
+        #  pending:  call it until it returns None to empty the packer.
+        #
+        ######################################################################################
+        if len(self._Messages)==0:
+            return None
+        return self._TakeFittingPrefix(len(self._Messages))
+
+    def EstimateLength(self):
+        ######################################################################################
+        #
+        #  Summary:  Cheap estimate of the encoded length of the pending messages (see
+        #  EstimateEncodedLength)
+        #
+        ######################################################################################
+        return self.EstimateEncodedLength(self._RawLength)
+
+    def EstimateEncodedLength(self, RawLength):
+        ######################################################################################
+        #
+        #  Summary:  Estimates the encoded length of RawLength bytes of mavlink frames, scaled
+        #  by the ratio seen in the last exact encode.  Before any exact encode has happened
+        #  there is nothing to scale by, so the estimate is pessimistic and forces one.
+        #
+        ######################################################################################
+        if self._EncodedPerRawByte==None:
+            return self._MaxLength
+        return int(RawLength*self._EncodedPerRawByte)
+
+    def Clear(self):
+        ######################################################################################
+        #
+        #  Summary:  Empties the packer without encoding and returns the messages it held
+        #
+        ######################################################################################
+        ClearedMessages = self._Messages
+        self._Reset()
+        return ClearedMessages
+
+    def GetMessageCount(self):
+        return len(self._Messages)
+
+    def _ExactEncode(self):
+        Payload = self._Encode(self._Messages)
+        if self._RawLength > 0:
+            self._EncodedPerRawByte = float(len(Payload))/self._RawLength
+        return Payload
+
+    def _TakeFittingPrefix(self, Count):
+        ######################################################################################
+        #
+        #  Summary:  Splits off and returns (ListOfMavlinkMessages, EncodedPayload) for the
+        #  first Count pending messages, or for fewer, one at a time, until their exact encode
+        #  fits in MaxLength (at least one message).  The rest stay pending.
+        #
+        ######################################################################################
+        while 1:
+            if Count==self._LastFitCount:
+                Payload = self._LastFitPayload
+                break
+            Payload = self._Encode(self._Messages[:Count])
+            if len(Payload) <= self._MaxLength or Count==1:
+                break
+            Count -= 1
+        TakenMessages = self._Messages[:Count]
+        Remaining = self._Messages[Count:]
+        self._Reset()
+        self._Messages = Remaining
+        self._RawLength = sum([len(MavlinkMessage.get_msgbuf()) for MavlinkMessage in Remaining])
+        return TakenMessages, Payload
+
+    def _Reset(self):
+        self._Messages = []
+        self._RawLength = 0
+        self._LastFitCount = 0
+        self._LastFitPayload = None
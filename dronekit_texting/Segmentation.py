@@ -0,0 +1,108 @@
+
+# Segmentation.py
+# Summary:  Splits payloads too big for one text message into numbered segments and
+# reassembles them on the receiving side
+# ChamBana03@gmail.com
+#
+# Segment layout:  [SEGMENT_MARKER][reference][index][total][slice of the payload]
+#
+# The marker takes the place of the payload format byte (see PayloadCodec), so a receiver can
+# tell segments from complete payloads.  The reference number ties the segments of one payload
+# together and wraps at 256; together with the sender's phone number it identifies the group.
+# Our own 4 byte header is used instead of a concatenated SMS user data header (6 bytes), so it
+# works the same in text and PDU mode.
+
+import time
+from collections import OrderedDict
+
+SEGMENT_MARKER = 0x0F
+SEGMENT_HEADER_LENGTH = 4
+MAX_SEGMENTS = 16
+
+
+def IsSegment(Payload):
+    return len(Payload) > 0 and ord(Payload[0])==SEGMENT_MARKER
+
+
+def SplitPayload(Payload, MaxSegmentLength, Reference):
+    ######################################################################################
+    #
+    #  Summary:  Splits a binary payload into segments of at most MaxSegmentLength bytes,
+    #  header included.  Raises ValueError if that takes more than MAX_SEGMENTS segments.
+    #
+    ######################################################################################
+    SliceLength = MaxSegmentLength - SEGMENT_HEADER_LENGTH
+    Total = (len(Payload) + SliceLength - 1)//SliceLength
+    if Total > MAX_SEGMENTS:
+        raise ValueError("Payload of "+str(len(Payload))+" bytes needs more than "+str(MAX_SEGMENTS)+" segments")
+
+    ListOfSegments = []
+    for Index in range(Total):
+        Header = chr(SEGMENT_MARKER) + chr(Reference & 0xff) + chr(Index) + chr(Total)
+        ListOfSegments.append(Header + Payload[Index*SliceLength:(Index+1)*SliceLength])
+    return ListOfSegments
+
+
+class SegmentReassembler(object):
+    def __init__(self, Timeout=600, MaxPendingGroups=32):
+        ######################################################################################
+        #
+        #  Summary:  Holds segments until every segment of their payload has arrived.  Groups
+        #  still incomplete after Timeout seconds are dropped, and at most MaxPendingGroups are
+        #  held at once (the oldest is dropped first), so segments that never arrive can't
+        #  grow memory without bound.  Text messages can sit on the GSM network for minutes,
+        #  hence the generous default timeout.
+        #
+        ######################################################################################
+        self._Timeout = Timeout
+        self._MaxPendingGroups = MaxPendingGroups
+        self._PendingGroups = OrderedDict()   #(Sender, Reference) -> [FirstSeen, Total, {Index: Slice}]
+
+    def AddSegment(self, Sender, Segment, now=None):
+        ######################################################################################
+        #
+        #  Summary:  Adds one received segment.  Returns the reassembled payload once the last
+        #  missing segment of its group arrives, otherwise None.
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        self.ExpireSegments(now)
+
+        if len(Segment) < SEGMENT_HEADER_LENGTH:
+            return None
+        Reference = ord(Segment[1])
+        Index = ord(Segment[2])
+        Total = ord(Segment[3])
+        if Total==0 or Total > MAX_SEGMENTS or Index >= Total:
+            return None
+
+        Key = (Sender, Reference)
+        Group = self._PendingGroups.get(Key)
+        if Group!=None and Group[1]!=Total:
+            #reference number wrapped around onto a stale group
+            del self._PendingGroups[Key]
+            Group = None
+        if Group==None:
+            while len(self._PendingGroups) >= self._MaxPendingGroups:
+                self._PendingGroups.popitem(last=False)
+            Group = [now, Total, {}]
+            self._PendingGroups[Key] = Group
+
+        Group[2][Index] = Segment[SEGMENT_HEADER_LENGTH:]
+        if len(Group[2]) < Total:
+            return None
+
+        del self._PendingGroups[Key]
+        return "".join([Group[2][i] for i in range(Total)])
+
+    def ExpireSegments(self, now=None):
+        if now==None:
+            now = time.time()
+        for Key in list(self._PendingGroups.keys()):
+            if now - self._PendingGroups[Key][0] <= self._Timeout:
+                break   #groups are kept in arrival order
+            del self._PendingGroups[Key]
+
+    def GetPendingGroupCount(self):
+        return len(self._PendingGroups)
@@ -0,0 +1,262 @@
+
+# SendJournal.py
+# Summary:  Append-only file journal of the outbound sends that must survive a crash or
+# reboot, e.g. acks, GCS commands and STATUSTEXT
+# ChamBana03@gmail.com
+#
+# Everything queued for sending lives in memory (CoalescingQueue, TextMessageTelemetry's send
+# queue), so a companion computer that reboots or a LaunchTelemetry.py that dies loses it.
+# For most telemetry that doesn't matter, a newer sample comes along, but an ack the GCS is
+# waiting for or a command the operator sent does.  Those are added to the journal when they
+# are queued and completed once the modem is done with them; on the next start, Open()
+# returns whatever was never completed, to be sent again.
+#
+# The file is a sequence of records:  <body length:4><kind:1><crc32 of kind+body:4><body>, an
+# ADD carrying <entry id:4><destination length:1><destination><mavlink frames> and a DONE
+# carrying the entry id.  A record torn by a crash fails its length or CRC check and ends the
+# replay there.
+#
+# Add() and Complete() only append the record to a list in memory, a few microseconds, so
+# they can be called from the DroneKit callback.  A writer thread writes whatever has
+# collected every GroupCommitSeconds and fsyncs once per batch (group commit), so a burst of
+# acks costs one fsync and telemetry that isn't journaled costs none.  A send can be lost if
+# the machine dies within GroupCommitSeconds of queueing it.  Once DONE records make up most
+# of a file bigger than CompactBytes, the live ADD records are rewritten to a new file that
+# replaces the old one by rename.
+
+import os
+import struct
+import threading
+import time
+import zlib
+
+RECORD_ADD = 1
+RECORD_DONE = 2
+RECORD_HEADER = struct.Struct("<IBI")   #body length, kind, crc32
+ENTRY_ID = struct.Struct("<I")
+MAX_RECORD_BYTES = 1024*1024            #a longer length field is a torn or corrupt record
+
+GROUP_COMMIT_SECONDS = 0.05             #records collect this long before they are written and fsynced together
+COMPACT_BYTES = 256*1024                #the file is compacted once it's bigger than this and mostly DONE records
+
+#journaled besides critical sends (acks, GCS commands):  every instance carries something the operator needs
+DEFAULT_JOURNAL_TYPES = ("STATUSTEXT",)
+
+
+class SendJournal(object):
+    def __init__(self, Path, GroupCommitSeconds=GROUP_COMMIT_SECONDS, CompactBytes=COMPACT_BYTES, MetricsRegistry=None):
+        ######################################################################################
+        #
+        #  Summary:  Journal kept in the file Path.  Nothing is read or written until Open().
+        #  fsync times and journal sizes go to MetricsRegistry (see Metrics) if given.
+        #  Thread safe.
+        #
+        ######################################################################################
+        self._Path = Path
+        self._GroupCommitSeconds = GroupCommitSeconds
+        self._CompactBytes = CompactBytes
+        self._Metrics = MetricsRegistry
+        self._Lock = threading.Lock()        #the journal's state in memory; never held across a write
+        self._WriteLock = threading.Lock()   #the file, held by whoever is writing or compacting it
+        self._Wake = threading.Event()
+        self._Records = []          #records not written yet, in order
+        self._Live = {}             #entry id -> its ADD record, for compaction
+        self._NextEntryId = 0
+        self._File = None
+        self._FileBytes = 0
+        self._LiveBytes = 0
+        self._Closed = False
+        self._Thread = None
+
+    def Open(self):
+        ######################################################################################
+        #
+        #  Summary:  Replays the journal and returns the sends that were never completed, as
+        #  a list of (EntryId, Destination, Frames) oldest first, Destination being None for
+        #  the default destination.  They stay in the journal until Complete(EntryId).  The
+        #  file is compacted on the way, and the writer thread started.
+        #
+        ######################################################################################
+        Buffer = ""
+        if os.path.exists(self._Path):
+            JournalFile = open(self._Path, "rb")
+            try:
+                Buffer = JournalFile.read()
+            finally:
+                JournalFile.close()
+        Offset = 0
+        while Offset + RECORD_HEADER.size <= len(Buffer):
+            Length, Kind, Crc = RECORD_HEADER.unpack_from(Buffer, Offset)
+            Body = Buffer[Offset + RECORD_HEADER.size:Offset + RECORD_HEADER.size + Length]
+            if Length > MAX_RECORD_BYTES or len(Body) < Length or zlib.crc32(chr(Kind) + Body) & 0xFFFFFFFF != Crc:
+                break   #torn by a crash mid-write
+            EntryId = ENTRY_ID.unpack_from(Body)[0]
+            if Kind==RECORD_ADD:
+                self._Live[EntryId] = Buffer[Offset:Offset + RECORD_HEADER.size + Length]
+            elif Kind==RECORD_DONE:
+                self._Live.pop(EntryId, None)
+            self._NextEntryId = max(self._NextEntryId, EntryId + 1)
+            Offset += RECORD_HEADER.size + Length
+        if Offset < len(Buffer):
+            print "Send journal %s:  dropped %d bytes of torn records" % (self._Path, len(Buffer) - Offset)
+
+        ListOfEntries = []
+        for EntryId in sorted(self._Live):
+            Body = self._Live[EntryId][RECORD_HEADER.size:]
+            DestinationLength = ord(Body[ENTRY_ID.size])
+            Destination = Body[ENTRY_ID.size + 1:ENTRY_ID.size + 1 + DestinationLength] or None
+            ListOfEntries.append((EntryId, Destination, Body[ENTRY_ID.size + 1 + DestinationLength:]))
+        self._Compact()
+
+        self._Thread = threading.Thread(target=self._WriterLoop)
+        self._Thread.daemon = True
+        self._Thread.start()
+        return ListOfEntries
+
+    def Add(self, Destination, Frames):
+        ######################################################################################
+        #
+        #  Summary:  Journals a send of Frames (mavlink frames back to back) to Destination
+        #  (None for the default destination) and returns its EntryId
+        #
+        ######################################################################################
+        Destination = str(Destination or "")
+        self._Lock.acquire()
+        try:
+            EntryId = self._NextEntryId
+            self._NextEntryId += 1
+            Record = _BuildRecord(RECORD_ADD, ENTRY_ID.pack(EntryId) + chr(len(Destination)) + Destination + Frames)
+            self._Live[EntryId] = Record
+            self._LiveBytes += len(Record)
+            self._Records.append(Record)
+        finally:
+            self._Lock.release()
+        if not self._Wake.is_set():
+            self._Wake.set()
+        return EntryId
+
+    def Complete(self, EntryId):
+        ######################################################################################
+        #
+        #  Summary:  Marks a send done, so it isn't sent again after a restart
+        #
+        ######################################################################################
+        self._Lock.acquire()
+        try:
+            Record = self._Live.pop(EntryId, None)
+            if Record==None:
+                return
+            self._LiveBytes -= len(Record)
+            self._Records.append(_BuildRecord(RECORD_DONE, ENTRY_ID.pack(EntryId)))
+        finally:
+            self._Lock.release()
+        if not self._Wake.is_set():
+            self._Wake.set()
+
+    def GetLiveCount(self):
+        return len(self._Live)
+
+    def Flush(self):
+        ######################################################################################
+        #
+        #  Summary:  Writes and fsyncs everything added or completed so far, from the calling
+        #  thread
+        #
+        ######################################################################################
+        self._WriteLock.acquire()
+        try:
+            self._Lock.acquire()
+            try:
+                Records, self._Records = self._Records, []
+            finally:
+                self._Lock.release()
+            if len(Records) > 0:
+                self._Write(Records)
+        finally:
+            self._WriteLock.release()
+
+    def Close(self):
+        self._Closed = True
+        self._Wake.set()
+        if self._Thread!=None:
+            self._Thread.join()
+        self.Flush()
+        if self._File!=None:
+            self._File.close()
+            self._File = None
+
+    def _WriterLoop(self):
+        while not self._Closed:
+            self._Wake.wait()
+            time.sleep(self._GroupCommitSeconds)   #let a burst collect into one write and fsync
+            self._Wake.clear()
+            try:
+                self.Flush()
+                if self._FileBytes > self._CompactBytes and self._LiveBytes*2 < self._FileBytes:
+                    self._WriteLock.acquire()
+                    try:
+                        self._Compact()
+                    finally:
+                        self._WriteLock.release()
+            except (IOError, OSError), e:
+                print "Can't write send journal: " + str(e)
+
+    def _Write(self, Records):
+        #caller holds the write lock
+        SyncStarted = time.time()
+        Buffer = "".join(Records)
+        self._File.write(Buffer)
+        self._File.flush()
+        os.fsync(self._File.fileno())
+        self._FileBytes += len(Buffer)
+        if self._Metrics!=None:
+            self._Metrics.Observe("journal_sync_seconds", time.time() - SyncStarted)
+            self._Metrics.Set("journal_live_entries", len(self._Live))
+
+    def _Compact(self):
+        ######################################################################################
+        #
+        #  Summary:  Replaces the file with one holding only the live ADD records and reopens
+        #  it for appending.  Records not written yet are dropped:  the live ADD records
+        #  already say everything they would.  Caller holds the write lock, or is Open().
+        #
+        ######################################################################################
+        self._Lock.acquire()
+        try:
+            Buffer = "".join([self._Live[EntryId] for EntryId in sorted(self._Live)])
+            self._Records = []
+            self._LiveBytes = len(Buffer)
+        finally:
+            self._Lock.release()
+        if self._File!=None:
+            self._File.close()
+        TemporaryPath = self._Path + ".tmp"
+        CompactFile = open(TemporaryPath, "wb")
+        try:
+            CompactFile.write(Buffer)
+            CompactFile.flush()
+            os.fsync(CompactFile.fileno())
+        finally:
+            CompactFile.close()
+        os.rename(TemporaryPath, self._Path)
+        _SyncDirectory(self._Path)
+        self._File = open(self._Path, "ab")
+        self._FileBytes = len(Buffer)
+
+
+def _BuildRecord(Kind, Body):
+    return RECORD_HEADER.pack(len(Body), Kind, zlib.crc32(chr(Kind) + Body) & 0xFFFFFFFF) + Body
+
+
+def _SyncDirectory(Path):
+    #makes a rename durable; not every platform can open a directory
+    try:
+        DirectoryHandle = os.open(os.path.dirname(os.path.abspath(Path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(DirectoryHandle)
+    except OSError:
+        pass
+    finally:
+        os.close(DirectoryHandle)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+# SmsPdu.py
+# Summary:  Minimal SMS PDU (3GPP TS 23.040) encoder/decoder for sending binary payloads
+# ChamBana03@gmail.com
+#
+# In text mode the modem only accepts characters, so payloads have to be Base64'd and a text
+# message carries 160 * 6 bits = 120 bytes.  In PDU mode we hand the modem a complete SMS-SUBMIT
+# with the 8-bit data coding scheme, so a text message carries the full 140 bytes of user data.
+# Modem libraries such as python-gsmmodem only encode GSM 7-bit and UCS2 text, hence this module.
+# The network's side, DecodeSubmitPdu() and EncodeDeliverPdu(), is what the fake modem of
+# benchmarks/SmsNetworkSimulator.py speaks.
+
+import time
+
+MAX_USER_DATA_LENGTH = 140
+
+DATA_CODING_GSM7 = 0x00
+DATA_CODING_8BIT = 0x04
+DATA_CODING_UCS2 = 0x08
+
+#GSM 03.38 default alphabet, indexed by septet value
+GSM7_BASIC = (u"@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+              u"¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+
+
+def EncodeSubmitPdu(PhoneNumber, UserData):
+    ######################################################################################
+    #
+    #  Summary:  Builds an SMS-SUBMIT PDU carrying UserData (a binary string of at most 140
+    #  bytes) with the 8-bit data coding scheme.  Returns (PduHexString, TpduLength); the
+    #  TPDU length is what AT+CMGS expects and excludes the (empty) SMSC field.
+    #
+    ######################################################################################
+    if len(UserData) > MAX_USER_DATA_LENGTH:
+        raise ValueError("SMS user data is limited to "+str(MAX_USER_DATA_LENGTH)+" bytes")
+
+    Tpdu = chr(0x01)                   #SMS-SUBMIT, no validity period, no UDH
+    Tpdu += chr(0x00)                  #message reference, filled in by the modem
+    Tpdu += _EncodeAddress(PhoneNumber)
+    Tpdu += chr(0x00)                  #protocol identifier
+    Tpdu += chr(DATA_CODING_8BIT)
+    Tpdu += chr(len(UserData))
+    Tpdu += UserData
+
+    Pdu = chr(0x00) + Tpdu             #use the SMSC stored in the SIM
+    return Pdu.encode("hex").upper(), len(Tpdu)
+
+
+def DecodeDeliverPdu(PduHexString):
+    ######################################################################################
+    #
+    #  Summary:  Decodes an SMS-DELIVER PDU as listed by AT+CMGL/AT+CMGR in PDU mode.
+    #  Returns (Sender, DataCoding, UserData).  For DATA_CODING_8BIT, UserData is the raw
+    #  binary string; for GSM 7-bit and UCS2 it is the decoded unicode text.  A user data
+    #  header, if present, is stripped.
+    #
+    ######################################################################################
+    Pdu = PduHexString.strip().decode("hex")
+    Offset = 1 + ord(Pdu[0])           #skip the SMSC field
+
+    FirstOctet = ord(Pdu[Offset])
+    HasUserDataHeader = (FirstOctet & 0x40)!=0
+    Offset += 1
+
+    AddressDigits = ord(Pdu[Offset])
+    AddressType = ord(Pdu[Offset+1])
+    AddressOctets = (AddressDigits+1)//2
+    Sender = _DecodeAddress(AddressType, AddressDigits, Pdu[Offset+2:Offset+2+AddressOctets])
+    Offset += 2 + AddressOctets
+
+    Offset += 1                        #protocol identifier
+    DataCodingScheme = ord(Pdu[Offset])
+    Offset += 1
+    Offset += 7                        #service centre time stamp
+    UserDataLength = ord(Pdu[Offset])
+    Offset += 1
+    UserData = Pdu[Offset:]
+
+    DataCoding = _GetAlphabet(DataCodingScheme)
+    if DataCoding==DATA_CODING_GSM7:
+        HeaderSeptets = 0
+        FillBits = 0
+        if HasUserDataHeader:
+            HeaderBits = (ord(UserData[0])+1)*8
+            HeaderSeptets = (HeaderBits+6)//7
+            FillBits = HeaderSeptets*7 - HeaderBits
+            UserData = UserData[ord(UserData[0])+1:]
+        Septets = _UnpackSeptets(UserData, UserDataLength-HeaderSeptets, FillBits)
+        return Sender, DataCoding, u"".join([GSM7_BASIC[Septet] for Septet in Septets])
+
+    UserData = UserData[:UserDataLength]
+    if HasUserDataHeader:
+        UserData = UserData[ord(UserData[0])+1:]
+    if DataCoding==DATA_CODING_UCS2:
+        return Sender, DataCoding, UserData.decode("utf-16-be")
+    return Sender, DataCoding, UserData
+
+
+def DecodeSubmitPdu(PduHexString):
+    ######################################################################################
+    #
+    #  Summary:  Decodes an SMS-SUBMIT PDU as built by EncodeSubmitPdu(), SMSC field
+    #  included.  Returns (PhoneNumber, DataCoding, UserData) like DecodeDeliverPdu().  Only
+    #  the 8-bit and GSM 7-bit alphabets, without a user data header, are supported.
+    #
+    ######################################################################################
+    Pdu = PduHexString.strip().decode("hex")
+    Offset = 1 + ord(Pdu[0])           #skip the SMSC field
+
+    FirstOctet = ord(Pdu[Offset])
+    Offset += 2                        #first octet, message reference
+
+    AddressDigits = ord(Pdu[Offset])
+    AddressType = ord(Pdu[Offset+1])
+    AddressOctets = (AddressDigits+1)//2
+    PhoneNumber = _DecodeAddress(AddressType, AddressDigits, Pdu[Offset+2:Offset+2+AddressOctets])
+    Offset += 2 + AddressOctets
+
+    Offset += 1                        #protocol identifier
+    DataCoding = _GetAlphabet(ord(Pdu[Offset]))
+    Offset += 1
+    ValidityPeriodFormat = (FirstOctet >> 3) & 0x03
+    if ValidityPeriodFormat==0x02:
+        Offset += 1                    #relative
+    elif ValidityPeriodFormat!=0x00:
+        Offset += 7                    #absolute or enhanced
+    UserDataLength = ord(Pdu[Offset])
+    UserData = Pdu[Offset+1:]
+
+    if DataCoding==DATA_CODING_GSM7:
+        return PhoneNumber, DataCoding, u"".join([GSM7_BASIC[Septet] for Septet in _UnpackSeptets(UserData, UserDataLength)])
+    return PhoneNumber, DataCoding, UserData[:UserDataLength]
+
+
+def EncodeDeliverPdu(Sender, UserData, DataCoding=DATA_CODING_8BIT, Timestamp=None):
+    ######################################################################################
+    #
+    #  Summary:  Builds the SMS-DELIVER PDU a modem lists for a received text message, as a
+    #  hex string with an empty SMSC field.  UserData is a binary string for
+    #  DATA_CODING_8BIT and text in the GSM 7-bit basic alphabet for DATA_CODING_GSM7.
+    #  Timestamp is the service centre time stamp, seconds since the epoch, now if None.
+    #
+    ######################################################################################
+    if Timestamp==None:
+        Timestamp = time.time()
+    Stamp = time.gmtime(Timestamp)
+    Pdu = chr(0x00)                    #no SMSC
+    Pdu += chr(0x04)                   #SMS-DELIVER, no more messages to send
+    Pdu += _EncodeAddress(Sender)
+    Pdu += chr(0x00)                   #protocol identifier
+    Pdu += chr(DataCoding)
+    Pdu += _EncodeSemiOctets("%02d%02d%02d%02d%02d%02d00" % (Stamp.tm_year % 100, Stamp.tm_mon, Stamp.tm_mday,
+                                                             Stamp.tm_hour, Stamp.tm_min, Stamp.tm_sec))
+    if DataCoding==DATA_CODING_GSM7:
+        Septets = [GSM7_BASIC.index(Character) for Character in unicode(UserData)]
+        Pdu += chr(len(Septets)) + _PackSeptets(Septets)
+    else:
+        Pdu += chr(len(UserData)) + UserData
+    return Pdu.encode("hex").upper()
+
+
+def _GetAlphabet(DataCodingScheme):
+    CodingGroup = DataCodingScheme & 0xF0
+    if CodingGroup==0xF0:
+        return DATA_CODING_8BIT if (DataCodingScheme & 0x04) else DATA_CODING_GSM7
+    if CodingGroup < 0x80:
+        return DataCodingScheme & 0x0C
+    return DATA_CODING_GSM7
+
+
+def _EncodeAddress(PhoneNumber):
+    if PhoneNumber.startswith("+"):
+        AddressType = 0x91             #international
+        PhoneNumber = PhoneNumber[1:]
+    else:
+        AddressType = 0x81             #unknown numbering plan, e.g. national number
+    return chr(len(PhoneNumber)) + chr(AddressType) + _EncodeSemiOctets(PhoneNumber)
+
+
+def _DecodeAddress(AddressType, AddressDigits, AddressOctets):
+    if (AddressType & 0x70)==0x50:     #alphanumeric sender, e.g. a carrier name
+        Septets = _UnpackSeptets(AddressOctets, (AddressDigits*4)//7)
+        return u"".join([GSM7_BASIC[Septet] for Septet in Septets])
+    Digits = _DecodeSemiOctets(AddressOctets)[:AddressDigits]
+    if (AddressType & 0x70)==0x10:
+        return "+" + Digits
+    return Digits
+
+
+def _EncodeSemiOctets(Digits):
+    if len(Digits) % 2:
+        Digits += "F"
+    return "".join([chr(int(Digits[i+1]+Digits[i], 16)) for i in range(0, len(Digits), 2)])
+
+
+def _DecodeSemiOctets(Octets):
+    Digits = ""
+    for Octet in Octets:
+        Digits += "%X%X" % (ord(Octet) & 0x0F, ord(Octet) >> 4)
+    return Digits.rstrip("F")
+
+
+def _UnpackSeptets(Octets, NumberOfSeptets, FillBits=0):
+    Bits = 0
+    for Octet in reversed(Octets):
+        Bits = (Bits << 8) | ord(Octet)
+    Bits >>= FillBits
+    return [(Bits >> (7*i)) & 0x7F for i in range(NumberOfSeptets)]
+
+
+def _PackSeptets(Septets):
+    Bits = 0
+    for Septet in reversed(Septets):
+        Bits = (Bits << 7) | Septet
+    return "".join([chr((Bits >> (8*i)) & 0xFF) for i in range((len(Septets)*7 + 7)//8)])
@@ -0,0 +1,376 @@
+
+# StateSync.py
+# Summary:  Keeps the ground station's copy of the vehicle's parameters and mission in step
+# by exchanging hashes, so only the entries that differ go over SMS
+# ChamBana03@gmail.com
+#
+# Pulling the parameter list the MAVLink way is hundreds of PARAM_VALUE messages, dozens of
+# text messages, every time the GCS connects.  Instead both ends keep a SyncTable of the
+# entries (parameter id -> value, mission seq -> item), hashed into a tree:  the entries are
+# spread over FANOUT**DEPTH buckets by a hash of their key, and every node's hash covers the
+# FANOUT nodes below it.  One side sends the hashes of some nodes at one level; the other side
+# answers with the hashes one level down, but only under the nodes that differ, and so on
+# until the differing buckets are found and their entries sent in full.  The vehicle's copy is
+# authoritative:  it sends the entries, the ground station replaces its buckets with them.
+#
+# An unchanged table costs one text message (the vehicle announces its root hash after a
+# change and the ground station finds it matches) or two (the ground station asks, the vehicle
+# says it matches).  One changed parameter costs five.  Sync payloads go reliable, so a lost
+# text message is retransmitted rather than stalling the sync.
+#
+# Sync payload:  [SYNC_MARKER][kind][table] followed by
+#   KIND_HASHES:   [level][node count, 2 bytes]([node index, 2 bytes][hash])*
+#   KIND_WANT:     [bucket count, 2 bytes]([bucket, 2 bytes])*
+#   KIND_ENTRIES:  [flags] then headerless deflate of
+#                  [bucket count, 2 bytes]([bucket, 2 bytes])*[entry count, 2 bytes]([key length][key][value length][value])*
+#   KIND_MATCH:    nothing
+# The format byte takes the place of PayloadCodec's, so TextMessageTelemetry hands sync
+# payloads to the handler registered for it (SetPayloadHandler) instead of decoding them.
+
+import binascii
+import hashlib
+import struct
+import threading
+import time
+import zlib
+import MavlinkFraming
+
+SYNC_MARKER = 0x07
+
+KIND_HASHES = 1
+KIND_WANT = 2
+KIND_ENTRIES = 3
+KIND_MATCH = 4
+
+TABLE_PARAMS = 0
+TABLE_MISSION = 1
+
+FLAG_LAST = 0x01          #the last ENTRIES payload of an answer
+
+FANOUT = 16
+DEPTH = 2                 #FANOUT**DEPTH buckets
+HASH_LENGTH = 4
+MAX_ENTRIES_BYTES = 1500  #entries per payload before deflate, so a payload stays within Segmentation's 16 segments
+SETTLE_SECONDS = 30.0     #a changed table is announced once it has stopped changing for this long
+
+PARAM_INDEX_UNKNOWN = 65535
+MISSION_TARGET_FIELDS = ("target_system", "target_component")   #zeroed in synced items, they depend on who asked
+
+
+def IsSyncPayload(Payload):
+    return len(Payload) > 0 and ord(Payload[0])==SYNC_MARKER
+
+
+def _Hash(Buffer):
+    return hashlib.sha1(Buffer).digest()[:HASH_LENGTH]
+
+
+class SyncTable(object):
+    def __init__(self, Depth=DEPTH):
+        ######################################################################################
+        #
+        #  Summary:  Key -> value table with a hash tree over its buckets.  Keys and values
+        #  are byte strings of up to 255 bytes.  Thread safe.
+        #
+        ######################################################################################
+        self._Depth = Depth
+        self._BucketCount = FANOUT**Depth
+        self._Lock = threading.Lock()
+        self._Entries = {}         #key -> value
+        self._Buckets = {}         #bucket -> set of keys
+        self._BucketHashes = {}    #bucket -> hash, dropped when the bucket changes
+
+    def GetDepth(self):
+        return self._Depth
+
+    def GetBucket(self, Key):
+        return (binascii.crc32(Key) & 0xffffffff) % self._BucketCount
+
+    def Set(self, Key, Value):
+        ######################################################################################
+        #
+        #  Summary:  Stores an entry and returns True if that changed the table
+        #
+        ######################################################################################
+        self._Lock.acquire()
+        try:
+            if self._Entries.get(Key)==Value:
+                return False
+            Bucket = self.GetBucket(Key)
+            self._Entries[Key] = Value
+            self._Buckets.setdefault(Bucket, set()).add(Key)
+            self._BucketHashes.pop(Bucket, None)
+            return True
+        finally:
+            self._Lock.release()
+
+    def Delete(self, Key):
+        self._Lock.acquire()
+        try:
+            if Key not in self._Entries:
+                return False
+            Bucket = self.GetBucket(Key)
+            del self._Entries[Key]
+            self._Buckets[Bucket].discard(Key)
+            self._BucketHashes.pop(Bucket, None)
+            return True
+        finally:
+            self._Lock.release()
+
+    def Get(self, Key):
+        return self._Entries.get(Key)
+
+    def GetItems(self):
+        self._Lock.acquire()
+        try:
+            return sorted(self._Entries.items())
+        finally:
+            self._Lock.release()
+
+    def GetEntries(self, Bucket):
+        self._Lock.acquire()
+        try:
+            return sorted([(Key, self._Entries[Key]) for Key in self._Buckets.get(Bucket, ())])
+        finally:
+            self._Lock.release()
+
+    def ReplaceBucket(self, Bucket, Entries):
+        ######################################################################################
+        #
+        #  Summary:  Makes a bucket hold exactly Entries, a list of (Key, Value)
+        #
+        ######################################################################################
+        self._Lock.acquire()
+        try:
+            for Key in self._Buckets.get(Bucket, ()):
+                del self._Entries[Key]
+            self._Buckets[Bucket] = set()
+            for Key, Value in Entries:
+                self._Entries[Key] = Value
+                self._Buckets[Bucket].add(Key)
+            self._BucketHashes.pop(Bucket, None)
+        finally:
+            self._Lock.release()
+
+    def GetNodeHash(self, Level, Index):
+        ######################################################################################
+        #
+        #  Summary:  Hash of node Index at Level, 0 being the root and the table's depth the
+        #  buckets
+        #
+        ######################################################################################
+        self._Lock.acquire()
+        try:
+            return self._GetNodeHash(Level, Index)
+        finally:
+            self._Lock.release()
+
+    def _GetNodeHash(self, Level, Index):
+        #caller holds the lock
+        if Level==self._Depth:
+            if Index not in self._BucketHashes:
+                Entries = sorted([(Key, self._Entries[Key]) for Key in self._Buckets.get(Index, ())])
+                self._BucketHashes[Index] = _Hash("".join([chr(len(Key)) + Key + chr(len(Value)) + Value for Key, Value in Entries]))
+            return self._BucketHashes[Index]
+        return _Hash("".join([self._GetNodeHash(Level + 1, Index*FANOUT + Child) for Child in range(FANOUT)]))
+
+
+class StateSync(object):
+    def __init__(self, SendFunction, Authoritative, SyncedCallback=None, DEBUG_LEVEL=2):
+        ######################################################################################
+        #
+        #  Summary:  One end of the sync with one remote.  SendFunction(Payload) sends a sync
+        #  payload reliably to the remote, e.g. TextMessageTelemetry.SubmitPayload().  The
+        #  Authoritative end (the vehicle) sends entries; the other end (the ground station)
+        #  takes them and calls SyncedCallback(Table, SyncTable) once its copy matches.
+        #
+        ######################################################################################
+        self._Send = SendFunction
+        self._Authoritative = Authoritative
+        self._SyncedCallback = SyncedCallback
+        self._DEBUG_LEVEL = DEBUG_LEVEL
+        self._Tables = {TABLE_PARAMS: SyncTable(), TABLE_MISSION: SyncTable()}
+        self._Synced = {}           #table -> True once the last sync completed
+        self._ChangedAt = {}        #table -> time of its first change not announced yet
+        self._MissionCount = None
+
+    def GetTable(self, Table):
+        return self._Tables[Table]
+
+    def IsSynced(self, Table):
+        return self._Synced.get(Table, False)
+
+    def Start(self, Table):
+        ######################################################################################
+        #
+        #  Summary:  Sends the table's root hash, which starts a sync from either end
+        #
+        ######################################################################################
+        self._ChangedAt.pop(Table, None)
+        if not self._Authoritative:
+            self._Synced[Table] = False
+        self._SendHashes(Table, 0, [0])
+
+    def Poll(self, now=None):
+        ######################################################################################
+        #
+        #  Summary:  Announces the tables that changed and then settled for SETTLE_SECONDS.
+        #  Call it every few seconds on the authoritative end.
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        for Table, ChangedAt in list(self._ChangedAt.items()):
+            if now - ChangedAt >= SETTLE_SECONDS:
+                self.Logger("Announcing changed sync table %s", 3, Table)
+                self.Start(Table)
+
+    def RecordMavlink(self, MavlinkMessage, now=None):
+        ######################################################################################
+        #
+        #  Summary:  Updates the tables from a parameter or mission message seen on the link
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        Type = MavlinkMessage.get_type()
+        Changed = False
+        if Type=="PARAM_VALUE":
+            Table = TABLE_PARAMS
+            Key = str(MavlinkMessage.param_id).rstrip("\0")
+            Index = MavlinkMessage.param_index
+            if Index==PARAM_INDEX_UNKNOWN:
+                Known = self._Tables[Table].Get(Key)
+                if Known==None:
+                    return   #not seen in a listing yet, so its index is unknown
+                Index = struct.unpack("<fHHB", Known)[1]
+            Value = struct.pack("<fHHB", MavlinkMessage.param_value, Index, MavlinkMessage.param_count, MavlinkMessage.param_type)
+            Changed = self._Tables[Table].Set(Key, Value)
+        elif Type=="MISSION_COUNT":
+            Table = TABLE_MISSION
+            self._MissionCount = MavlinkMessage.count
+            for Key, Value in self._Tables[Table].GetItems():
+                if struct.unpack("<H", Key)[0] >= MavlinkMessage.count:
+                    Changed = self._Tables[Table].Delete(Key) or Changed
+        elif Type in ("MISSION_ITEM", "MISSION_ITEM_INT"):
+            Table = TABLE_MISSION
+            if self._MissionCount!=None and MavlinkMessage.seq >= self._MissionCount:
+                return
+            Sequence, SystemId, ComponentId, MessageId, Payload = MavlinkFraming.SplitFrame(MavlinkMessage.get_msgbuf())
+            for FieldName in MISSION_TARGET_FIELDS:
+                Offset = MavlinkFraming.GetFieldOffset(MessageId, FieldName)
+                if Offset!=None:
+                    Payload = Payload[:Offset] + "\0" + Payload[Offset+1:]
+            Changed = self._Tables[Table].Set(struct.pack("<H", MavlinkMessage.seq), chr(MessageId) + Payload)
+        else:
+            return
+        if Changed and self._Authoritative and Table not in self._ChangedAt:
+            self._ChangedAt[Table] = now
+
+    def HandlePayload(self, Payload):
+        ######################################################################################
+        #
+        #  Summary:  Processes a sync payload from the remote and sends whatever it calls for
+        #
+        ######################################################################################
+        try:
+            Kind, Table = ord(Payload[1]), ord(Payload[2])
+            if Table not in self._Tables:
+                raise ValueError("unknown table "+str(Table))
+            if Kind==KIND_HASHES:
+                self._HandleHashes(Table, Payload[3:])
+            elif Kind==KIND_WANT:
+                Count = struct.unpack("<H", Payload[3:5])[0]
+                self._SendEntries(Table, list(struct.unpack("<"+str(Count)+"H", Payload[5:5+2*Count])))
+            elif Kind==KIND_ENTRIES:
+                self._HandleEntries(Table, ord(Payload[3]), Payload[4:])
+            elif Kind==KIND_MATCH:
+                self._SetSynced(Table)
+            else:
+                raise ValueError("unknown kind "+str(Kind))
+        except (IndexError, ValueError, struct.error, zlib.error), e:
+            self.Logger("Skipping bad sync payload: %s", 1, e)
+
+    def _HandleHashes(self, Table, Body):
+        Level = ord(Body[0])
+        Count = struct.unpack("<H", Body[1:3])[0]
+        SyncedTable = self._Tables[Table]
+        if Level==0 and self._Authoritative:
+            self._ChangedAt.pop(Table, None)   #the remote started a sync, which covers the changes so far
+        Differing = []
+        for Offset in range(3, 3 + Count*(2 + HASH_LENGTH), 2 + HASH_LENGTH):
+            Index = struct.unpack("<H", Body[Offset:Offset+2])[0]
+            if SyncedTable.GetNodeHash(Level, Index)!=Body[Offset+2:Offset+2+HASH_LENGTH]:
+                Differing.append(Index)
+        if len(Differing)==0:
+            if self._Authoritative:
+                self._Send(chr(SYNC_MARKER) + chr(KIND_MATCH) + chr(Table))
+            else:
+                self._SetSynced(Table)
+        elif Level < SyncedTable.GetDepth():
+            self._SendHashes(Table, Level + 1, [Index*FANOUT + Child for Index in Differing for Child in range(FANOUT)])
+        elif self._Authoritative:
+            self._SendEntries(Table, Differing)
+        else:
+            self._Send(chr(SYNC_MARKER) + chr(KIND_WANT) + chr(Table) + struct.pack("<H"+str(len(Differing))+"H", len(Differing), *Differing))
+
+    def _SendHashes(self, Table, Level, Indexes):
+        SyncedTable = self._Tables[Table]
+        Nodes = "".join([struct.pack("<H", Index) + SyncedTable.GetNodeHash(Level, Index) for Index in Indexes])
+        self._Send(chr(SYNC_MARKER) + chr(KIND_HASHES) + chr(Table) + chr(Level) + struct.pack("<H", len(Indexes)) + Nodes)
+
+    def _SendEntries(self, Table, Buckets):
+        #whole buckets per payload, so each payload can be applied on its own
+        SyncedTable = self._Tables[Table]
+        Chunks = []
+        for Bucket in Buckets:
+            Entries = SyncedTable.GetEntries(Bucket)
+            Length = sum([2 + len(Key) + len(Value) for Key, Value in Entries])
+            if len(Chunks)==0 or (Chunks[-1][2] > 0 and Chunks[-1][2] + Length > MAX_ENTRIES_BYTES):
+                Chunks.append([[], [], 0])
+            Chunks[-1][0].append(Bucket)
+            Chunks[-1][1] += Entries
+            Chunks[-1][2] += Length
+        self.Logger("Sending %s changed buckets of sync table %s", 2, len(Buckets), Table)
+        for Number in range(len(Chunks)):
+            ChunkBuckets, Entries, Length = Chunks[Number]
+            Body = struct.pack("<H", len(ChunkBuckets)) + struct.pack("<"+str(len(ChunkBuckets))+"H", *ChunkBuckets)
+            Body += struct.pack("<H", len(Entries)) + "".join([chr(len(Key)) + Key + chr(len(Value)) + Value for Key, Value in Entries])
+            Flags = FLAG_LAST if Number==len(Chunks) - 1 else 0
+            Compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS, 9)
+            self._Send(chr(SYNC_MARKER) + chr(KIND_ENTRIES) + chr(Table) + chr(Flags) + Compressor.compress(Body) + Compressor.flush())
+
+    def _HandleEntries(self, Table, Flags, Body):
+        Decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        Body = Decompressor.decompress(Body) + Decompressor.flush()
+        BucketCount = struct.unpack("<H", Body[:2])[0]
+        Buckets = struct.unpack("<"+str(BucketCount)+"H", Body[2:2+2*BucketCount])
+        Offset = 2 + 2*BucketCount
+        EntryCount = struct.unpack("<H", Body[Offset:Offset+2])[0]
+        Offset += 2
+        Entries = {}
+        for Number in range(EntryCount):
+            KeyLength = ord(Body[Offset])
+            Key = Body[Offset+1:Offset+1+KeyLength]
+            Offset += 1 + KeyLength
+            ValueLength = ord(Body[Offset])
+            Value = Body[Offset+1:Offset+1+ValueLength]
+            Offset += 1 + ValueLength
+            Entries.setdefault(self._Tables[Table].GetBucket(Key), []).append((Key, Value))
+        for Bucket in Buckets:
+            self._Tables[Table].ReplaceBucket(Bucket, Entries.get(Bucket, []))
+        if Flags & FLAG_LAST:
+            self._SetSynced(Table)
+
+    def _SetSynced(self, Table):
+        if self._Authoritative:
+            return
+        self._Synced[Table] = True
+        self.Logger("Sync table %s is in step", 2, Table)
+        if self._SyncedCallback!=None:
+            self._SyncedCallback(Table, self._Tables[Table])
+
+    def Logger(self, message, message_importance, *Arguments):
+        #Arguments are only formatted into message if it is printed
+        if message_importance < self._DEBUG_LEVEL:
+            print message % Arguments if Arguments else message
@@ -0,0 +1,304 @@
+
+# TelemetryRecorder.py
+# Summary:  Records what the ground station receives, the decoded mavlink stream as a tlog and
+# the raw text messages beside it, with an index for fast queries after the flight
+# ChamBana03@gmail.com
+#
+# A recording is three files:
+#   -- <path>:  the frames handed to the GCS, as a tlog (an 8 byte big endian microsecond
+#      timestamp before each frame) that MAVProxy, mavlogdump.py, APM Planner, ... can open
+#   -- <path>.sms:  every text message as read from the modem, with its arrival time, sender
+#      and the send time from its envelope
+#   -- <path>.idx:  one INDEX_ENTRY per frame or text message, in arrival order:  its time,
+#      where it is in the tlog or .sms file, its length and its message id (SMS_ENTRY for a
+#      text message)
+#
+# Index entries have a fixed size and arrive in time order, so TelemetryLog finds the first
+# entry of a time range by binary search with a handful of seeks, then reads the index entries
+# of the range and seeks straight to the records of the types asked for.  Neither the tlog nor
+# the .sms file is ever scanned.
+#
+# Record() and RecordTextMessage() only append to a list in memory.  A writer thread builds
+# the records and index entries and writes them in one batch every FlushSeconds, the index
+# last so it never points past the data, so recording adds nothing to the forwarding loop.
+# Recording into an existing file appends to it.
+#
+# LoadTelemetryLog() reads any plain tlog, e.g. one saved by a GCS, for the benchmarks and tools.
+
+import os
+import struct
+import threading
+import time
+import Envelope
+import Segmentation
+from pymavlink import mavlinkv10 as mavlink
+
+FLUSH_SECONDS = 1.0
+TLOG_TIMESTAMP = struct.Struct(">Q")     #microseconds, as mavutil reads tlogs
+INDEX_ENTRY = struct.Struct("<dQHH")     #time, offset in the tlog or .sms file, length, message id or SMS_ENTRY
+SMS_HEADER = struct.Struct("<dlB")       #arrival time, envelope send time (-1 if none), sender length
+SMS_ENTRY = 0xFFFF                       #message id of a text message's index entry
+NO_TIMESTAMP = -1
+
+
+class TelemetryRecorder(object):
+    def __init__(self, Path, FlushSeconds=FLUSH_SECONDS):
+        ######################################################################################
+        #
+        #  Summary:  Records into Path, Path.sms and Path.idx, appending if they exist.
+        #  Thread safe.  Nothing is written until Start().
+        #
+        ######################################################################################
+        self._Path = Path
+        self._FlushSeconds = FlushSeconds
+        self._Lock = threading.Lock()
+        self._Pending = []   #(time, frame) or (time, (sender, payload)) not written yet
+        self._Stop = threading.Event()
+        self._Thread = None
+        self._TlogFile = None
+        self._SmsFile = None
+        self._IndexFile = None
+        self._TlogBytes = 0
+        self._SmsBytes = 0
+
+    def Start(self):
+        self._TlogFile = open(self._Path, "ab")
+        self._SmsFile = open(self._Path + ".sms", "ab")
+        self._IndexFile = open(self._Path + ".idx", "ab")
+        IndexBytes = os.path.getsize(self._Path + ".idx")
+        if IndexBytes % INDEX_ENTRY.size!=0:
+            self._IndexFile.truncate(IndexBytes - IndexBytes % INDEX_ENTRY.size)   #an entry torn by a crash
+        self._TlogBytes = os.path.getsize(self._Path)
+        self._SmsBytes = os.path.getsize(self._Path + ".sms")
+        self._Thread = threading.Thread(target=self._WriterLoop)
+        self._Thread.daemon = True
+        self._Thread.start()
+
+    def Record(self, Frame, now=None):
+        #a mavlink frame as handed to the GCS
+        if now==None:
+            now = time.time()
+        self._Lock.acquire()
+        try:
+            self._Pending.append((now, Frame))
+        finally:
+            self._Lock.release()
+
+    def RecordTextMessage(self, Sender, Payload, now=None):
+        #a text message's binary payload as read from the modem (see TextMessageTelemetry.SetReceiveObserver)
+        if now==None:
+            now = time.time()
+        self._Lock.acquire()
+        try:
+            self._Pending.append((now, (Sender, Payload)))
+        finally:
+            self._Lock.release()
+
+    def Close(self):
+        self._Stop.set()
+        if self._Thread!=None:
+            self._Thread.join()
+        self.Flush()
+        for RecordFile in (self._TlogFile, self._SmsFile, self._IndexFile):
+            if RecordFile!=None:
+                RecordFile.close()
+
+    def Flush(self):
+        ######################################################################################
+        #
+        #  Summary:  Writes everything recorded so far.  The writer thread calls it every
+        #  FlushSeconds.
+        #
+        ######################################################################################
+        self._Lock.acquire()
+        try:
+            Pending, self._Pending = self._Pending, []
+        finally:
+            self._Lock.release()
+        if len(Pending)==0 or self._IndexFile==None:
+            return
+        TlogOffset = self._TlogBytes
+        SmsOffset = self._SmsBytes
+        TlogRecords = []
+        SmsRecords = []
+        IndexEntries = []
+        for RecordTime, Record in Pending:
+            if isinstance(Record, tuple):
+                Sender, Payload = Record
+                Sender = str(Sender or "")[:255]
+                SmsRecord = SMS_HEADER.pack(RecordTime, _GetSendTimestamp(Payload), len(Sender)) + Sender + Payload
+                IndexEntries.append(INDEX_ENTRY.pack(RecordTime, SmsOffset, len(SmsRecord), SMS_ENTRY))
+                SmsRecords.append(SmsRecord)
+                SmsOffset += len(SmsRecord)
+            else:
+                TlogRecord = TLOG_TIMESTAMP.pack(int(RecordTime*1e6)) + Record
+                IndexEntries.append(INDEX_ENTRY.pack(RecordTime, TlogOffset, len(TlogRecord), ord(Record[5])))
+                TlogRecords.append(TlogRecord)
+                TlogOffset += len(TlogRecord)
+        self._TlogFile.write("".join(TlogRecords))
+        self._TlogFile.flush()
+        self._SmsFile.write("".join(SmsRecords))
+        self._SmsFile.flush()
+        self._IndexFile.write("".join(IndexEntries))
+        self._IndexFile.flush()
+        self._TlogBytes = TlogOffset
+        self._SmsBytes = SmsOffset
+
+    def _WriterLoop(self):
+        while not self._Stop.wait(self._FlushSeconds):
+            try:
+                self.Flush()
+            except (IOError, OSError), e:
+                print "Can't write telemetry recording: " + str(e)
+
+
+class TelemetryLog(object):
+    def __init__(self, Path):
+        ######################################################################################
+        #
+        #  Summary:  Reads a recording made by TelemetryRecorder at Path, by way of its index
+        #
+        ######################################################################################
+        self._Path = Path
+        self._IndexFile = open(Path + ".idx", "rb")
+        self._TlogFile = open(Path, "rb")
+        self._SmsFile = open(Path + ".sms", "rb") if os.path.exists(Path + ".sms") else None
+        self._Parser = mavlink.MAVLink(None)
+
+    def Close(self):
+        for RecordFile in (self._IndexFile, self._TlogFile, self._SmsFile):
+            if RecordFile!=None:
+                RecordFile.close()
+
+    def GetEntryCount(self):
+        self._IndexFile.seek(0, os.SEEK_END)
+        return self._IndexFile.tell() // INDEX_ENTRY.size
+
+    def GetTimeRange(self):
+        #(first time, last time) recorded, or None if nothing was
+        Count = self.GetEntryCount()
+        if Count==0:
+            return None
+        return self._ReadEntry(0)[0], self._ReadEntry(Count - 1)[0]
+
+    def GetMessages(self, Types=None, Start=None, End=None):
+        ######################################################################################
+        #
+        #  Summary:  Returns the (time, MavlinkMessage) recorded between Start and End
+        #  (seconds since the epoch, None for no limit), optionally only those whose type
+        #  is in Types, e.g. ["GPS_RAW_INT"]
+        #
+        ######################################################################################
+        MessageIds = None
+        if Types!=None:
+            MessageIds = set([MessageId for MessageId, MessageClass in mavlink.mavlink_map.items()
+                              if MessageClass.name in Types])
+        Found = []
+        for EntryTime, Offset, Length, MessageId in self._GetEntries(Start, End):
+            if MessageId==SMS_ENTRY or (MessageIds!=None and MessageId not in MessageIds):
+                continue
+            self._TlogFile.seek(Offset)
+            Record = self._TlogFile.read(Length)
+            try:
+                MavlinkMessage = self._Parser.decode(Record[TLOG_TIMESTAMP.size:])
+            except Exception:
+                continue   #a frame the dialect doesn't know
+            Found.append((EntryTime, MavlinkMessage))
+        return Found
+
+    def GetTextMessages(self, Start=None, End=None):
+        ######################################################################################
+        #
+        #  Summary:  Returns the text messages received between Start and End as (arrival
+        #  time, Sender, SendTimestamp, Payload), SendTimestamp being the envelope's send time
+        #  in seconds modulo 65536 (see RateController) or None
+        #
+        ######################################################################################
+        Found = []
+        if self._SmsFile==None:
+            return Found
+        for EntryTime, Offset, Length, MessageId in self._GetEntries(Start, End):
+            if MessageId!=SMS_ENTRY:
+                continue
+            self._SmsFile.seek(Offset)
+            Record = self._SmsFile.read(Length)
+            ArrivalTime, SendTimestamp, SenderLength = SMS_HEADER.unpack_from(Record)
+            Sender = Record[SMS_HEADER.size:SMS_HEADER.size + SenderLength]
+            Found.append((ArrivalTime, Sender, None if SendTimestamp==NO_TIMESTAMP else SendTimestamp,
+                          Record[SMS_HEADER.size + SenderLength:]))
+        return Found
+
+    def GetTextMessageLatencies(self, Start=None, End=None):
+        ######################################################################################
+        #
+        #  Summary:  Seconds each text message received between Start and End took from
+        #  being sent to being read, for those whose send time is known.  Includes the offset
+        #  between the two clocks, and the send time only has whole seconds.
+        #
+        ######################################################################################
+        Latencies = []
+        for ArrivalTime, Sender, SendTimestamp, Payload in self.GetTextMessages(Start, End):
+            if SendTimestamp!=None:
+                Latency = (int(ArrivalTime) - SendTimestamp) % 65536
+                Latencies.append(Latency - 65536 if Latency >= 32768 else Latency)
+        return Latencies
+
+    def _GetEntries(self, Start, End):
+        #index entries from the first at or after Start up to End
+        Count = self.GetEntryCount()
+        Low = 0
+        if Start!=None:
+            High = Count
+            while Low < High:
+                Middle = (Low + High)//2
+                if self._ReadEntry(Middle)[0] < Start:
+                    Low = Middle + 1
+                else:
+                    High = Middle
+        self._IndexFile.seek(Low*INDEX_ENTRY.size)
+        while 1:
+            Buffer = self._IndexFile.read(INDEX_ENTRY.size*1024)
+            for Offset in range(0, len(Buffer) - len(Buffer) % INDEX_ENTRY.size, INDEX_ENTRY.size):
+                Entry = INDEX_ENTRY.unpack_from(Buffer, Offset)
+                if End!=None and Entry[0] > End:
+                    return
+                yield Entry
+            if len(Buffer) < INDEX_ENTRY.size*1024:
+                return
+
+    def _ReadEntry(self, Index):
+        self._IndexFile.seek(Index*INDEX_ENTRY.size)
+        return INDEX_ENTRY.unpack(self._IndexFile.read(INDEX_ENTRY.size))
+
+
+def LoadTelemetryLog(Path):
+    ######################################################################################
+    #
+    #  Summary:  Reads every valid mavlink message out of a telemetry log, with the time it
+    #  was logged as _timestamp
+    #
+    ######################################################################################
+    from pymavlink import mavutil   #only the benchmarks and tools read whole logs
+    ListOfMavlinkMessages = []
+    Log = mavutil.mavlink_connection(Path)
+    while 1:
+        message = Log.recv_match()
+        if message==None:
+            break
+        if message.get_type()=="BAD_DATA":
+            continue
+        ListOfMavlinkMessages.append(message)
+    return ListOfMavlinkMessages
+
+
+def _GetSendTimestamp(Payload):
+    #the envelope's send time, from the payload or, for a segmented one, its first segment
+    if Segmentation.IsSegment(Payload) and len(Payload) > Segmentation.SEGMENT_HEADER_LENGTH and ord(Payload[2])==0:
+        Payload = Payload[Segmentation.SEGMENT_HEADER_LENGTH:]
+    if not Envelope.IsEnveloped(Payload):
+        return NO_TIMESTAMP
+    try:
+        Timestamp = Envelope.UnwrapEnvelope(Payload)[3]
+    except ValueError:
+        return NO_TIMESTAMP
+    return NO_TIMESTAMP if Timestamp==None else Timestamp
@@ -4,13 +4,57 @@
 # ChamBana03@gmail.com
 
 import base64
-import pylzma
+import errno
+import select
 import socket
 import time
+import re
 from pymavlink import mavlinkv10 as mavlink
-import multiprocessing
-import binascii
-import gsmmodem
+import threading
+from collections import deque
+import ModemEngine
+import PayloadCodec
+import CompressionDictionary
+import SmsPdu
+import Segmentation
+import FieldCodec
+import MavlinkFraming
+import DuplicateFilter
+import Envelope
+import Reliability
+import RateController
+import Metrics
+import SendJournal
+import BulkDecoder
+from CoalescingQueue import IsCritical, DEFAULT_ORDERED_TYPES
+
+MAX_TEXT_MESSAGE_LENGTH = 160
+MAX_TEXT_MODE_PAYLOAD_LENGTH = MAX_TEXT_MESSAGE_LENGTH*3//4   #bytes that Base64 to 160 characters
+
+SMS_MODE_TEXT = "TEXT"   #Base64 payload sent as text, 160 characters = 120 bytes per text message
+SMS_MODE_PDU = "PDU"     #binary payload sent as 8-bit user data, 140 bytes per text message
+
+#what Submit() does when the sender thread's queue is full; critical sends are never dropped
+OVERFLOW_DROP_OLDEST = "DROP_OLDEST"   #drop the oldest queued non-critical send to make room (telemetry goes stale)
+OVERFLOW_DROP_NEWEST = "DROP_NEWEST"   #refuse the new send
+
+RECEIVE_MODE_POLL = "POLL"       #list the whole inbox on every GetTextMessageTelemetry()
+RECEIVE_MODE_NOTIFY = "NOTIFY"   #read only the text messages the modem announced with +CMTI
+
+CMTI_REGEX = re.compile(r'^\+CMTI:\s*"([^"]+)",\s*(\d+)')
+#text mode +CMGL/+CMGR header of a received message:  [index,]"status","sender",...
+TEXT_MODE_HEADER_REGEX = re.compile(r'^\+CMG[LR]:\s*(?:\d+,)?"([^"]+)","([^"]*)"')
+CMGL_INDEX_REGEX = re.compile(r'^\+CMGL:\s*(\d+)')   #storage index of a listed text message
+CPMS_REGEX = re.compile(r'^\+CPMS:\s*"[^"]+",\s*(\d+)')   #messages stored in the read memory
+SEND_TIMEOUT = 30   #seconds the network gets to accept a text message
+
+#which modem of a modem pool sends the next payload
+SCHEDULE_ROUND_ROBIN = "ROUND_ROBIN"   #take turns
+SCHEDULE_LEAST_BUSY = "LEAST_BUSY"     #the modem with the fewest text messages waiting to go out
+
+MAX_DATAGRAM_LENGTH = 65535            #a UDP datagram from the GCS can hold many mavlink frames
+GCS_SOCKET_BUFFER_BYTES = 1024*1024    #kernel buffer, so a burst from or to the GCS isn't dropped
+GCS_BATCH_BYTES = 8192                 #frames going to the GCS are sent this many bytes per datagram at most
 
 class fifo(object):
     def __init__(self):
@@ -21,28 +65,68 @@ class fifo(object):
     def read(self):
         return self.buf.pop(0)
 
+class _RemotePeer(object):
+    ######################################################################################
+    #
+    #  Summary:  State kept per remote vehicle or ground station, so streams from different
+    #  senders don't mix.  For receiving:  the framer numbering the frames
+    #  rebuilt from compact and delta payloads, the delta codec's reference state, the buffer
+    #  putting enveloped payloads back in order, the acks owed for its reliable payloads and
+    #  the queueing delay of its text messages.  For sending:  its phone numbers, taken in
+    #  turn, its envelope sequence number and the reliable payloads waiting for its ack.  The
+    #  numbers of a remote modem pool share one peer.
+    #
+    ######################################################################################
+    def __init__(self, PhoneNumbers):
+        self.PhoneNumbers = PhoneNumbers
+        self.NextPhoneNumber = 0
+        self.SendSequence = 0
+        self.Framing = MavlinkFraming.FrameBuilder()
+        self.DeltaDecoder = FieldCodec.DeltaDecoder(self.Framing)
+        self.Reorder = Envelope.ReorderBuffer()
+        self.Acks = Reliability.AckTracker()
+        self.Retransmits = Reliability.RetransmitQueue()
+        self.Delays = RateController.RateController()
+
 class LocalGCScommunication(object):
 
-    def __init__(self, GCSport, debug_level):
+    def __init__(self, GCSport, debug_level, LocalPort=14555, MetricsRegistry=None):
+        ######################################################################################
+        #
+        #  Summary:  UDP link to the GCS software.  Receiving waits on the socket with select(),
+        #  so an idle link costs no CPU, and every datagram is drained and parsed whole, since
+        #  a GCS packs several frames into one datagram when it sends a burst (e.g. a mission
+        #  upload).  Frames going to the GCS are batched into as few datagrams as possible.
+        #  Traffic counts go to MetricsRegistry (see Metrics), e.g. one shared with the
+        #  TextMessageTelemetry, or a registry of its own if None.
+        #
+        ######################################################################################
         self._PortGCS = GCSport
-        self._PortMe = 14555
+        self._PortMe = LocalPort   #one per GCS connection
         self._IP = "127.0.0.1"
         self._LocalGCSConnection = None
         self._DEBUG_LEVEL = debug_level
         f=fifo()
         self._MavlinkHelperObject = mavlink.MAVLink(f)
+        self._ReceivedMessages = deque()   #parsed but not handed out yet by ReceiveMavlinkMessageFromGCS()
+        self._Metrics = MetricsRegistry if MetricsRegistry!=None else Metrics.MetricsRegistry()
 
 
     def Connect(self):
         ######################################################################################
         #
-        #  Summary:  Takes a mavlink message and sends it via UDP as a raw buffer to the Ground
-        #  Control Statin software (e.g. APM planner 2) running on the local computer.
+        #  Summary:  Opens the non-blocking UDP socket the GCS software (e.g. APM planner 2)
+        #  running on the local computer talks to, with buffers big enough for its bursts.
         #
         ######################################################################################
 
         self._LocalGCSConnection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._LocalGCSConnection.setblocking(0)
+        for Option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                self._LocalGCSConnection.setsockopt(socket.SOL_SOCKET, Option, GCS_SOCKET_BUFFER_BYTES)
+            except socket.error, e:
+                self.Logger("Can't enlarge GCS socket buffer: %s", 2, e)
         self._LocalGCSConnection.bind((self._IP, self._PortMe))
 
 
@@ -54,10 +138,60 @@ class LocalGCScommunication(object):
         #
         ######################################################################################
 
-        if self._LocalGCSConnection!=None:
-            self._LocalGCSConnection.sendto(message.get_msgbuf(), (self._IP, self._PortGCS))
-        else:
+        self.SendBufferToGCS(message.get_msgbuf())
+
+
+    def SendBufferToGCS(self, Buffer):
+        #sends frames that are already built, e.g. rewritten by a FleetRouter
+        self.SendBuffersToGCS([Buffer])
+
+
+    def SendMavlinkMessagesToGCS(self, ListOfMavlinkMessages):
+        self.SendBuffersToGCS([message.get_msgbuf() for message in ListOfMavlinkMessages])
+
+
+    def SendBuffersToGCS(self, ListOfBuffers):
+        ######################################################################################
+        #
+        #  Summary:  Sends a burst of frames, e.g. everything decoded from one text message,
+        #  packed up to GCS_BATCH_BYTES per datagram, so a burst costs a few sendto() calls
+        #  instead of one per frame.  Frames are never split across datagrams.
+        #
+        ######################################################################################
+
+        if self._LocalGCSConnection==None:
             self.Logger("Can't Send Mavlink Data without first initializing Socket", message_importance=1)
+            return
+        Batch = []
+        BatchLength = 0
+        for Buffer in ListOfBuffers:
+            if BatchLength > 0 and BatchLength + len(Buffer) > GCS_BATCH_BYTES:
+                self._SendDatagram("".join(Batch))
+                Batch = []
+                BatchLength = 0
+            Batch.append(Buffer)
+            BatchLength += len(Buffer)
+        if BatchLength > 0:
+            self._SendDatagram("".join(Batch))
+        self._Metrics.Increment("gcs_frames_sent_total", len(ListOfBuffers))
+
+
+    def _SendDatagram(self, Datagram):
+        #the socket is non-blocking, so wait a moment for room in the send buffer rather than drop the datagram
+        for Attempt in range(10):
+            try:
+                self._LocalGCSConnection.sendto(Datagram, (self._IP, self._PortGCS))
+                self._Metrics.Increment("gcs_datagrams_sent_total")
+                self._Metrics.Increment("gcs_bytes_sent_total", len(Datagram))
+                return
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    self.Logger("Can't send to GCS: %s", 1, e)
+                    self._Metrics.Increment("drops_total", Reason="gcs_send_error")
+                    return
+                select.select([], [self._LocalGCSConnection], [], 0.1)
+        self.Logger("GCS socket is full...dumping %s bytes", 1, len(Datagram))
+        self._Metrics.Increment("drops_total", Reason="gcs_socket_full")
 
 
     def ReceiveMavlinkMessageFromGCS(self):
@@ -67,199 +201,1196 @@ class LocalGCScommunication(object):
         #  (e.g. APM planner 2) running on the local computer and returns it as a Mavlink message.
         #  Typically you'd want to subsequently relay this data to the vehicle after processing
         #  it using, for example, the TextMessageTelemetry class function SendTextMessageTelemetry()
+        #  Returns None without waiting if nothing arrived.  Frames after the first of a
+        #  datagram are kept for the next calls.
         #
         ######################################################################################
 
-        if self._LocalGCSConnection!=None:
-            BufferFromGCS = self._LocalGCSConnection.recv(1024)
-            MavlinkMessage = self._MavlinkHelperObject.decode(BufferFromGCS)
-            return MavlinkMessage
-        else:
+        if len(self._ReceivedMessages)==0:
+            self._ReceivedMessages.extend(self.ReceiveMavlinkMessagesFromGCS(timeout=0))
+        if len(self._ReceivedMessages)==0:
+            return None
+        return self._ReceivedMessages.popleft()
+
+
+    def ReceiveMavlinkMessagesFromGCS(self, timeout=None):
+        ######################################################################################
+        #
+        #  Summary:  Waits up to timeout seconds (None for as long as it takes) for the GCS to
+        #  send something, then drains every datagram waiting on the socket and returns all the
+        #  mavlink messages in them, possibly none.  A frame split across datagrams is
+        #  completed by the next one.
+        #
+        ######################################################################################
+
+        if self._LocalGCSConnection==None:
             self.Logger("Can't Receive Mavlink Data without first initializing Socket", message_importance=1)
+            return []
+        ListOfMavlinkMessages = list(self._ReceivedMessages)
+        self._ReceivedMessages.clear()
+        if len(ListOfMavlinkMessages)==0:
+            try:
+                Readable, Writable, Failed = select.select([self._LocalGCSConnection], [], [], timeout)
+            except select.error, e:
+                if e.args[0]!=errno.EINTR:
+                    raise
+                return []
+            if len(Readable)==0:
+                return []
+        while 1:
+            try:
+                Datagram = self._LocalGCSConnection.recv(MAX_DATAGRAM_LENGTH)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break   #drained
+                if e.args[0]==errno.ECONNREFUSED:
+                    continue   #an earlier sendto() found nobody listening yet
+                raise
+            self._Metrics.Increment("gcs_bytes_received_total", len(Datagram))
+            try:
+                MavlinkMessages = self._MavlinkHelperObject.parse_buffer(Datagram)
+            except Exception, e:
+                self.Logger("Skipping bad data from GCS: %s", 2, e)
+                self._Metrics.Increment("drops_total", Reason="bad_gcs_data")
+                continue
+            if MavlinkMessages:
+                ListOfMavlinkMessages += MavlinkMessages
+                self._Metrics.Increment("gcs_frames_received_total", len(MavlinkMessages))
+        return ListOfMavlinkMessages
 
 
-    def Logger(self, message, message_importance):
+    def Logger(self, message, message_importance, *Arguments):
         ######################################################################################
         #
         #  Summary:  Debug logger that prints output if the message importance meets the
         #  threshold set during class object initialization.  For example, if DEBUG_LEVEL is set
         #  to 4, all debug output is printed.  Recommended DEBUG_LEVEL value is 2.
+        #  Arguments are %-formatted into message only if it is printed, so a message below the
+        #  threshold costs no formatting.
         #
         ######################################################################################
         if message_importance < self._DEBUG_LEVEL:
-            print message
+            print message % Arguments if Arguments else message
 
 
 
 class TextMessageTelemetry(object):
-    def __init__(self, SendToPhoneNumber, LocalModemPath, baud=115200, DEBUG_LEVEL=2):
-        self._RemotePhoneNumber = SendToPhoneNumber
+    def __init__(self, SendToPhoneNumber, LocalModemPath, baud=115200, DEBUG_LEVEL=2, PayloadFormat=PayloadCodec.DEFAULT_PAYLOAD_FORMAT, DictionaryId=CompressionDictionary.DEFAULT_DICTIONARY_ID, SmsMode=SMS_MODE_TEXT,
+                 MaxQueuedSends=4, OverflowPolicy=OVERFLOW_DROP_OLDEST, ReceiveMode=RECEIVE_MODE_POLL, Schedule=SCHEDULE_LEAST_BUSY,
+                 ReliableTypes=(), MaxTextMessagesPerMinute=None, MaxTextMessagesPerDay=None, MetricsRegistry=None,
+                 BulkDecodeWorkers=0, BulkDecodeThreshold=BulkDecoder.BULK_DECODE_THRESHOLD, CollapseBacklog=False):
+        ######################################################################################
+        #
+        #  Summary:  SendToPhoneNumber and LocalModemPath may each be a list, for a pool of
+        #  modems and SIMs on either side.  A ground station talking to several vehicles adds
+        #  each with AddRemote() (SendToPhoneNumber can then be None) and picks one per send
+        #  with Destination.  Every payload is sent by one local modem, picked by Schedule, to
+        #  one of the remote's numbers in turn, and carries a sequence number
+        #  (see Envelope) so the receiving side decodes the payloads in the order they were
+        #  sent, whichever modems they went through.  Payloads carrying a message of one of
+        #  the ReliableTypes (e.g. Reliability.DEFAULT_RELIABLE_TYPES) are retransmitted until
+        #  the other side acks them; the rest are best-effort.  The text message budget,
+        #  MaxTextMessagesPerMinute and MaxTextMessagesPerDay, is enforced by the caller with
+        #  GetRateScale() and IsWithinBudget() (see RateController).  Encode times, sizes,
+        #  send and inbox read times, drops and queue depths go to MetricsRegistry (see
+        #  Metrics), or to a registry of its own if None (GetMetrics()).  With
+        #  BulkDecodeWorkers, a backlog of BulkDecodeThreshold payloads or more is decoded by
+        #  that many worker processes, merged by send time and, with CollapseBacklog, cut down
+        #  to the newest sample of each telemetry stream (see BulkDecoder).
+        #
+        ######################################################################################
+        if not isinstance(LocalModemPath, (list, tuple)):
+            LocalModemPath = [LocalModemPath]
         self._DEBUG_LEVEL = DEBUG_LEVEL
+        self._PayloadFormat = PayloadFormat
+        self._DictionaryId = DictionaryId
+        self._SmsMode = SmsMode
+        self._Metrics = MetricsRegistry if MetricsRegistry!=None else Metrics.MetricsRegistry()
+        self._DecodePool = None                #forked before the modem threads start
+        if BulkDecodeWorkers > 0:
+            self._DecodePool = BulkDecoder.CreatePool(BulkDecodeWorkers)
+        self._BulkDecodeThreshold = BulkDecodeThreshold
+        self._CollapseBacklog = CollapseBacklog
+        self._SegmentReference = 0
+        self._Reassembler = Segmentation.SegmentReassembler()
+        self._Duplicates = DuplicateFilter.DuplicateFilter()
+        self._DeltaEncoder = FieldCodec.DeltaEncoder()
+        self._EncoderLock = threading.Lock()   #the delta encoder is used by both the caller's and the sender thread
+        self._SendQueue = deque()              #(ListOfMavlinkMessages, EncodedBuffer, Critical, Destination, JournalIds) waiting for the sender thread
+        self._PayloadHandlers = {}             #format byte -> handler, see SetPayloadHandler()
+        self._ReceiveObserver = None           #see SetReceiveObserver()
+        self._SendCondition = threading.Condition()
+        self._MaxQueuedSends = MaxQueuedSends
+        self._OverflowPolicy = OverflowPolicy
+        self._DroppedSends = 0
+        self._SenderThread = None
+        self._ReceiveMode = ReceiveMode
+        self._NewMessages = deque()           #(ModemIndex, Memory, Index) announced by +CMTI, not read yet
+        self._NewMessageEvent = threading.Event()
+        self._InboxListed = False             #messages stored before we connected never get a +CMTI
+        self._ReadFailed = False              #the last listing or read failed; wait before listing again
+        self._Peers = {}           #remote's first phone number -> _RemotePeer
+        self._PeerKeys = {}        #phone number, as the modem reports senders -> remote's first phone number
+        self._PeerLock = threading.Lock()
+        self._RemotePhoneNumber = None         #default destination
+        if SendToPhoneNumber!=None:
+            self._RemotePhoneNumber = self.AddRemote(SendToPhoneNumber)
         self._ModemLocation = LocalModemPath
-        f=fifo()
-        self._MavlinkHelperObject = mavlink.MAVLink(f)
-        self._ModemLock = multiprocessing.Lock()
-        self._ModemConnection = gsmmodem.GsmModem(port=LocalModemPath, baudrate=baud)
-        try:
-            self._PrepareModem()
-        except Exception, err:
-            self.Logger("Modem Init failed"+str(err), message_importance=1)
-            self._ModemConnection=None
+        self._SendLock = threading.Lock()      #one payload is prepared and queued at a time
+        self._ReceiveLock = threading.Lock()   #one caller reads the inbox at a time
+        self._ReliableTypes = ReliableTypes
+        self._RateController = RateController.RateController(MaxTextMessagesPerMinute, MaxTextMessagesPerDay)
+        self._Schedule = Schedule
+        self._NextModem = 0
+        self._PendingSends = deque()           #(ModemIndex, ModemCommand) of text messages not sent yet, oldest first
+        self._Journal = None                   #SendJournal, see OpenJournal()
+        self._JournalTypes = ()
+        self._JournalSends = []                #(JournalIds, ListOfCommands) handed to the modems, not done yet
+        self._ReadMemory = [None]*len(LocalModemPath)   #message storage AT+CPMS last selected, per modem
+        self._ModemConnections = []            #None for a modem that failed to initialize
+        for ModemIndex in range(len(LocalModemPath)):
+            OnNotification = lambda Line, ModemIndex=ModemIndex: self._OnModemNotification(ModemIndex, Line)
+            self._ModemConnections.append(ModemEngine.ModemEngine(LocalModemPath[ModemIndex], baud, OnNotification, DEBUG_LEVEL))
+            try:
+                self._PrepareModem(ModemIndex)
+            except Exception, err:
+                self.Logger("Modem Init failed%s", 1, err)
+                self._ModemConnections[ModemIndex]=None
 
-    def _PrepareModem(self):
+    def _PrepareModem(self, ModemIndex=0):
         ######################################################################################
         #
-        #  Summary:  Initializes modem.  Disables modem echoing our input and sets the modem
-        #  to text mode.
+        #  Summary:  Initializes modem.  Disables modem echoing our input (see ModemEngine),
+        #  sets the modem to text or PDU mode and, in RECEIVE_MODE_NOTIFY, asks for +CMTI new
+        #  message indications, falling back to RECEIVE_MODE_POLL if the modem has none.
         #
         ######################################################################################
-        try: 
-            self._ModemLock.acquire()
-            self._ModemConnection.connect()
-            self._ModemConnection.smsTextMode=True
-            self._ModemLock.release()
+        Modem = self._ModemConnections[ModemIndex]
+        try:
+            Modem.Connect()
+            Modem.Execute('AT+CMGF={0}'.format(1 if self._SmsMode==SMS_MODE_TEXT else 0), Priority=ModemEngine.PRIORITY_BACKGROUND)
+            if self._ReceiveMode==RECEIVE_MODE_NOTIFY:
+                try:
+                    Modem.Execute('AT+CNMI=2,1,0,0', Priority=ModemEngine.PRIORITY_BACKGROUND)
+                except ModemEngine.ModemError, e:
+                    self.Logger("No new message indications, polling instead: %s", 1, e)
+                    self._ReceiveMode = RECEIVE_MODE_POLL
         except Exception, e:
-            self.Logger("Prepare Modem failed"+str(e), message_importance=1)
-            self._ModemConnection=None
+            self.Logger("Prepare Modem failed%s", 1, e)
+            self._ModemConnections[ModemIndex]=None
 
-    def Logger(self, message, message_importance):
+    def Logger(self, message, message_importance, *Arguments):
         ######################################################################################
         #
         #  Summary:  Debug logger that prints output if the message importance meets the
         #  threshold set during class object initialization.  For example, if DEBUG_LEVEL is set
         #  to 4, all debug output is printed.  Recommended DEBUG_LEVEL value is 2.
+        #  Arguments are %-formatted into message only if it is printed, so a message below the
+        #  threshold costs no formatting.
         #
         ######################################################################################
         if message_importance < self._DEBUG_LEVEL:
-            print message
+            print message % Arguments if Arguments else message
 
-    def SendTextMessageTelemetry(self, ListOfMavlinkMessages, blocking=False):
+    def SendTextMessageTelemetry(self, ListOfMavlinkMessages, blocking=False, EncodedBuffer=None, Destination=None):
         ######################################################################################
         #
         #  Summary:  Takes a list of mavlink messages, uses class helper functions to compress
-        #  them with LZMA compression, encode them into Base64, and action the modem to transmit
-        #  the telemetry via SMS.
-        #  NOTE:  This function requires your compressed/encoded buffer to be <160 characters.
-        #  It's trivial (and inefficient) to just check the length of your proposed text msg by
-        #  checking the length returned by helper function ConvertMavlinkToTextMessage()
+        #  them (see PayloadCodec), encode them for the SMS mode (Base64 text or binary PDU), and
+        #  action the modem to transmit the telemetry via SMS.  Blocking calls wait until the
+        #  network has taken every text message and return True if it did; non-blocking calls
+        #  queue the text messages on the modem (see ModemEngine) and return straight away.
+        #  Payloads bigger than GetMaxPayloadLength() are split into up to 16 segments (see
+        #  Segmentation), each sent as its own text message and reassembled by the receiving
+        #  TextMessageTelemetry, so a burst of messages is compressed as a single unit.
+        #  Each payload is enveloped with a sequence number first, and all its text messages
+        #  go through the same modem of the pool (see _PickModem).
+        #  PayloadSelector with EncodeOutgoingPayload() picks lists that fit one text message; it
+        #  hands back the already encoded payload, which can be passed in as EncodedBuffer to
+        #  skip encoding the list a second time.
+        #  Destination is any phone number of the remote to send to (see AddRemote), None for
+        #  SendToPhoneNumber.
         #
         ######################################################################################
 
+        LockRequested = time.time()
         if blocking==True:
-            self._ModemLock.acquire(True)
+            self._SendLock.acquire(True)
         else:
-            self.Logger("Non-blocking call to SendTextMessage..", message_importance=1)
-            ret=self._ModemLock.acquire(False)
+            self.Logger("Non-blocking call to SendTextMessage..", message_importance=3)
+            ret=self._SendLock.acquire(False)
             if ret==False:
                 self.Logger("Modem is not available...dumping outbound", message_importance=1)
+                self._Metrics.Increment("drops_total", Reason="modem_busy")
                 return False
-            else:
-                self.Logger("Modem available, sending.....", message_importance=1)
+        self._Metrics.Observe("send_lock_wait_seconds", time.time() - LockRequested)
 
-        OutgoingBuffer = self.ConvertMavlinkToTextMessage(ListOfMavlinkMessages)
-        if len(OutgoingBuffer)>160:
-            self.Logger("Can't send more than 160 characters per text message", message_importance=1)
-            return False
+        try:
+            ListOfCommands = self._QueueTextMessages(ListOfMavlinkMessages, EncodedBuffer, Destination)
+        finally:
+            self._SendLock.release()
 
-        self.Logger("Sending SMS...", message_importance=1)
+        if ListOfCommands==None:
+            return False
+        if blocking==False:
+            return True
         try:
-            result = self._ModemConnection.sendSms(self._RemotePhoneNumber, OutgoingBuffer)
-            self._ModemLock.release()
-            return result
+            for Command in ListOfCommands:
+                Command.Result()
+            return True
         except Exception, e:
-            self.Logger("Exception during sendSMS()"+str(e), message_importance=1)
-            self._ModemLock.release()
+            self.Logger("Exception during sendSMS()%s", 1, e)
+            return False
+
+    def _QueueTextMessages(self, ListOfMavlinkMessages, EncodedBuffer, Destination=None):
+        ######################################################################################
+        #
+        #  Summary:  Encodes the payload, keeps it for retransmission if it carries one of the
+        #  ReliableTypes, and queues it for Destination with _QueuePayload().  Returns the
+        #  ModemCommands of its text messages, or None if the payload can't be sent.  Caller
+        #  holds the send lock.
+        #
+        ######################################################################################
+        if Destination==None:
+            Destination = self._RemotePhoneNumber
+        if Destination==None:
+            self.Logger("No destination for outbound...dumping", message_importance=1)
+            self._Metrics.Increment("drops_total", Reason="no_destination")
             return None
-	
-    def GetTextMessageTelemetry(self, blocking=True):
+        Peer = self._GetPeer(Destination)
+        if ListOfMavlinkMessages==None:
+            Reliable = True   #an encoded payload from SubmitPayload()
+        else:
+            Reliable = len([MavlinkMessage for MavlinkMessage in ListOfMavlinkMessages
+                            if MavlinkMessage.get_type() in self._ReliableTypes]) > 0
+        if ListOfMavlinkMessages==None:
+            Payload = EncodedBuffer
+        elif Reliable and self._PayloadFormat==FieldCodec.FORMAT_DELTA:
+            #a retransmitted delta record would decode against newer reference state
+            Payload = PayloadCodec.EncodePayload(ListOfMavlinkMessages, PayloadCodec.DEFAULT_PAYLOAD_FORMAT, self._DictionaryId)
+        elif self._PayloadFormat==FieldCodec.FORMAT_DELTA:
+            #the delta reference state only moves on for payloads that are actually sent
+            self._EncoderLock.acquire()
+            try:
+                Payload = self._DeltaEncoder.Encode(ListOfMavlinkMessages, Commit=True)
+            finally:
+                self._EncoderLock.release()
+        elif EncodedBuffer!=None:
+            Payload = EncodedBuffer
+        else:
+            Payload = self.EncodeOutgoingPayload(ListOfMavlinkMessages)
+
+        ReliableSequence = None
+        if Reliable:
+            ReliableSequence, GivenUp = Peer.Retransmits.Add(Payload)
+            self._LogGivenUp(GivenUp)
+        ListOfCommands = self._QueuePayload(Peer, Payload, ReliableSequence)
+        if ListOfCommands and ListOfMavlinkMessages:
+            FrameBytes = sum([len(MavlinkMessage.get_msgbuf()) for MavlinkMessage in ListOfMavlinkMessages])
+            self._Metrics.Observe("payload_bytes", len(Payload))
+            self._Metrics.Observe("compression_ratio", float(FrameBytes)/max(1, len(Payload)))
+            self._Metrics.Observe("messages_per_text_message", float(len(ListOfMavlinkMessages))/len(ListOfCommands))
+            self._Metrics.Increment("mavlink_messages_sent_total", len(ListOfMavlinkMessages))
+        return ListOfCommands
+
+    def _QueuePayload(self, Peer, Payload, ReliableSequence=None):
+        ######################################################################################
+        #
+        #  Summary:  Envelopes and segments an encoded payload, queues its text messages for
+        #  Peer on one modem and returns their ModemCommands, or None if the payload can't be
+        #  sent.  The envelope carries the send time, and an ack or a delay report owed to Peer
+        #  rides along if it fits without another text message.  Caller holds the send lock.
+        #
+        ######################################################################################
+        Reliable = None
+        if ReliableSequence!=None:
+            Reliable = Peer.Retransmits.GetHeader(ReliableSequence)
+        Ack = Peer.Acks.GetAck()
+        Delay = Peer.Delays.GetInboundDelay()
+        Timestamp = RateController.GetTimestamp()
+        Capacity = self._GetTextMessageCapacity()
+        Length = len(Envelope.WrapPayload(Payload, Peer.SendSequence, Reliable, None, Timestamp))
+        if Ack!=None and (Length + Envelope.ACK_HEADER_LENGTH <= Capacity or Length > Capacity):
+            Length += Envelope.ACK_HEADER_LENGTH
+        else:
+            Ack = None
+        if Delay!=None and not (Length + Envelope.DELAY_LENGTH <= Capacity or Length > Capacity):
+            Delay = None
+        Payload = Envelope.WrapPayload(Payload, Peer.SendSequence, Reliable, Ack, Timestamp, Delay)
+
+        if len(Payload)>self._GetTextMessageCapacity():
+            try:
+                ListOfPayloads = Segmentation.SplitPayload(Payload, self._GetTextMessageCapacity(), self._SegmentReference)
+            except ValueError, e:
+                self.Logger("Can't send payload: %s", 1, e)
+                self._Metrics.Increment("drops_total", Reason="too_big")
+                return None
+            self._SegmentReference = (self._SegmentReference + 1) % 256
+            self.Logger("Sending payload as %s segments", 2, len(ListOfPayloads))
+        else:
+            ListOfPayloads = [Payload]
+
+        ModemIndex = self._PickModem()
+        if ModemIndex==None:
+            self.Logger("No modem available...dumping outbound", message_importance=1)
+            self._Metrics.Increment("drops_total", Reason="no_modem")
+            return None
+        PhoneNumber = Peer.PhoneNumbers[Peer.NextPhoneNumber]
+        Peer.NextPhoneNumber = (Peer.NextPhoneNumber + 1) % len(Peer.PhoneNumbers)
+
+        self.Logger("Sending SMS...", message_importance=3)
+        ListOfCommands = [self._SubmitSms(ModemIndex, PhoneNumber, Payload) for Payload in ListOfPayloads]
+        #only a queued payload uses up its sequence number:  a gap would hold the receiver's later payloads back
+        Peer.SendSequence = (Peer.SendSequence + 1) % Envelope.SEQUENCE_MODULUS
+        for Command in ListOfCommands:
+            self._PendingSends.append((ModemIndex, Command))
+        self._RateController.RecordSend(len(ListOfCommands))
+        self._Metrics.Increment("text_messages_sent_total", len(ListOfCommands))
+        if Ack!=None:
+            Peer.Acks.AckSent()
+        if Delay!=None:
+            Peer.Delays.ReportSent()
+        return ListOfCommands
+
+    def _SendControlTraffic(self):
+        ######################################################################################
+        #
+        #  Summary:  Queues the retransmissions that are due, then a bare envelope if an ack
+        #  or a delay report is owed and nothing went out to carry it in time.  Caller holds
+        #  the send lock.
+        #
+        ######################################################################################
+        for Key, Peer in list(self._Peers.items()):
+            ListOfDue, GivenUp = Peer.Retransmits.TakeDue()
+            self._LogGivenUp(GivenUp)
+            for ReliableSequence, Payload in ListOfDue:
+                self.Logger("Retransmitting reliable payload %s to %s", 2, ReliableSequence, Key)
+                self._QueuePayload(Peer, Payload, ReliableSequence)
+            AckDeadline = Peer.Acks.GetAckDeadline()
+            if AckDeadline!=None and AckDeadline <= time.time():
+                self.Logger("Sending bare ack to %s", 3, Key)
+                self._QueuePayload(Peer, "")
+                Peer.Acks.AckSent()   #even if it couldn't be queued; the next reliable payload asks again
+            FeedbackDeadline = Peer.Delays.GetFeedbackDeadline()
+            if FeedbackDeadline!=None and FeedbackDeadline <= time.time():
+                self.Logger("Reporting a queueing delay of %s seconds to %s", 2, Peer.Delays.GetInboundDelay(), Key)
+                self._QueuePayload(Peer, "")
+                Peer.Delays.ReportSent()
+
+    def _GetControlDeadline(self):
+        #earliest time _SendControlTraffic() has something to do, or None
+        Deadlines = []
+        for Peer in list(self._Peers.values()):
+            Deadlines += [Peer.Retransmits.GetNextDeadline(), Peer.Acks.GetAckDeadline(), Peer.Delays.GetFeedbackDeadline()]
+        Deadlines = [Deadline for Deadline in Deadlines if Deadline!=None]
+        if len(Deadlines)==0:
+            return None
+        return min(Deadlines)
+
+    def _LogGivenUp(self, GivenUp):
+        for ReliableSequence in GivenUp:
+            self.Logger("Giving up on reliable payload %s, never acked", 1, ReliableSequence)
+            self._Metrics.Increment("drops_total", Reason="never_acked")
+
+    def _PickModem(self):
+        ######################################################################################
+        #
+        #  Summary:  Returns the index of the modem that sends the next payload, or None if no
+        #  modem is up.  SCHEDULE_ROUND_ROBIN takes turns, SCHEDULE_LEAST_BUSY picks the modem
+        #  with the fewest text messages still waiting to go out (taking turns on a tie).  A
+        #  whole payload goes through one modem, since segments are reassembled per sender.
+        #  Caller holds the send lock.
+        #
+        ######################################################################################
+        ModemCount = len(self._ModemConnections)
+        Rotation = [(self._NextModem + Offset) % ModemCount for Offset in range(ModemCount)]
+        Rotation = [ModemIndex for ModemIndex in Rotation if self._ModemConnections[ModemIndex]!=None]
+        if len(Rotation)==0:
+            return None
+        if self._Schedule==SCHEDULE_LEAST_BUSY:
+            PendingCounts = self._GetPendingSendCounts()
+            ModemIndex = min(Rotation, key=lambda ModemIndex: PendingCounts[ModemIndex])   #min keeps the first of equals
+        else:
+            ModemIndex = Rotation[0]
+        self._NextModem = (ModemIndex + 1) % ModemCount
+        return ModemIndex
+
+    def _GetPendingSendCounts(self):
+        #text messages not sent yet, per modem; forgets the ones that completed.  Caller holds the send lock.
+        while len(self._PendingSends) > 0 and self._PendingSends[0][1].IsDone():
+            ModemIndex, Command = self._PendingSends.popleft()
+            if Command.GetDuration()!=None:
+                self._RateController.RecordModemSendTime(Command.GetDuration())
+                self._Metrics.Observe("sms_send_seconds", Command.GetDuration())
+            if Command.GetQueueWait()!=None:
+                self._Metrics.Observe("modem_queue_wait_seconds", Command.GetQueueWait())
+        if len(self._JournalSends) > 0:
+            self._CompleteJournalSends()
+        PendingCounts = [0]*len(self._ModemConnections)
+        for ModemIndex, Command in self._PendingSends:
+            if not Command.IsDone():
+                PendingCounts[ModemIndex] += 1
+        self._Metrics.Set("pending_text_messages", sum(PendingCounts))
+        return PendingCounts
+
+    def _CompleteJournalSends(self):
+        #completes the journal entries of sends whose text messages the modems are done with.  Caller holds the send lock.
+        StillPending = []
+        for JournalIds, ListOfCommands in self._JournalSends:
+            if len([Command for Command in ListOfCommands if not Command.IsDone()]) > 0:
+                StillPending.append((JournalIds, ListOfCommands))
+            else:
+                for JournalId in JournalIds:
+                    self._Journal.Complete(JournalId)
+        self._JournalSends = StillPending
+
+    def _WaitForFreeModem(self):
+        ######################################################################################
+        #
+        #  Summary:  Waits until at least one modem of the pool has no text message waiting to
+        #  go out, so the sender thread keeps every modem busy without queueing up stale
+        #  telemetry on any of them.
+        #
+        ######################################################################################
+        while 1:
+            self._SendLock.acquire()
+            try:
+                PendingCounts = self._GetPendingSendCounts()
+                Busy = [ModemIndex for ModemIndex in range(len(PendingCounts))
+                        if PendingCounts[ModemIndex] > 0 or self._ModemConnections[ModemIndex]==None]
+                if len(Busy) < len(PendingCounts) or len(self._PendingSends)==0:
+                    return
+                Oldest = [Command for ModemIndex, Command in self._PendingSends if not Command.IsDone()][0]
+            finally:
+                self._SendLock.release()
+            try:
+                Oldest.Result()
+            except Exception:
+                pass   #reported by whoever sent it
+
+    def Submit(self, ListOfMavlinkMessages, EncodedBuffer=None, Critical=False, Destination=None, JournalIds=None):
+        ######################################################################################
+        #
+        #  Summary:  Hands a list of mavlink messages to the sender thread, which sends them with
+        #  SendTextMessageTelemetry() as soon as the modem is free, and returns straight away.
+        #  Returns False if the send was refused because the queue is full (OVERFLOW_DROP_NEWEST)
+        #  or holds nothing but critical sends.  Critical sends (e.g. acks) are always queued,
+        #  making room by dropping the oldest non-critical send if need be.  Destination is as
+        #  for SendTextMessageTelemetry().  The sender thread is started on the first call.
+        #  With a journal (OpenJournal), critical sends and sends carrying a message of the
+        #  JournalTypes are journaled until the modem is done with them.  JournalIds are the
+        #  journal entries already holding these messages (see CoalescingQueue.GetJournalIds):
+        #  the send takes them over and completes them instead of journaling the messages
+        #  again.  A refused send leaves them to the caller.
+        #
+        ######################################################################################
+        self._SendCondition.acquire()
+        try:
+            if len(self._SendQueue) >= self._MaxQueuedSends:
+                if Critical or self._OverflowPolicy==OVERFLOW_DROP_OLDEST:
+                    Dropped = self._DropOldestSend()
+                else:
+                    Dropped = False
+                if not Dropped and not Critical:
+                    self._DroppedSends += 1
+                    self.Logger("Send queue is full...dumping outbound", message_importance=1)
+                    self._Metrics.Increment("drops_total", Reason="send_queue_full")
+                    return False
+            if not JournalIds:
+                JournalIds = []
+                if self._Journal!=None and (Critical or len([MavlinkMessage for MavlinkMessage in ListOfMavlinkMessages
+                                                             if MavlinkMessage.get_type() in self._JournalTypes]) > 0):
+                    JournalIds = [self._Journal.Add(Destination, "".join([MavlinkMessage.get_msgbuf() for MavlinkMessage in ListOfMavlinkMessages]))]
+            self._SendQueue.append((ListOfMavlinkMessages, EncodedBuffer, Critical, Destination, JournalIds))
+            self._Metrics.Set("send_queue_depth", len(self._SendQueue))
+            self._WakeSender()
+            return True
+        finally:
+            self._SendCondition.release()
+
+    def SubmitPayload(self, Payload, Destination=None):
+        ######################################################################################
+        #
+        #  Summary:  Like Submit(), for a payload that is already encoded and starts with a
+        #  format byte of its own, e.g. a StateSync payload.  It is always sent reliably and
+        #  never dropped.  The receiving side hands it to the handler registered for its
+        #  format byte (SetPayloadHandler).
+        #
+        ######################################################################################
+        self._SendCondition.acquire()
+        try:
+            self._SendQueue.append((None, Payload, True, Destination, []))
+            self._Metrics.Set("send_queue_depth", len(self._SendQueue))
+            self._WakeSender()
+            return True
+        finally:
+            self._SendCondition.release()
+
+    def OpenJournal(self, Journal, JournalTypes=SendJournal.DEFAULT_JOURNAL_TYPES):
+        ######################################################################################
+        #
+        #  Summary:  Opens Journal (a SendJournal), queues the sends it still holds from
+        #  before a crash or restart, and journals Submit()s from then on (see Submit).
+        #  Returns the number of sends recovered.  Add the remotes (AddRemote) first, so the
+        #  recovered sends go to the right one.  StateSync payloads (SubmitPayload) aren't
+        #  journaled:  a sync simply starts over.
+        #
+        ######################################################################################
+        Recovered = Journal.Open()
+        Parser = mavlink.MAVLink(fifo())
+        self._SendCondition.acquire()
+        try:
+            self._Journal = Journal
+            self._JournalTypes = JournalTypes
+            for JournalId, Destination, Frames in Recovered:
+                ListOfMavlinkMessages = Parser.parse_buffer(Frames) or []
+                if len(ListOfMavlinkMessages)==0:
+                    Journal.Complete(JournalId)
+                    continue
+                self.Logger("Resending %s journaled messages to %s", 1, len(ListOfMavlinkMessages), Destination or self._RemotePhoneNumber)
+                self._SendQueue.append((ListOfMavlinkMessages, None, True, Destination, [JournalId]))
+            if len(self._SendQueue) > 0:
+                self._WakeSender()
+        finally:
+            self._SendCondition.release()
+        return len(Recovered)
+
+    def SetPayloadHandler(self, FormatByte, Handler):
+        ######################################################################################
+        #
+        #  Summary:  Payloads starting with FormatByte are handed to Handler(Sender, Payload)
+        #  instead of being decoded to mavlink messages, Sender being the first phone number of
+        #  the remote (see AddRemote).  Called with the receive lock held.
+        #
+        ######################################################################################
+        self._PayloadHandlers[FormatByte] = Handler
+
+    def SetReceiveObserver(self, Observer):
+        ######################################################################################
+        #
+        #  Summary:  Observer(Sender, Payload, ArrivalTime) is called with every text message's
+        #  binary payload as read from the modem, duplicates and segments included, e.g. to
+        #  record them (see TelemetryRecorder).  Called with the receive lock held, so keep it
+        #  quick.
+        #
+        ######################################################################################
+        self._ReceiveObserver = Observer
+
+    def _WakeSender(self):
+        #starts the sender thread or wakes it up to look at its queue and timers; caller holds _SendCondition
+        self._SendCondition.notify()
+        if self._SenderThread==None:
+            self._SenderThread = threading.Thread(target=self._SenderLoop)
+            self._SenderThread.daemon = True
+            self._SenderThread.start()
+
+    def GetQueuedSendCount(self):
+        ######################################################################################
+        #
+        #  Summary:  Number of sends waiting for the sender thread.  Callers that can hold on
+        #  to their messages (e.g. a CoalescingQueue) should wait for this to drop before
+        #  submitting more, so they keep coalescing instead of queueing stale telemetry.
+        #
+        ######################################################################################
+        return len(self._SendQueue)
+
+    def GetDroppedSendCount(self):
+        return self._DroppedSends
+
+    def GetRateScale(self):
+        ######################################################################################
+        #
+        #  Summary:  Factor to apply to the per-type telemetry rates (CoalescingQueue's
+        #  SetRateScale()), below 1 while the GSM network is backed up or the text message
+        #  budget is being overspent.  See RateController.
+        #
+        ######################################################################################
+        return self._RateController.GetRateScale()
+
+    def IsWithinBudget(self):
+        ######################################################################################
+        #
+        #  Summary:  False if one more text message would exceed MaxTextMessagesPerMinute or
+        #  MaxTextMessagesPerDay.  Critical messages may go out regardless.
+        #
+        ######################################################################################
+        return self._RateController.IsWithinBudget()
+
+    def _DropOldestSend(self):
+        #caller holds _SendCondition
+        for Index in range(len(self._SendQueue)):
+            if not self._SendQueue[Index][2]:
+                for JournalId in self._SendQueue[Index][4]:
+                    self._Journal.Complete(JournalId)
+                del self._SendQueue[Index]
+                self._DroppedSends += 1
+                self.Logger("Send queue is full...dropped the oldest outbound", message_importance=2)
+                self._Metrics.Increment("drops_total", Reason="send_queue_oldest")
+                return True
+        return False
+
+    def _SenderLoop(self):
+        ######################################################################################
+        #
+        #  Summary:  Sender thread started by Submit().  Hands the queued lists to the modems one
+        #  at a time, each as soon as a modem of the pool is free, waiting as long as it takes.
+        #  It also runs the retransmit, ack and delay report timers (see Reliability and
+        #  RateController).
+        #
+        ######################################################################################
+        while 1:
+            self._WaitForFreeModem()
+            self._SendCondition.acquire()
+            try:
+                Queued = None
+                while len(self._SendQueue)==0:
+                    Deadline = self._GetControlDeadline()
+                    if Deadline!=None and Deadline <= time.time():
+                        break
+                    self._SendCondition.wait(None if Deadline==None else max(0.01, Deadline - time.time()))
+                if len(self._SendQueue) > 0:
+                    Queued = self._SendQueue.popleft()
+                    self._Metrics.Set("send_queue_depth", len(self._SendQueue))
+            finally:
+                self._SendCondition.release()
+            self._SendLock.acquire()
+            try:
+                if Queued!=None:
+                    ListOfMavlinkMessages, EncodedBuffer, Critical, Destination, JournalIds = Queued
+                    ListOfCommands = self._QueueTextMessages(ListOfMavlinkMessages, EncodedBuffer, Destination)
+                    if len(JournalIds) > 0 and ListOfCommands!=None:
+                        self._JournalSends.append((JournalIds, ListOfCommands))   #one that couldn't be sent stays for the next start
+                self._SendControlTraffic()
+            except Exception, e:
+                self.Logger("Exception in sender thread: %s", 1, e)
+            finally:
+                self._SendLock.release()
+
+    def GetTextMessageTelemetry(self, blocking=True, WithSender=False):
         ######################################################################################
         #
         #  Summary:  Requests all the unread text messages from the modem, parses the modem output into
         #  a list of text buffers (each containing one text message's payload), and then uses class helper
         #  functions to (in order):
-        #           1) decode each text message from Base64
-        #           2) decompress each text message with LZMA compression
+        #           1) decode each text message from Base64 (binary PDU text messages skip this step)
+        #           2) decompress each text message according to its payload format byte
         #           3) dissect each text message into multiple Mavlink messages
         #  Finally, function returns a list of Mavlink messages compiled from all unread text messages
+        #  In RECEIVE_MODE_NOTIFY only the text messages announced since the last call are read,
+        #  by index, after one full listing on the first call.
+        #  Text messages are deleted from the modem once read, so each call only costs as much as
+        #  the new text messages, and enveloped payloads received twice are dropped (see
+        #  DuplicateFilter).
+        #  Enveloped payloads are decoded in the order they were sent, so one that arrives early
+        #  is held back until the ones before it arrive or are given up on (see Envelope).
+        #  A backlog is decoded in parallel if BulkDecodeWorkers was given (see _DecodeReleased).
+        #  WithSender returns (Sender, MavlinkMessage) tuples instead, Sender being the first
+        #  phone number of the remote the message came from (see AddRemote), so a ground
+        #  station can tell its vehicles apart.
         #
         ######################################################################################
 
         if blocking==True:
-            self._ModemLock.acquire(True)
+            self._ReceiveLock.acquire(True)
         else:
-            ret=self._ModemLock.acquire(False)
+            ret=self._ReceiveLock.acquire(False)
             if ret==False:
                 return False
         try:
-            ListOfTextMessages = self._ModemConnection.listStoredSms()
-            ListOfMavlinkMessages=[]
-            for TextMessage in ListOfTextMessages:
-                #text message buffer contains multiple mavlink msgs wrapped in LZMA wrapped in Base64
-                MavlinkMessages = self.ConvertTextMessageToMavlink(TextMessage.text)
-                ListOfMavlinkMessages+=MavlinkMessages
-            self._ModemLock.release()
+            ReadStarted = time.time()
+            if self._ReceiveMode==RECEIVE_MODE_NOTIFY and self._InboxListed:
+                ListOfTextMessages = self._ReadNewPayloads()
+            else:
+                self._NewMessageEvent.clear()
+                self._NewMessages.clear()   #the listing covers them
+                self._InboxListed = True   #unless a listing fails
+                self._ReadFailed = False
+                ListOfTextMessages = self._ListStoredPayloads()
+            self._Metrics.Observe("inbox_read_seconds", time.time() - ReadStarted)
+            self._Metrics.Increment("text_messages_received_total", len(ListOfTextMessages))
+            Released = []   #(Sender, Timestamp, Payload), each sender's in the order sent
+            for Sender, Payload in ListOfTextMessages:
+                if self._ReceiveObserver!=None:
+                    self._ReceiveObserver(Sender, Payload, ReadStarted)
+                if Segmentation.IsSegment(Payload):
+                    Payload = self._Reassembler.AddSegment(Sender, Payload)
+                    if Payload==None:
+                        continue   #still waiting for the rest of the segments
+                #only an envelope's sequence number tells a repeat delivery from the same messages sent twice
+                if Envelope.IsEnveloped(Payload) and self._Duplicates.IsDuplicate(Sender, Payload):
+                    self.Logger("Dropping duplicate text message from %s", 2, Sender)
+                    self._Metrics.Increment("drops_total", Reason="duplicate")
+                    continue
+                for Timestamp, Payload in self._ReorderPayload(Sender, Payload):
+                    Released.append((Sender, Timestamp, Payload))
+            for Sender, Peer in list(self._Peers.items()):
+                for Timestamp, Payload in Peer.Reorder.Expire():
+                    Released.append((Sender, Timestamp, Payload))
+            ListOfMavlinkMessages = self._DecodeReleased(Released, WithSender)
+            self._Metrics.Increment("mavlink_messages_received_total", len(ListOfMavlinkMessages))
+            self._ReceiveLock.release()
             return ListOfMavlinkMessages
         except Exception, e:
-            self.Logger("Exception during GetTextMessage: "+str(e), message_importance=1)
-            self._ModemLock.release()
+            self.Logger("Exception during GetTextMessage: %s", 1, e)
+            self._ReceiveLock.release()
 
-    def WaitForResponse(self, StringToWaitFor, timeout=10):
+    def WaitForTextMessageTelemetry(self, timeout, WithSender=False):
         ######################################################################################
         #
-        #  Summary:  Helper function to parse modem responses looking for an expected response
-        #  contained in the input value "StringToWaitFor".  Times out if the response isn't returned.
-        #  This function is mostly used to make sure we get the expected "OK" from the modem before we
-        #  we continue on to the next modem command.
+        #  Summary:  Waits up to timeout seconds for text messages, then returns the mavlink
+        #  messages in them like GetTextMessageTelemetry().  In RECEIVE_MODE_NOTIFY it returns as
+        #  soon as the modem announces a text message, and the modem isn't touched at all if
+        #  none arrived.  In RECEIVE_MODE_POLL it sleeps for timeout and then lists the inbox.
+        #  Either way it returns early when payloads held back for reordering are due.
         #
         ######################################################################################
-        starttime = time.time()
+        Deadline = self._GetReorderDeadline()
+        if Deadline!=None:
+            timeout = max(0, min(timeout, Deadline - time.time()))
+        if self._ReceiveMode==RECEIVE_MODE_NOTIFY and self._InboxListed:
+            self._NewMessageEvent.wait(timeout)
+            if not self._NewMessageEvent.isSet() and (Deadline==None or time.time() < Deadline):
+                return []
+        elif self._ReceiveMode==RECEIVE_MODE_POLL or self._ReadFailed:
+            time.sleep(timeout)
+        return self.GetTextMessageTelemetry(blocking=True, WithSender=WithSender)
 
-        while (time.time() - starttime) < timeout:
-            ret = self._ModemConnection.readline()
-            if StringToWaitFor in ret:
-                return True
-            time.sleep(1)
-        self.Logger("Didn't get expected response from modem", message_importance=1)
+    def _DecodeReleased(self, Released, WithSender):
+        ######################################################################################
+        #
+        #  Summary:  Decodes the payloads released in order, a list of (Sender, Timestamp,
+        #  Payload), and returns their mavlink messages.  A backlog of BulkDecodeThreshold
+        #  payloads or more goes to the worker pool, if there is one (see BulkDecoder):  delta
+        #  records and payloads with a handler are still decoded here, in order, the rest by
+        #  the workers.  The senders' messages are then merged by send time and, with
+        #  CollapseBacklog, only the newest sample of each telemetry stream is kept.  Caller
+        #  holds the receive lock.
+        #
+        ######################################################################################
+        ListOfMavlinkMessages = []
+        if self._DecodePool==None or len(Released) < self._BulkDecodeThreshold:
+            for Sender, Timestamp, Payload in Released:
+                self._AppendMavlinkMessages(ListOfMavlinkMessages, Sender, Payload, WithSender)
+            return ListOfMavlinkMessages
+
+        DecodeStarted = time.time()
+        ListOfDecoded = []   #(Sender, Timestamp, messages or index of the job decoding them)
+        ListOfJobs = []
+        for Sender, Timestamp, Payload in Released:
+            if len(Payload)==0:
+                continue
+            Sender = self._GetPeerKey(Sender)
+            if ord(Payload[0]) in self._PayloadHandlers or ord(Payload[0]) in (FieldCodec.FORMAT_DELTA, FieldCodec.FORMAT_DELTA_RAW):
+                MavlinkMessages = []
+                self._AppendMavlinkMessages(MavlinkMessages, Sender, Payload, False)   #stateful, so decoded here in order
+                ListOfDecoded.append((Sender, Timestamp, MavlinkMessages))
+                continue
+            try:
+                ListOfJobs.append(BulkDecoder.PrepareJob(Payload, self._GetPeer(Sender).Framing))
+            except Exception, e:
+                self.Logger("Exception in ConvertPayloadToMavlink: %s", 1, e)
+                self._Metrics.Increment("drops_total", Reason="undecodable")
+                continue
+            ListOfDecoded.append((Sender, Timestamp, len(ListOfJobs) - 1))
+
+        Results = self._DecodePool.map(BulkDecoder.DecodeJob, ListOfJobs)
+        for Index in range(len(ListOfDecoded)):
+            Sender, Timestamp, MavlinkMessages = ListOfDecoded[Index]
+            if isinstance(MavlinkMessages, int):
+                MavlinkMessages = Results[MavlinkMessages]
+                if MavlinkMessages==None:
+                    self._Metrics.Increment("drops_total", Reason="undecodable")
+                    MavlinkMessages = []
+            ListOfDecoded[Index] = (Sender, Timestamp, MavlinkMessages)
+        Merged = BulkDecoder.MergeBySendTime(ListOfDecoded)
+        if self._CollapseBacklog:
+            Collapsed = BulkDecoder.CollapseStale(Merged, lambda MavlinkMessage: IsCritical(MavlinkMessage) or MavlinkMessage.get_type() in DEFAULT_ORDERED_TYPES)
+            self._Metrics.Increment("drops_total", len(Merged) - len(Collapsed), Reason="stale_backlog")
+            Merged = Collapsed
+        self._Metrics.Observe("bulk_decode_seconds", time.time() - DecodeStarted)
+        self.Logger("Decoded a backlog of %s payloads into %s messages", 2, len(Released), len(Merged))
+        if WithSender:
+            return Merged
+        return [MavlinkMessage for Sender, MavlinkMessage in Merged]
+
+    def _AppendMavlinkMessages(self, ListOfMavlinkMessages, Sender, Payload, WithSender):
+        #decodes a payload released in order onto the list; caller holds the receive lock
+        if len(Payload)==0:
+            return   #a bare ack, or a retransmission processed already
+        if ord(Payload[0]) in self._PayloadHandlers:
+            try:
+                self._PayloadHandlers[ord(Payload[0])](self._GetPeerKey(Sender), Payload)
+            except Exception, e:
+                self.Logger("Exception in payload handler: %s", 1, e)
+            return
+        #payload contains multiple mavlink msgs wrapped in compression
+        MavlinkMessages = self.ConvertPayloadToMavlink(Payload, Sender)
+        if not MavlinkMessages:
+            return
+        if WithSender:
+            Key = self._GetPeerKey(Sender)
+            ListOfMavlinkMessages += [(Key, MavlinkMessage) for MavlinkMessage in MavlinkMessages]
+        else:
+            ListOfMavlinkMessages += MavlinkMessages
+
+    def _ReorderPayload(self, Sender, Payload):
+        ######################################################################################
+        #
+        #  Summary:  Unwraps an enveloped payload and returns the list of payloads its sender's
+        #  reorder buffer releases, in the order they were sent, as (Timestamp, Payload)
+        #  tuples.  Bare payloads from senders without envelopes pass straight through.  Acks in the envelope are handed to the
+        #  sender's retransmit queue, timestamps to its delay tracking and delay reports to the
+        #  rate controller, and a
+        #  reliable payload received before is replaced by an empty one, so it still fills its
+        #  place in the order.  Caller holds the receive lock.
+        #
+        ######################################################################################
+        if not Envelope.IsEnveloped(Payload):
+            return [(None, Payload)]
+        try:
+            Sequence, Reliable, Ack, Timestamp, Delay, Payload = Envelope.UnwrapEnvelope(Payload)
+        except ValueError, e:
+            self.Logger("Skipping text message from %s: %s", 2, Sender, e)
+            self._Metrics.Increment("drops_total", Reason="bad_envelope")
+            return []
+        Peer = self._GetPeer(Sender)
+        if Ack!=None:
+            Peer.Retransmits.Acknowledge(Ack)
+        if Timestamp!=None:
+            Peer.Delays.RecordTimestamp(Timestamp)
+        if Delay!=None:
+            self._RateController.RecordReportedDelay(Delay)   #the modems and budget are shared by all peers
+        if Reliable!=None:
+            if not Peer.Acks.Receive(Reliable):
+                self.Logger("Dropping retransmission of reliable payload %s", 2, Reliable[1])
+                self._Metrics.Increment("drops_total", Reason="retransmission")
+                Payload = ""
+        if Reliable!=None or Peer.Delays.GetFeedbackDeadline()!=None:
+            self._SendCondition.acquire()
+            try:
+                self._WakeSender()   #to send an ack or delay report bare if nothing else goes out in time
+            finally:
+                self._SendCondition.release()
+        return Peer.Reorder.Add(Sequence, (Timestamp, Payload))
+
+    def _GetReorderDeadline(self):
+        #earliest time a reorder buffer gives up waiting for a missing payload, or None
+        Deadlines = [Peer.Reorder.GetNextDeadline() for Peer in list(self._Peers.values())]
+        Deadlines = [Deadline for Deadline in Deadlines if Deadline!=None]
+        if len(Deadlines)==0:
+            return None
+        return min(Deadlines)
+
+    def _OnModemNotification(self, ModemIndex, Line):
+        #called from the modem's reader thread, so only note the index; the read happens in GetTextMessageTelemetry()
+        CmtiMatch = CMTI_REGEX.match(Line)
+        if CmtiMatch:
+            self.Logger("New text message at index %s", 3, CmtiMatch.group(2))
+            self._NewMessages.append((ModemIndex, CmtiMatch.group(1), int(CmtiMatch.group(2))))
+            self._NewMessageEvent.set()
+
+    def _ReadNewPayloads(self):
+        ######################################################################################
+        #
+        #  Summary:  Reads the text messages announced by +CMTI since the last call, by index,
+        #  deletes the ones read, and returns them as (Sender, Payload) tuples like
+        #  _ListStoredPayloads().  All the reads are queued on the modem at once.  A text
+        #  message that can't be read stays on the modem for the next full listing.  Caller
+        #  holds the receive lock.
+        #
+        ######################################################################################
+        self._NewMessageEvent.clear()   #anything announced from here on sets it again
+        ListOfReads = []
+        while len(self._NewMessages) > 0:
+            ModemIndex, Memory, Index = self._NewMessages.popleft()
+            if self._ModemConnections[ModemIndex]==None:
+                continue
+            self._SelectMemory(ModemIndex, Memory)
+            ListOfReads.append((ModemIndex, Memory, Index, self._ModemConnections[ModemIndex].Submit('AT+CMGR={0}'.format(Index))))
+
+        ListOfPayloads = []
+        for ModemIndex, Memory, Index, Read in ListOfReads:
+            try:
+                ModemResponse = Read.Result()
+            except Exception, e:
+                self.Logger("Can't read the text message at index %s, leaving it on the modem: %s", 1, Index, e)
+                self._InboxListed = False   #the next call lists the inbox again
+                self._ReadFailed = True
+                continue
+            self._ParseStoredMessages(ModemResponse, ListOfPayloads)
+            self._DeleteMessages(ModemIndex, [Index], Memory)
+        return ListOfPayloads
+
+    def _ListStoredPayloads(self):
+        ######################################################################################
+        #
+        #  Summary:  Lists every text message stored on the modems, deletes them, and returns a
+        #  list of (Sender, Payload) tuples, where Payload is the binary payload: 8-bit PDU user
+        #  data as is, text messages un-Base64'd.  Text messages that aren't valid Base64 are
+        #  skipped.  The modems of a pool are listed at the same time.  Only the text messages
+        #  of a listing that succeeded are deleted, by index, so a listing that times out or
+        #  fails leaves its modem's text messages for the next call.  Caller holds the receive
+        #  lock.
+        #
+        ######################################################################################
+        ListOfListings = []
+        for ModemIndex in range(len(self._ModemConnections)):
+            if self._ModemConnections[ModemIndex]==None:
+                continue
+            if self._SmsMode==SMS_MODE_TEXT:
+                ListOfListings.append((ModemIndex, self._ModemConnections[ModemIndex].Submit('AT+CMGL="ALL"', Timeout=15)))
+            else:
+                ListOfListings.append((ModemIndex, self._ModemConnections[ModemIndex].Submit('AT+CMGL=4', Timeout=15)))   #4 = all messages
+        ListOfPayloads = []
+        for ModemIndex, Listing in ListOfListings:
+            try:
+                ModemResponse = Listing.Result()
+            except Exception, e:
+                self.Logger("Can't list the text messages on modem %s, leaving them there: %s", 1, ModemIndex, e)
+                self._InboxListed = False   #the next call lists the inbox again
+                self._ReadFailed = True
+                continue
+            self._DeleteMessages(ModemIndex, self._ParseStoredMessages(ModemResponse, ListOfPayloads))
+        return ListOfPayloads
+
+    def _ParseStoredMessages(self, ModemResponse, ListOfPayloads):
+        ######################################################################################
+        #
+        #  Summary:  Parses the response to AT+CMGL or AT+CMGR, a header line per text message
+        #  followed by its PDU (PDU mode) or its text (text mode), and appends a (Sender, Payload)
+        #  tuple per received text message to ListOfPayloads.  Returns the storage indexes of
+        #  the text messages listed (AT+CMGL), telemetry or not, for deletion.
+        #
+        ######################################################################################
+        Indexes = []
+        for Line in ModemResponse:
+            IndexMatch = CMGL_INDEX_REGEX.match(Line)
+            if IndexMatch:
+                Indexes.append(int(IndexMatch.group(1)))
+
+        if self._SmsMode==SMS_MODE_TEXT:
+            Sender = None
+            Text = None
+            for Line in ModemResponse + ["+CMGL:"]:   #the sentinel ends the last text message
+                if Line.startswith("+CMGL:") or Line.startswith("+CMGR:"):
+                    if Sender!=None:
+                        self._AppendTextPayload(ListOfPayloads, Sender, "".join(Text))
+                    HeaderMatch = TEXT_MODE_HEADER_REGEX.match(Line)
+                    Sender = HeaderMatch.group(2) if HeaderMatch else None   #no match: e.g. a status report
+                    Text = []
+                elif Sender!=None and Line!="OK":
+                    Text.append(Line)
+            return Indexes
+
+        for LineNumber in range(len(ModemResponse)-1):
+            if not (ModemResponse[LineNumber].startswith('+CMGL:') or ModemResponse[LineNumber].startswith('+CMGR:')):
+                continue
+            try:
+                Sender, DataCoding, UserData = SmsPdu.DecodeDeliverPdu(ModemResponse[LineNumber+1])
+            except Exception, e:
+                self.Logger("Skipping undecodable PDU: %s", 2, e)
+                continue
+            if DataCoding==SmsPdu.DATA_CODING_8BIT:
+                ListOfPayloads.append((Sender, UserData))
+            else:
+                self._AppendTextPayload(ListOfPayloads, Sender, UserData)
+        return Indexes
+
+    def _AppendTextPayload(self, ListOfPayloads, Sender, Text):
+        try:
+            ListOfPayloads.append((Sender, base64.b64decode(Text)))
+        except Exception, e:
+            self.Logger("Skipping non-telemetry text message from %s: %s", 2, Sender, e)
+
+    def _SelectMemory(self, ModemIndex, Memory):
+        #queues an AT+CPMS ahead of the reads if Memory isn't the storage selected already
+        if Memory!=None and Memory!=self._ReadMemory[ModemIndex]:
+            self._ModemConnections[ModemIndex].Submit('AT+CPMS="{0}"'.format(Memory))
+            self._ReadMemory[ModemIndex] = Memory
+
+    def _DeleteMessages(self, ModemIndex, Indexes, Memory=None):
+        ######################################################################################
+        #
+        #  Summary:  Queues the deletion of the text messages at Indexes, once their listing or
+        #  read has come back, so exactly what was processed is removed; anything that arrived
+        #  in the meantime stays.  Caller holds the receive lock.
+        #
+        ######################################################################################
+        if len(Indexes)==0:
+            return
+        self._SelectMemory(ModemIndex, Memory)
+        for Index in Indexes:
+            self._ModemConnections[ModemIndex].Submit('AT+CMGD={0}'.format(Index))
+
+    def _SubmitSms(self, ModemIndex, PhoneNumber, Payload):
+        ######################################################################################
+        #
+        #  Summary:  Queues one text message carrying Payload on a modem of the pool and returns
+        #  its ModemCommand.  In PDU mode the payload goes as 8-bit user data, in text mode
+        #  Base64'd.
+        #
+        ######################################################################################
+        Modem = self._ModemConnections[ModemIndex]
+        if self._SmsMode==SMS_MODE_PDU:
+            Pdu, TpduLength = SmsPdu.EncodeSubmitPdu(PhoneNumber, Payload)
+            return Modem.Submit('AT+CMGS={0}'.format(TpduLength), Priority=ModemEngine.PRIORITY_SEND,
+                                Timeout=SEND_TIMEOUT, Prompt='> ', Data=Pdu + ModemEngine.CTRL_Z)
+        return Modem.Submit('AT+CMGS="{0}"'.format(PhoneNumber), Priority=ModemEngine.PRIORITY_SEND,
+                            Timeout=SEND_TIMEOUT, Prompt='> ', Data=base64.b64encode(Payload) + ModemEngine.CTRL_Z)
+
+
+    def GetMaxPayloadLength(self):
+        ######################################################################################
+        #
+        #  Summary:  Largest payload returned by EncodeOutgoingPayload() that fits in one text
+        #  message once enveloped and timestamped: 114 bytes in text mode (160 Base64
+        #  characters), 134 bytes in PDU mode.  With ReliableTypes, 4 bytes less, since any
+        #  payload may carry one of them and with it a reliable header; a full payload would
+        #  otherwise go out as two segments.
+        #
+        ######################################################################################
+        Length = self._GetTextMessageCapacity() - Envelope.ENVELOPE_HEADER_LENGTH - Envelope.TIMESTAMP_LENGTH
+        if len(self._ReliableTypes) > 0:
+            Length -= Envelope.RELIABLE_HEADER_LENGTH
+        return Length
+
+    def _GetTextMessageCapacity(self):
+        #binary bytes one text message carries
+        if self._SmsMode==SMS_MODE_PDU:
+            return SmsPdu.MAX_USER_DATA_LENGTH
+        return MAX_TEXT_MODE_PAYLOAD_LENGTH
 
+    def EncodeOutgoingPayload(self, ListOfMavlinkMessages):
+        ######################################################################################
+        #
+        #  Summary:  Encodes a list of mavlink messages into a binary payload in this
+        #  connection's payload format.  SendTextMessageTelemetry() takes care of Base64'ing it
+        #  in text mode.  Its time is recorded as encode_seconds, trial encodes by a
+        #  PayloadSelector included.
+        #
+        ######################################################################################
+        EncodeStarted = time.time()
+        if self._PayloadFormat==FieldCodec.FORMAT_DELTA:
+            self._EncoderLock.acquire()
+            try:
+                Payload = self._DeltaEncoder.Encode(ListOfMavlinkMessages)
+            finally:
+                self._EncoderLock.release()
+        else:
+            Payload = PayloadCodec.EncodePayload(ListOfMavlinkMessages, self._PayloadFormat, self._DictionaryId)
+        self._Metrics.Observe("encode_seconds", time.time() - EncodeStarted)
+        return Payload
+
+    def GetMetrics(self):
+        return self._Metrics
 
     def ConvertMavlinkToTextMessage(self, ListOfMavlinkMessages):
         ######################################################################################
         #
-        #  Summary:  Take a list of mavlink messages, converts them to a single text buffer, crushes
-        #  the buffer size down with LZMA compression, encodes the compressed buffer in Base64, and
+        #  Summary:  Take a list of mavlink messages, converts them to a single binary payload in
+        #  this connection's payload format (see PayloadCodec), encodes the payload in Base64, and
         #  returns the encoded buffer.  Base64 is used to make the text buffer url/sms/email safe.
+        #  The default format primes the compressor with a preset dictionary whose id is carried
+        #  in the payload, so the receiving side picks the same one (see CompressionDictionary).
         #
         ######################################################################################
 
-        BufferOfMavlinkMessages = ""
-        for message in ListOfMavlinkMessages:
-            MessageInASCII = binascii.hexlify(message.get_msgbuf())
-            BufferOfMavlinkMessages+=MessageInASCII
-
-        CompressedMavlinkBuffer = pylzma.compress(BufferOfMavlinkMessages)
-        EncodedMavlinkBuffer = base64.b64encode(CompressedMavlinkBuffer)
-        TestMavlinkBuffer = base64.b64encode(BufferOfMavlinkMessages)  #debug
+        Payload = PayloadCodec.EncodePayload(ListOfMavlinkMessages, self._PayloadFormat, self._DictionaryId)
+        EncodedMavlinkBuffer = base64.b64encode(Payload)
         return EncodedMavlinkBuffer
 
 
     def ConvertTextMessageToMavlink(self, TextMessage):
         ######################################################################################
         #
-        #  Summary:  Takes a text message's payload text, unBase64's it, decompresses it with LZMA,
-        #  parses out the multiple Mavlink messages within the buffer, and a returns a list of
-        #  decoded Mavlink messages.  Base64 is used to make the text buffer url/sms/email safe.
+        #  Summary:  Takes a text message's payload text, unBase64's it, decompresses it according
+        #  to its payload format byte, parses out the multiple Mavlink messages within the buffer,
+        #  and a returns a list of decoded Mavlink messages.  Text messages sent in the original
+        #  LZMA format still decode.
         #
         ######################################################################################
         try:
             DecodedMavlinkBuffer = base64.b64decode(TextMessage)
-            DecompressedMavlinkBuffer = pylzma.decompress(DecodedMavlinkBuffer)
-            ListOfMavlinkMessages = self._MavlinkHelperObject.parse_buffer(DecompressedMavlinkBuffer)
+        except Exception, e:
+            self.Logger("Exception in ConvertTextMessagetoMavlink: %s", 1, e)
+            return None
+        return self.ConvertPayloadToMavlink(DecodedMavlinkBuffer, self._RemotePhoneNumber)
+
+
+    def ConvertPayloadToMavlink(self, Payload, Sender=None):
+        ######################################################################################
+        #
+        #  Summary:  Decompresses a binary payload according to its payload format byte and
+        #  returns the list of Mavlink messages within it.  Compact and delta encoded payloads
+        #  are rebuilt with the framing and reference state kept for their Sender, and each
+        #  payload is parsed with a fresh parser, so a partial frame never garbles the next.  An
+        #  envelope is stripped, without reordering (see GetTextMessageTelemetry).
+        #
+        ######################################################################################
+        try:
+            DecodeStarted = time.time()
+            if Envelope.IsEnveloped(Payload):
+                Sequence, Payload = Envelope.UnwrapPayload(Payload)
+            Peer = self._GetPeer(Sender)
+            if ord(Payload[0]) in (FieldCodec.FORMAT_DELTA, FieldCodec.FORMAT_DELTA_RAW):
+                DecompressedMavlinkBuffer = Peer.DeltaDecoder.Decode(Payload)
+            else:
+                DecompressedMavlinkBuffer = PayloadCodec.DecodePayload(Payload, Peer.Framing)
+            ListOfMavlinkMessages = mavlink.MAVLink(fifo()).parse_buffer(DecompressedMavlinkBuffer)   #a bad payload can't garble the next
+            self._Metrics.Observe("decode_seconds", time.time() - DecodeStarted)
             return ListOfMavlinkMessages
         except Exception, e:
-            self.Logger("Exception in ConvertTextMessagetoMavlink: "+str(e), message_importance=1)
+            self.Logger("Exception in ConvertPayloadToMavlink: %s", 1, e)
+            self._Metrics.Increment("drops_total", Reason="undecodable")
             return None
 
 
+    def AddRemote(self, PhoneNumbers):
+        ######################################################################################
+        #
+        #  Summary:  Registers a remote vehicle or ground station by its phone number, or the
+        #  list of numbers of its modem pool, and returns its first number, which identifies it
+        #  from then on (Destination, WithSender).  Senders that were never added still get
+        #  their own state, keyed by the number the modem reports.
+        #
+        ######################################################################################
+        if not isinstance(PhoneNumbers, (list, tuple)):
+            PhoneNumbers = [PhoneNumbers]
+        Key = PhoneNumbers[0]
+        self._PeerLock.acquire()
+        try:
+            if Key not in self._Peers:
+                self._Peers[Key] = _RemotePeer(list(PhoneNumbers))
+            for PhoneNumber in PhoneNumbers:
+                self._PeerKeys[PhoneNumber] = Key
+            return Key
+        finally:
+            self._PeerLock.release()
+
+    def _GetPeerKey(self, Sender):
+        #the numbers of a remote modem pool share the state of its first one
+        self._PeerLock.acquire()
+        try:
+            if Sender in self._PeerKeys:
+                return self._PeerKeys[Sender]
+            Key = Sender
+            SenderDigits = re.sub(r'\D', '', str(Sender))
+            for PhoneNumber, PeerKey in self._PeerKeys.items():
+                Digits = re.sub(r'\D', '', str(PhoneNumber))
+                if SenderDigits and Digits and (SenderDigits.endswith(Digits) or Digits.endswith(SenderDigits)):
+                    Key = PeerKey   #senders usually come with the country code
+                    break
+            self._PeerKeys[Sender] = Key
+            if Key not in self._Peers:
+                self._Peers[Key] = _RemotePeer([Sender])
+            return Key
+        finally:
+            self._PeerLock.release()
+
+    def _GetPeer(self, Sender):
+        return self._Peers[self._GetPeerKey(Sender)]
+
+
     def PurgeIncomingTextMessages(self, timeout=90, blocking=True):
         ######################################################################################
         #
@@ -271,29 +1402,32 @@ class TextMessageTelemetry(object):
         ######################################################################################
 
         if blocking==True:
-            self._ModemLock.acquire(True)
+            self._ReceiveLock.acquire(True)
         else:
-            ret=self._ModemLock.acquire(False)
+            ret=self._ReceiveLock.acquire(False)
             if ret==False:
                 return False
 
-        starttime=time.time()
-        while (time.time()-starttime) < timeout:
-            self._ModemConnection.write("AT+CMGL(0,4)\r\n")  #wipe modem memory
-            self.WaitForResponse("OK")
-            time.sleep(5)                                    #allow time for modem to receive any waiting SMS's
-            self._ModemConnection.write('AT+CMGD="ALL"\r\n') #check if modem SMS memory is empty
-            ret=self._ModemConnection.readline()
-            if ret=="OK":                                    #it's empty, purge is complete
-                self._ModemLock.release()
-                return True
-            else:                                            #there were SMS's bottlenecked on network, purge again
-                continue
-
-        self._ModemLock.release()
-        return False
-
-
-
-
-
+        try:
+            starttime=time.time()
+            Modems = [Modem for Modem in self._ModemConnections if Modem!=None]
+            while (time.time()-starttime) < timeout:
+                for Modem in Modems:
+                    Modem.Execute('AT+CMGD=1,4')                   #wipe modem memory
+                self._NewMessages.clear()
+                self._NewMessageEvent.clear()
+                time.sleep(5)                                      #allow time for modem to receive any waiting SMS's
+                Empty = True
+                for Modem in Modems:
+                    StorageMatch = CPMS_REGEX.match(Modem.Execute('AT+CPMS?')[0])
+                    if not (StorageMatch and int(StorageMatch.group(1))==0):
+                        Empty = False
+                if Empty:                                          #it's empty, purge is complete
+                    return True
+                #there were SMS's bottlenecked on network, purge again
+            return False
+        except Exception, e:
+            self.Logger("Exception during PurgeIncomingTextMessages: %s", 1, e)
+            return False
+        finally:
+            self._ReceiveLock.release()
@@ -0,0 +1,118 @@
+
+# VehicleSender.py
+# Summary:  The vehicle's send path:  queues what the autopilot sends and decides when to fill a
+# text message with the most valuable of it
+# ChamBana03@gmail.com
+#
+# LaunchTelemetry.py hands HandleAutopilotMessage every message from the autopilot and
+# benchmarks/EndToEndBenchmark.py the messages of a log, so the benchmark measures the code the
+# vehicle runs.  Messages coalesce in a CoalescingQueue; a text message goes out as soon as one
+# must (an ack or other critical message), once the due telemetry fills one, or once telemetry
+# has waited MaxSecondsBetweenTextMessages.  PayloadSelector picks what goes in it and the rest
+# stays queued.
+#
+# With a StateSyncer, parameters and mission items are kept in step by StateSync instead, and
+# only texted as telemetry for SyncedReadSeconds after the ground station reads them the
+# MAVLink way (see HandleGroundCommand).
+
+import threading
+import time
+from CoalescingQueue import CoalescingQueue, IsCritical, DEFAULT_ORDERED_TYPES
+from PayloadSelector import PayloadSelector
+from SendJournal import DEFAULT_JOURNAL_TYPES
+
+MAX_SECONDS_BETWEEN_TEXT_MESSAGES = 10
+SYNCED_READ_SECONDS = 120
+SYNCED_TYPES = ("PARAM_VALUE", "MISSION_COUNT", "MISSION_ITEM", "MISSION_ITEM_INT")
+SYNCED_READ_TYPES = ("PARAM_REQUEST_LIST", "PARAM_REQUEST_READ", "PARAM_SET", "MISSION_REQUEST_LIST", "MISSION_REQUEST", "MISSION_REQUEST_INT")
+
+
+class VehicleSender(object):
+    def __init__(self, TextMessagingConnection, StateSyncer=None,
+                 MaxSecondsBetweenTextMessages=MAX_SECONDS_BETWEEN_TEXT_MESSAGES, SyncedReadSeconds=SYNCED_READ_SECONDS):
+        ######################################################################################
+        #
+        #  Summary:  Sends through TextMessagingConnection, a connected TextMessageTelemetry.
+        #  StateSyncer is the vehicle's StateSync, or None to text parameters and mission
+        #  items like any other telemetry.
+        #
+        ######################################################################################
+        self._Connection = TextMessagingConnection
+        self._StateSyncer = StateSyncer
+        self._MaxSecondsBetweenTextMessages = MaxSecondsBetweenTextMessages
+        self._SyncedReadSeconds = SyncedReadSeconds
+        self._MessageQueue = CoalescingQueue()   #newest sample of each telemetry stream, plus ACKs and other must-send messages
+        self._MessageQueueLock = threading.Lock()   #only one caller builds a text message at a time
+        self._MessageSelector = PayloadSelector(TextMessagingConnection.EncodeOutgoingPayload,
+                                                MaxLength=TextMessagingConnection.GetMaxPayloadLength(),
+                                                ValueFunction=self._MessageQueue.GetMessageValue, MandatoryFunction=IsCritical,
+                                                OrderedTypes=DEFAULT_ORDERED_TYPES)
+        self._SyncedReadsUntil = 0   #time until which the ground station is reading parameters or mission the MAVLink way
+
+    def SetJournal(self, Journal, JournalTypes=DEFAULT_JOURNAL_TYPES):
+        #journals the queued messages of JournalTypes; open the same Journal on the connection first
+        self._MessageQueue.SetJournal(Journal, JournalTypes)
+
+    def HandleAutopilotMessage(self, MavlinkMessage):
+        ######################################################################################
+        #
+        #  Summary:  Queues a message from the autopilot and sends a text message if one is
+        #  due.  Called for every message, e.g. as DroneKit's mavlink callback.
+        #
+        ######################################################################################
+        try:
+            if MavlinkMessage==None:
+                return
+            if MavlinkMessage.get_type()=="BAD_DATA":
+                return
+            if self._StateSyncer!=None:
+                self._StateSyncer.RecordMavlink(MavlinkMessage)
+                if MavlinkMessage.get_type() in SYNCED_TYPES and time.time() > self._SyncedReadsUntil:
+                    return   #the ground station gets these by sync, not one text message after another
+            self._MessageQueue.Put(MavlinkMessage)
+
+            #when the GSM network backs up or the text message budget runs low, each stream is sampled less
+            #often, so text messages fill up more slowly instead of going out late
+            RateScale = self._Connection.GetRateScale()
+            self._MessageQueue.SetRateScale(RateScale)
+
+            #the sender thread does the slow modem work; while it's still busy with the last text message,
+            #telemetry keeps coalescing in the queue rather than piling up stale in the send queue
+            if self._MessageQueue.HasCritical():
+                SendNow = True
+            elif self._Connection.GetQueuedSendCount() > 0 or not self._Connection.IsWithinBudget():
+                SendNow = False
+            else:
+                DueBytes = self._MessageQueue.GetDueBytes()
+                SendNow = (DueBytes > 0 and self._MessageQueue.GetSecondsWaiting() > self._MaxSecondsBetweenTextMessages/RateScale) \
+                    or self._MessageSelector.EstimateEncodedLength(DueBytes) >= self._Connection.GetMaxPayloadLength()
+
+            if SendNow:
+                if self._MessageQueueLock.acquire(False)==False:
+                    return  #another caller is already building one; this message stays queued for the next text message
+                try:
+                    self._SendQueuedTelemetry()
+                finally:
+                    self._MessageQueueLock.release()
+        except Exception, e:
+            print "Exception in Pixhawk callback", str(e)
+
+    def HandleGroundCommand(self, MavlinkMessage):
+        #call with every message from the ground station before it goes to the autopilot
+        if MavlinkMessage.get_type() in SYNCED_READ_TYPES:
+            self._SyncedReadsUntil = time.time() + self._SyncedReadSeconds   #the ground station missed its cache, so text the answers
+
+    def _SendQueuedTelemetry(self):
+        #fill one text message with the most valuable messages in the queue; whatever doesn't fit goes back
+        ListOfMavlinkMessages, OutgoingBuffer, LeftoverMessages = self._MessageSelector.Select(self._MessageQueue.TakeMessages())
+        self._MessageQueue.ReturnMessages(LeftoverMessages)
+        if len(ListOfMavlinkMessages)==0:
+            return
+
+        Critical = any([IsCritical(message) for message in ListOfMavlinkMessages])  #never let a busy modem drop an ACK
+        #the send takes over the queue's journal entries, so a crash before the modem is done resends them once
+        if self._Connection.Submit(ListOfMavlinkMessages, EncodedBuffer=OutgoingBuffer, Critical=Critical,
+                                   JournalIds=self._MessageQueue.GetJournalIds(ListOfMavlinkMessages)):
+            self._MessageQueue.MarkSent(ListOfMavlinkMessages, JournalHandedOver=True)
+        else:
+            self._MessageQueue.ReturnMessages(ListOfMavlinkMessages)  #refused by a full send queue; still queued and journaled
@@ -0,0 +1,247 @@
+
+# VehicleStateCache.py
+# Summary:  Ground station copy of a vehicle's slow-changing state, used to answer the GCS's
+# read requests locally instead of with a round trip over SMS
+# ChamBana03@gmail.com
+#
+# A GCS keeps asking for things that rarely change:  the parameter list when it connects, the
+# mission whenever its plan view opens, the autopilot capabilities, and it wants a heartbeat
+# every second or it declares the link lost.  Over SMS each of those is a round trip of
+# seconds to minutes and, for the parameter list, hundreds of PARAM_VALUE messages.
+#
+# The cache records what the vehicle sends (frames as the GCS sees them, i.e. after any
+# FleetRouter rewriting) and Answer() looks at what the GCS sends:
+#   -- HEARTBEAT:  the last one is re-emitted every second (GetHeartbeat) for up to
+#      HEARTBEAT_HOLD_SECONDS, so a vehicle that really went silent is still noticed
+#   -- PARAM_REQUEST_LIST / PARAM_REQUEST_READ:  answered once every parameter has been seen
+#   -- MISSION_REQUEST_LIST / MISSION_REQUEST(_INT):  answered once the count and every item
+#      have been seen, and the MISSION_ACK closing a locally answered read is swallowed
+#   -- AUTOPILOT_VERSION and HOME_POSITION requests (COMMAND_LONG):  answered with the cached
+#      message plus a COMMAND_ACK
+# Misses and all writes go over SMS.  A PARAM_SET keeps that parameter a miss until the
+# vehicle echoes the new value; a mission upload or clear drops the cached mission.
+#
+# Parameters and mission can also be filled in ahead of the GCS asking, from a StateSync
+# table (LoadSync), so the GCS's first read is answered locally too.
+
+import struct
+import threading
+import time
+import MavlinkFraming
+import StateSync
+
+HEARTBEAT_HOLD_SECONDS = 300.0   #heartbeats are re-emitted for this long after the vehicle's last one
+
+MAV_CMD_GET_HOME_POSITION = 410
+MAV_CMD_REQUEST_AUTOPILOT_CAPABILITIES = 520
+MAV_RESULT_ACCEPTED = 0
+COMMAND_ACK_ID = 77
+PARAM_VALUE_ID = 22
+MISSION_COUNT_ID = 44
+GCS_SYSTEM_ID = 255              #target of the mission messages rebuilt from a sync
+
+#message the vehicle answers each cached COMMAND_LONG with
+CACHED_COMMANDS = {
+    MAV_CMD_REQUEST_AUTOPILOT_CAPABILITIES: "AUTOPILOT_VERSION",
+    MAV_CMD_GET_HOME_POSITION: "HOME_POSITION",
+}
+PARAM_INDEX_UNKNOWN = 65535      #PARAM_VALUE sent after a PARAM_SET may not carry its index
+
+
+class VehicleStateCache(object):
+    def __init__(self, HeartbeatHoldSeconds=HEARTBEAT_HOLD_SECONDS):
+        ######################################################################################
+        #
+        #  Summary:  Cache for one vehicle.  Thread safe:  recorded from the telemetry loop,
+        #  answered from the GCS listeners.
+        #
+        ######################################################################################
+        self._HeartbeatHoldSeconds = HeartbeatHoldSeconds
+        self._Lock = threading.Lock()
+        self._Heartbeat = None
+        self._HeartbeatTime = None
+        self._ParamCount = None
+        self._Params = {}             #param index -> PARAM_VALUE frame
+        self._ParamIndexes = {}       #param id -> param index
+        self._PendingParams = set()   #param ids written but not echoed by the vehicle yet
+        self._MissionCount = None     #MISSION_COUNT frame
+        self._MissionItemCount = None
+        self._MissionItems = {}       #(message type, seq) -> MISSION_ITEM or MISSION_ITEM_INT frame
+        self._MissionReadLocal = False
+        self._Messages = {}           #message type -> last frame, for CACHED_COMMANDS
+        self._AckFraming = MavlinkFraming.FrameBuilder()
+        self._SyncFraming = MavlinkFraming.FrameBuilder()
+
+    def Record(self, MavlinkMessage, Frame, now=None):
+        ######################################################################################
+        #
+        #  Summary:  Takes a message from the vehicle and the frame handed to the GCS for it
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        Type = MavlinkMessage.get_type()
+        self._Lock.acquire()
+        try:
+            if Type=="HEARTBEAT":
+                self._Heartbeat = Frame
+                self._HeartbeatTime = now
+            elif Type=="PARAM_VALUE":
+                self._RecordParam(MavlinkMessage, Frame)
+            elif Type=="MISSION_COUNT":
+                self._MissionCount = Frame   #the start of a read:  the items follow
+                self._MissionItemCount = MavlinkMessage.count
+                self._MissionItems = {}
+            elif Type in ("MISSION_ITEM", "MISSION_ITEM_INT"):
+                self._MissionItems[(Type, MavlinkMessage.seq)] = Frame
+            elif Type in CACHED_COMMANDS.values():
+                self._Messages[Type] = Frame
+        finally:
+            self._Lock.release()
+
+    def _RecordParam(self, MavlinkMessage, Frame):
+        #caller holds the lock
+        ParamId = MavlinkMessage.param_id
+        Index = MavlinkMessage.param_index
+        if Index==PARAM_INDEX_UNKNOWN:
+            Index = self._ParamIndexes.get(ParamId)
+            if Index==None:
+                return   #a parameter not seen in a listing yet
+        else:
+            self._ParamCount = MavlinkMessage.param_count
+            self._ParamIndexes[ParamId] = Index
+        self._Params[Index] = Frame
+        self._PendingParams.discard(ParamId)
+
+    def Answer(self, MavlinkMessage):
+        ######################################################################################
+        #
+        #  Summary:  Takes a message from the GCS meant for the vehicle and returns
+        #  (ListOfFrames, Forward):  the frames answering it from the cache, to hand the GCS,
+        #  and whether it still has to go to the vehicle over SMS.
+        #
+        ######################################################################################
+        Type = MavlinkMessage.get_type()
+        self._Lock.acquire()
+        try:
+            if Type=="PARAM_REQUEST_LIST":
+                if self._HasAllParams():
+                    return [self._Params[Index] for Index in range(self._ParamCount)], False
+            elif Type=="PARAM_REQUEST_READ":
+                Frame = self._GetParam(MavlinkMessage)
+                if Frame!=None:
+                    return [Frame], False
+            elif Type=="PARAM_SET":
+                self._PendingParams.add(MavlinkMessage.param_id)
+            elif Type=="MISSION_REQUEST_LIST":
+                self._MissionReadLocal = self._HasMission("MISSION_ITEM") or self._HasMission("MISSION_ITEM_INT")
+                if self._MissionReadLocal:
+                    return [self._MissionCount], False
+            elif Type in ("MISSION_REQUEST", "MISSION_REQUEST_INT"):
+                ItemType = "MISSION_ITEM_INT" if Type=="MISSION_REQUEST_INT" else "MISSION_ITEM"
+                Frame = self._MissionItems.get((ItemType, MavlinkMessage.seq))
+                if self._MissionReadLocal and Frame!=None:
+                    return [Frame], False
+                self._MissionReadLocal = False   #the vehicle has to finish this read
+            elif Type=="MISSION_ACK":
+                if self._MissionReadLocal:
+                    self._MissionReadLocal = False
+                    return [], False   #closes a read the vehicle never saw
+            elif Type in ("MISSION_COUNT", "MISSION_CLEAR_ALL"):
+                self._MissionCount = None   #an upload or clear:  the cached mission is stale
+                self._MissionItemCount = None
+                self._MissionItems = {}
+                self._MissionReadLocal = False
+            elif Type=="COMMAND_LONG" and MavlinkMessage.command in CACHED_COMMANDS:
+                Frame = self._Messages.get(CACHED_COMMANDS[MavlinkMessage.command])
+                if Frame!=None:
+                    return [Frame, self._BuildCommandAck(Frame, MavlinkMessage.command)], False
+            return [], True
+        finally:
+            self._Lock.release()
+
+    def LoadSync(self, Table, SyncTable):
+        ######################################################################################
+        #
+        #  Summary:  Replaces the cached parameters (StateSync.TABLE_PARAMS) or mission
+        #  (StateSync.TABLE_MISSION) with the synced table, rebuilt as the frames the vehicle
+        #  would send, from the sysid/compid of its heartbeat.  Returns False if there's no
+        #  heartbeat to take them from yet, or the table is empty.
+        #
+        ######################################################################################
+        Items = SyncTable.GetItems()
+        self._Lock.acquire()
+        try:
+            if self._Heartbeat==None or len(Items)==0:
+                return False
+            Sequence, SystemId, ComponentId, MessageId, Payload = MavlinkFraming.SplitFrame(self._Heartbeat)
+            if Table==StateSync.TABLE_PARAMS:
+                self._Params = {}
+                self._ParamIndexes = {}
+                for ParamId, Value in Items:
+                    ParamValue, Index, Count, ParamType = struct.unpack("<fHHB", Value)
+                    Payload = struct.pack("<fHH16sB", ParamValue, Count, Index, ParamId, ParamType)
+                    self._Params[Index] = self._SyncFraming.BuildFrame(SystemId, ComponentId, PARAM_VALUE_ID, Payload)
+                    self._ParamIndexes[ParamId] = Index
+                    self._ParamCount = Count
+            elif Table==StateSync.TABLE_MISSION:
+                self._MissionItems = {}
+                for Key, Value in Items:
+                    ItemId, Payload = ord(Value[0]), Value[1:]
+                    Offset = MavlinkFraming.GetFieldOffset(ItemId, "target_system")
+                    if Offset!=None:
+                        Payload = Payload[:Offset] + chr(GCS_SYSTEM_ID) + Payload[Offset+1:]
+                    Type = MavlinkFraming.GetMessageClass(ItemId).name
+                    self._MissionItems[(Type, struct.unpack("<H", Key)[0])] = \
+                        self._SyncFraming.BuildFrame(SystemId, ComponentId, ItemId, Payload)
+                self._MissionItemCount = len(Items)
+                self._MissionCount = self._SyncFraming.BuildFrame(SystemId, ComponentId, MISSION_COUNT_ID,
+                                                                  struct.pack("<HBB", len(Items), GCS_SYSTEM_ID, 0))
+            return True
+        finally:
+            self._Lock.release()
+
+    def GetHeartbeat(self, now=None):
+        ######################################################################################
+        #
+        #  Summary:  The vehicle's last heartbeat frame, to re-emit to the GCS every second,
+        #  or None if there is none from the last HEARTBEAT_HOLD_SECONDS
+        #
+        ######################################################################################
+        if now==None:
+            now = time.time()
+        if self._Heartbeat==None or now - self._HeartbeatTime > self._HeartbeatHoldSeconds:
+            return None
+        return self._Heartbeat
+
+    def _HasAllParams(self):
+        return self._ParamCount!=None and len(self._PendingParams)==0 and \
+            len([Index for Index in self._Params if Index < self._ParamCount])==self._ParamCount
+
+    def _GetParam(self, MavlinkMessage):
+        #caller holds the lock
+        Index = MavlinkMessage.param_index
+        if Index < 0:
+            Index = self._ParamIndexes.get(MavlinkMessage.param_id)
+        Frame = self._Params.get(Index)
+        if Frame==None:
+            return None
+        for ParamId, ParamIndex in self._ParamIndexes.items():
+            if ParamIndex==Index and ParamId in self._PendingParams:
+                return None
+        return Frame
+
+    def _HasMission(self, ItemType):
+        if self._MissionCount==None:
+            return False
+        for Sequence in range(self._MissionItemCount):
+            if (ItemType, Sequence) not in self._MissionItems:
+                return False
+        return True
+
+    def _BuildCommandAck(self, Frame, Command):
+        #COMMAND_ACK from the vehicle's sysid/compid, as the vehicle would send it
+        Sequence, SystemId, ComponentId, MessageId, Payload = MavlinkFraming.SplitFrame(Frame)
+        Payload = struct.pack("<HB", Command, MAV_RESULT_ACCEPTED)
+        Payload += "\0"*(MavlinkFraming.GetPayloadLength(COMMAND_ACK_ID) - len(Payload))
+        return self._AckFraming.BuildFrame(SystemId, ComponentId, COMMAND_ACK_ID, Payload)
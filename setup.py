@@ -74,7 +74,7 @@ setup(
     # your project is installed. For an analysis of "install_requires" vs pip's
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
-    install_requires=['pymavlink', 'python-gsmmodem','pylzma','dronekit'],
+    install_requires=['pymavlink', 'pyserial','pylzma','dronekit'],
 
 
     # List additional groups of dependencies here (e.g. development
@@ -88,6 +88,7 @@ setup(
     # installed, specify them here.  If using Python 2.6 or less, then these
     # have to be included in MANIFEST.in as well.
     package_data={
+        'dronekit_texting': ['dictionaries/*.dict'],
     },
 
     # Although 'package_data' is the preferred approach, in some case you may
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+# QueryTelemetryLog.py
+# Summary:  Queries a ground station recording (RECORD_PATH in LaunchTelemetry.py) through its index
+# ChamBana03@gmail.com
+#
+# Usage:
+#   python tools/QueryTelemetryLog.py flight.tlog
+#   python tools/QueryTelemetryLog.py --type GPS_RAW_INT [--type ATTITUDE] [--start 60] [--end 120] flight.tlog
+#   python tools/QueryTelemetryLog.py --latency [--start 60] [--end 120] flight.tlog
+#
+# --start and --end are seconds since the recording began.  Without --type or --latency, prints
+# how long the recording is and how many messages of each type it holds.  The tlog itself opens in
+# MAVProxy, mavlogdump.py or APM Planner as usual.
+
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import time
+from dronekit_texting.TelemetryRecorder import TelemetryLog
+
+
+def PrintSummary(Log, Start, End):
+    Counts = {}
+    for RecordTime, MavlinkMessage in Log.GetMessages(Start=Start, End=End):
+        Counts[MavlinkMessage.get_type()] = Counts.get(MavlinkMessage.get_type(), 0) + 1
+    TimeRange = Log.GetTimeRange()
+    print "Recorded", time.ctime(TimeRange[0]), "to", time.ctime(TimeRange[1]), "(%.0f s)" % (TimeRange[1] - TimeRange[0])
+    print "Text messages:", len(Log.GetTextMessages(Start, End))
+    for Type in sorted(Counts):
+        print "%-32s %d" % (Type, Counts[Type])
+
+
+def PrintLatencies(Log, Start, End):
+    Latencies = sorted(Log.GetTextMessageLatencies(Start, End))
+    if len(Latencies)==0:
+        print "No text messages with a send time"
+        return
+    print "Text message latency, seconds (includes the offset between the vehicle's and ground station's clocks):"
+    print "  count", len(Latencies)
+    for Percentile in (0, 50, 90, 99, 100):
+        print "  p%-4d %d" % (Percentile, Latencies[min(len(Latencies) - 1, len(Latencies)*Percentile//100)])
+
+
+if __name__ == "__main__":
+    Arguments = sys.argv[1:]
+    if len(Arguments)==0:
+        print "Usage: QueryTelemetryLog.py [--type TYPE ...] [--latency] [--start SECONDS] [--end SECONDS] flight.tlog"
+        sys.exit(1)
+
+    Types = []
+    while "--type" in Arguments:
+        Types.append(Arguments[Arguments.index("--type")+1])
+        del Arguments[Arguments.index("--type"):Arguments.index("--type")+2]
+    Offsets = {}
+    for Option in ("--start", "--end"):
+        if Option in Arguments:
+            Offsets[Option] = float(Arguments[Arguments.index(Option)+1])
+            del Arguments[Arguments.index(Option):Arguments.index(Option)+2]
+    Latency = "--latency" in Arguments
+    if Latency:
+        Arguments.remove("--latency")
+
+    Log = TelemetryLog(Arguments[0])
+    TimeRange = Log.GetTimeRange()
+    if TimeRange==None:
+        print "Nothing recorded"
+        sys.exit(0)
+    Start = TimeRange[0] + Offsets["--start"] if "--start" in Offsets else None
+    End = TimeRange[0] + Offsets["--end"] if "--end" in Offsets else None
+
+    if Latency:
+        PrintLatencies(Log, Start, End)
+    elif len(Types) > 0:
+        for RecordTime, MavlinkMessage in Log.GetMessages(Types, Start, End):
+            print "%.3f" % (RecordTime - TimeRange[0]), MavlinkMessage
+    else:
+        PrintSummary(Log, Start, End)
+    Log.Close()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# TrainCompressionDictionary.py
+# Summary:  Trains a preset compression dictionary for text message payloads from telemetry logs
+# ChamBana03@gmail.com
+#
+# Usage:
+#   python tools/TrainCompressionDictionary.py --id 2 flight1.tlog [flight2.tlog ...]
+#   python tools/TrainCompressionDictionary.py --id 1 --synthetic
+#
+# The dictionary is written to dronekit_texting/dictionaries/mavlink_<id>.dict.  Pick a new id
+# whenever you retrain; the id is sent in every text message, and both the vehicle and the ground
+# station need the same dictionary file installed.  Dictionary 1, shipped with the package, was
+# built with --synthetic: a simulated rover drive at the ArduPilot SITL home location.
+
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import math
+import struct
+from dronekit_texting import CompressionDictionary
+from dronekit_texting.TelemetryRecorder import LoadTelemetryLog
+
+
+def LoadFramesFromTelemetryLogs(ListOfPaths):
+    ListOfFrames = []
+    for Path in ListOfPaths:
+        ListOfFrames += [message.get_msgbuf() for message in LoadTelemetryLog(Path)]
+    return ListOfFrames
+
+
+def _X25Crc(Buffer):
+    Crc = 0xffff
+    for Character in Buffer:
+        Temp = ord(Character) ^ (Crc & 0xff)
+        Temp = (Temp ^ (Temp << 4)) & 0xff
+        Crc = ((Crc >> 8) ^ (Temp << 8) ^ (Temp << 3) ^ (Temp >> 4)) & 0xffff
+    return Crc
+
+
+def _Frame(Sequence, MessageId, CrcExtra, Payload):
+    Header = struct.pack("<BBBBB", len(Payload), Sequence & 0xff, 1, 1, MessageId)
+    Crc = _X25Crc(Header + Payload + chr(CrcExtra))
+    return "\xfe" + Header + Payload + struct.pack("<H", Crc)
+
+
+def GenerateSyntheticFrames(Seconds=600):
+    ######################################################################################
+    #
+    #  Summary:  Generates the mavlink 1.0 frames an ArduPilot rover streams at its default
+    #  rates while driving a slow circle around the SITL home location.  Used to build the
+    #  dictionary shipped with the package, where no real logs are available.
+    #
+    ######################################################################################
+    ListOfFrames = []
+    Sequence = 0
+    HomeLat, HomeLon = -35.363261, 149.165230
+    for Tick in range(Seconds*4):
+        TimeBootMs = 5000 + Tick*250
+        Heading = (Tick*0.5) % 360.0
+        Lat = int((HomeLat + 0.0005*math.sin(math.radians(Heading)))*1e7)
+        Lon = int((HomeLon + 0.0005*math.cos(math.radians(Heading)))*1e7)
+        Roll = 0.02*math.sin(Tick/7.0)
+        Pitch = 0.01*math.cos(Tick/5.0)
+        Yaw = math.radians(Heading) - math.pi
+        Speed = 2.0 + 0.1*math.sin(Tick/11.0)
+
+        Frames = [
+            (30, 39, struct.pack("<Iffffff", TimeBootMs, Roll, Pitch, Yaw, 0.001, -0.002, 0.035)),
+            (74, 20, struct.pack("<ffffhH", 0.0, Speed, 584.1, 0.0, int(Heading), 23)),
+        ]
+        if Tick % 2==0:
+            Frames += [
+                (33, 104, struct.pack("<IiiiihhhH", TimeBootMs, Lat, Lon, 584090, 10, int(Speed*100), 0, 0, int(Heading*100))),
+                (62, 183, struct.pack("<fffffhhH", Roll*57.3, Pitch*57.3, 0.0, 0.0, 0.12, int(Heading), int(Heading), 71)),
+                (36, 222, struct.pack("<IHHHHHHHHB", TimeBootMs*1000, 1500, 0, 1620, 0, 0, 0, 0, 0, 0)),
+                (35, 244, struct.pack("<IHHHHHHHHBB", TimeBootMs, 1500, 1500, 1620, 1500, 1100, 1100, 1100, 1100, 0, 255)),
+            ]
+        if Tick % 4==0:
+            Frames += [
+                (0, 50, struct.pack("<IBBBBB", 10, 10, 3, 217, 4, 3)),
+                (1, 124, struct.pack("<IIIHHhHHHHHHb", 0x0020fc0f, 0x0020fc0f, 0x0020fc0f, 210, 12150, 340, 0, 0, 0, 0, 0, 0, 87)),
+                (24, 24, struct.pack("<QiiiHHHHBB", TimeBootMs*1000, Lat, Lon, 584090, 121, 200, int(Speed*100), int(Heading*100), 3, 10)),
+                (27, 144, struct.pack("<Qhhhhhhhhh", TimeBootMs*1000, 3, -2, -1001, 0, 1, 0, 198, 25, -412)),
+                (29, 115, struct.pack("<Iffh", TimeBootMs, 945.1, 0.0, 3150)),
+                (42, 28, struct.pack("<H", (Tick//80) % 5)),
+                (125, 203, struct.pack("<HHH", 5012, 0, 3)),
+                (152, 208, struct.pack("<HH", 0, 65535)),
+                (2, 137, struct.pack("<QI", 0, TimeBootMs)),
+            ]
+        if Tick % 120==0:
+            Frames.append((253, 83, struct.pack("<B50s", 6, "Reached waypoint #%d dist 0m" % ((Tick//120) % 5))))
+
+        for MessageId, CrcExtra, Payload in Frames:
+            ListOfFrames.append(_Frame(Sequence, MessageId, CrcExtra, Payload))
+            Sequence += 1
+    return ListOfFrames
+
+
+if __name__ == "__main__":
+    Arguments = sys.argv[1:]
+    if "--id" not in Arguments:
+        print "Usage: TrainCompressionDictionary.py --id N [--size BYTES] (--synthetic | flight1.tlog ...)"
+        sys.exit(1)
+
+    DictionaryId = int(Arguments[Arguments.index("--id")+1])
+    del Arguments[Arguments.index("--id"):Arguments.index("--id")+2]
+    if DictionaryId < 1 or DictionaryId > 255:
+        print "Dictionary id has to fit in one byte (1-255)"
+        sys.exit(1)
+
+    MaxSize = 4096
+    if "--size" in Arguments:
+        MaxSize = int(Arguments[Arguments.index("--size")+1])
+        del Arguments[Arguments.index("--size"):Arguments.index("--size")+2]
+
+    if "--synthetic" in Arguments:
+        ListOfFrames = GenerateSyntheticFrames()
+    else:
+        ListOfFrames = LoadFramesFromTelemetryLogs(Arguments)
+    print "Training on", len(ListOfFrames), "mavlink frames..."
+
+    Dictionary = CompressionDictionary.TrainDictionary(ListOfFrames, MaxSize=MaxSize)
+    Path = CompressionDictionary.GetDictionaryPath(DictionaryId)
+    with open(Path, "wb") as DictionaryFile:
+        DictionaryFile.write(Dictionary)
+    print "Wrote", len(Dictionary), "byte dictionary to", Path